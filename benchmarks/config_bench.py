@@ -0,0 +1,110 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compare serial and parallel configuration generation across
+different stack sizes. The generated files are hashed so that we
+can verify that both modes produce exactly the same output.
+
+Usage: python benchmarks/config_bench.py [size ...]
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import time
+from ferry.config.system.info import System
+from ferry.docker.configfactory import ConfigFactory
+from ferry.docker.docker import DockerInstance
+from ferry.workers import WorkerPool
+
+DEFAULT_SIZES = [4, 16, 64]
+
+def _new_containers(service, num):
+    """
+    Create some fake containers. Configuration generation only
+    needs the addresses and host names.
+    """
+    containers = []
+    for i, t in enumerate(service.get_total_instances(num, [])):
+        c = DockerInstance()
+        c.container = 'bench%d' % i
+        c.service_type = t
+        c.host_name = service.new_host_name(i)
+        c.internal_ip = '10.1.%d.%d' % (i / 250, i % 250 + 2)
+        c.external_ip = c.internal_ip
+        c.volumes = {}
+        containers.append(c)
+    return containers
+
+def _set_workers(factory, num_workers):
+    """
+    Use the same number of workers everywhere.
+    """
+    pool = WorkerPool(num_workers)
+    factory.workers = pool
+    factory.cassandra.workers = pool
+    factory.hadoop.workers = pool
+
+def _hash_output(config_dirs):
+    """
+    Hash the list of transferred directories and their contents.
+    """
+    h = hashlib.sha1()
+    for container, files, dest in config_dirs:
+        host_dir = os.path.dirname(files)
+        h.update("%s %s %s\n" % (container.container, host_dir, dest))
+        for f in sorted(os.listdir(host_dir)):
+            h.update(f)
+            h.update(open(os.path.join(host_dir, f)).read())
+    return h.hexdigest()
+
+def _clean_output(config_dirs):
+    for container, files, dest in config_dirs:
+        shutil.rmtree(os.path.dirname(files), ignore_errors=True)
+
+def _run(factory, service, containers, num_workers):
+    _set_workers(factory, num_workers)
+    start = time.time()
+    config_dirs, entry_point = factory.generate_storage_configuration('bench',
+                                                                      containers,
+                                                                      service)
+    elapsed = time.time() - start
+    digest = _hash_output(config_dirs)
+    _clean_output(config_dirs)
+    return elapsed, digest
+
+def main(sizes):
+    factory = ConfigFactory(System())
+    services = [('cassandra', factory.cassandra),
+                ('hadoop', factory.hadoop)]
+
+    print "%-10s %6s %10s %10s %8s" % ('service', 'size', 'serial', 'parallel', 'speedup')
+    for name, service in services:
+        for size in sizes:
+            containers = _new_containers(service, size)
+            serial, serial_digest = _run(factory, service, containers, 1)
+            parallel, parallel_digest = _run(factory, service, containers, None)
+            if serial_digest != parallel_digest:
+                print "%s: output differs for %d instances" % (name, size)
+                sys.exit(1)
+            print "%-10s %6d %9.3fs %9.3fs %7.2fx" % (name, size, serial, parallel, serial / parallel)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main([int(s) for s in sys.argv[1:]])
+    else:
+        main(DEFAULT_SIZES)
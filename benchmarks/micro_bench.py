@@ -0,0 +1,358 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Micro-benchmarks for the code that runs on every request or stack
+(IP allocation, port forwarding, configuration templates, environment
+variables, application listing, etc.). None of these need Docker, Mongo
+or the network: the Mongo collections are replaced by an in-memory
+collection and iptables is never called.
+
+Each benchmark reports operations per second and the memory allocated
+per operation. The growth of the peak resident memory is measured in a
+forked process, so it works on any Python but only counts whole pages.
+If tracemalloc is available (i.e., pytracemalloc), the peak memory 
+allocated per operation is reported as well.
+
+Usage: python benchmarks/micro_bench.py [--json] [name ...]
+"""
+
+import gc
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import ferry.install
+from ferry.cli.cli import CLI
+from ferry.config.cassandra.cassandraconfig import CassandraInitializer, CassandraConfig
+from ferry.config.system.info import System
+from ferry.docker.catalog import AppCatalog
+from ferry.docker.configfactory import ConfigFactory
+from ferry.docker.docker import DockerInstance
+from ferry.ip.dhcp import DHCP
+from ferry.ip.nat import NAT
+
+# Minimum time to run each benchmark.
+MIN_TIME = 1.0
+
+class MemoryCollection(object):
+    """
+    Just enough of a Mongo collection for the DHCP and NAT state.
+    """
+    def __init__(self):
+        self.docs = []
+
+    def _matches(self, doc, query):
+        return all(doc.get(k) == v for k, v in query.items())
+
+    def find(self, query=None):
+        return [d for d in self.docs if self._matches(d, query or {})]
+
+    def find_one(self, query=None):
+        for d in self.docs:
+            if self._matches(d, query or {}):
+                return d
+        return None
+
+    def insert(self, doc):
+        self.docs.append(dict(doc))
+
+    def update(self, query, change, upsert=False):
+        doc = self.find_one(query)
+        if not doc:
+            if not upsert:
+                return
+            doc = dict(query)
+            self.docs.append(doc)
+        doc.update(change.get('$set', {}))
+
+    def remove(self, query):
+        self.docs = [d for d in self.docs if not self._matches(d, query)]
+
+    def count(self):
+        return len(self.docs)
+
+def _new_nat():
+    nat = object.__new__(NAT)
+    nat._current_port = 999
+    nat.reserved_ports = [4000, 5000]
+    nat.nat_collection = MemoryCollection()
+
+    # Don't touch the real iptables.
+    nat._save_nat = lambda *args: None
+    nat._delete_nat = lambda *args: None
+    return nat
+
+def _new_dhcp():
+    dhcp = object.__new__(DHCP)
+    dhcp.free_ips = []
+    dhcp.reserved_ips = []
+    dhcp.ips = {}
+    dhcp.num_ips = 1
+    dhcp.num_addrs = 0
+    dhcp.nat = _new_nat()
+    dhcp.dhcp_collection = MemoryCollection()
+    dhcp.cidr_collection = MemoryCollection()
+    dhcp.assign_cidr('10.1.0.1/16')
+    return dhcp
+
+def bench_dhcp_churn():
+    """
+    Assign 256 addresses, then free and reassign half of them.
+    """
+    dhcp = _new_dhcp()
+    def run():
+        ips = [dhcp.assign_ip({}) for _ in range(256)]
+        for ip in ips[::2]:
+            dhcp.free_ip(ip)
+        for _ in ips[::2]:
+            dhcp.assign_ip({})
+    return run, 256 + 128 + 128
+
+def bench_nat_forward():
+    """
+    Add and delete 100 forwarding rules.
+    """
+    nat = _new_nat()
+    def run():
+        ports = [nat.random_port() for _ in range(100)]
+        for i, p in enumerate(ports):
+            nat.forward_rule('0.0.0.0/0', p, '10.1.0.%d' % (i + 2), '22')
+        for i, p in enumerate(ports):
+            nat.delete_rule('10.1.0.%d' % (i + 2), '22')
+    return run, 200
+
+def bench_cassandra_template():
+    """
+    Generate the cassandra.yaml of a single node.
+    """
+    init = CassandraInitializer(System())
+    init.template_dir = ferry.install.DEFAULT_TEMPLATE_DIR + '/cassandra'
+    config = CassandraConfig(1)
+    init._apply_profile(config, None)
+    container = { 'data_ip' : '10.1.0.2' }
+    host_dir = tempfile.mkdtemp()
+    def run():
+        init._generate_yaml_config(container, '10.1.0.2', '# initial_token:', host_dir, config)
+        init._generate_log4j_config(host_dir, config)
+    return run, 1, lambda: shutil.rmtree(host_dir)
+
+def _deep_entry_point(depth, width):
+    entry = {}
+    for i in range(width):
+        entry[u'key%d' % i] = u'value%d' % i
+    if depth > 0:
+        entry[u'layer'] = _deep_entry_point(depth - 1, width)
+    return entry
+
+def bench_env_vars():
+    """
+    Generate the connector environment from two storage and compute
+    backends with 5 layers of 20 values each.
+    """
+    factory = object.__new__(ConfigFactory)
+    storage = [_deep_entry_point(5, 20) for _ in range(2)]
+    compute = [[_deep_entry_point(5, 20)] for _ in range(2)]
+    def run():
+        factory.generate_env_vars(storage_info = storage,
+                                  compute_info = compute)
+    return run, 1
+
+def bench_instance_json():
+    """
+    Serialize and parse 100 container descriptions.
+    """
+    instances = []
+    for i in range(100):
+        c = DockerInstance()
+        c.container = uuid.uuid4().hex
+        c.service_type = 'hadoop'
+        c.host_name = 'hadoop%d' % i
+        c.internal_ip = '10.1.0.%d' % (i + 2)
+        c.external_ip = c.internal_ip
+        c.ports = { '50070' : [ { 'HostIp' : '0.0.0.0', 'HostPort' : str(1000 + i) } ] }
+        c.image = 'ferry/hadoop'
+        c.volumes = { '/tmp/data%d' % i : '/service/data' }
+        instances.append(c)
+    def run():
+        data = json.dumps([c.json() for c in instances])
+        [DockerInstance(j) for j in json.loads(data)]
+    return run, 100
+
+def _app_dir():
+    """
+    Install 200 applications from 10 users.
+    """
+    app_dir = tempfile.mkdtemp()
+    plans = os.listdir(ferry.install.DEFAULT_BUILTIN_APPS)
+    for i in range(200):
+        user_dir = os.path.join(app_dir, 'user%d' % (i % 10))
+        if not os.path.isdir(user_dir):
+            os.makedirs(user_dir)
+        shutil.copy(os.path.join(ferry.install.DEFAULT_BUILTIN_APPS, plans[i % len(plans)]),
+                    os.path.join(user_dir, 'app%d.yaml' % i))
+    return app_dir
+
+def bench_query_applications():
+    """
+    List 200 installed applications from the catalog.
+    """
+    app_dir = _app_dir()
+    catalog = AppCatalog([app_dir])
+    def run():
+        catalog.query()
+    return run, 200, lambda: shutil.rmtree(app_dir)
+
+def bench_query_applications_cold():
+    """
+    List 200 installed applications, reading all of them.
+    """
+    app_dir = _app_dir()
+    def run():
+        AppCatalog([app_dir]).query()
+    return run, 200, lambda: shutil.rmtree(app_dir)
+
+def bench_ps_table():
+    """
+    Format the "ferry ps" table with 500 stacks.
+    """
+    stacks = {}
+    for i in range(500):
+        stack_id = 'sa-%s' % uuid.uuid4().hex[:8]
+        stacks[stack_id] = { 'uuid' : stack_id,
+                             'base' : 'hadoop',
+                             'ts' : '10/3/2014 (10:00 AM)',
+                             'backends' : [ { 'storage' : 'se-%d' % i,
+                                              'compute' : ['se-%d' % (i + 1)] } ],
+                             'connectors' : ['se-%d' % (i + 2)],
+                             'status' : 'running' }
+    cli = object.__new__(CLI)
+    def run():
+        cli._format_table_query(stacks)
+    return run, 500
+
+BENCHMARKS = [('dhcp_churn', bench_dhcp_churn),
+              ('nat_forward', bench_nat_forward),
+              ('cassandra_template', bench_cassandra_template),
+              ('env_vars', bench_env_vars),
+              ('instance_json', bench_instance_json),
+              ('query_applications', bench_query_applications),
+              ('query_applications_cold', bench_query_applications_cold),
+              ('ps_table', bench_ps_table)]
+
+def _measure_rss(run):
+    """
+    Growth of the peak resident memory during a single run. The run 
+    happens in a child process, so that memory used by earlier runs 
+    doesn't hide the growth. 
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        growth = 0
+        try:
+            gc.collect()
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            run()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            growth = (after - before) * 1024
+        finally:
+            os.write(w, str(growth))
+            os._exit(0)
+
+    os.close(w)
+    data = os.read(r, 64)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return int(data or 0)
+
+def _measure_allocations(run):
+    """
+    Peak memory allocated by a single run.
+    """
+    if not tracemalloc:
+        return None
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def _run_benchmark(name, bench):
+    setup = bench()
+    run, ops = setup[0], setup[1]
+    try:
+        # Warm up, then run for at least the minimum time.
+        run()
+        runs = 0
+        start = time.time()
+        while True:
+            run()
+            runs += 1
+            elapsed = time.time() - start
+            if elapsed >= MIN_TIME:
+                break
+
+        result = { 'name' : name,
+                   'ops_per_sec' : round(runs * ops / elapsed, 1),
+                   'usec_per_op' : round(elapsed / (runs * ops) * 1000000, 2),
+                   'rss_bytes_per_op' : round(float(_measure_rss(run)) / ops, 1),
+                   'bytes_per_op' : None }
+        allocated = _measure_allocations(run)
+        if allocated is not None:
+            result['bytes_per_op'] = round(float(allocated) / ops, 1)
+        return result
+    finally:
+        if len(setup) > 2:
+            setup[2]()
+
+def main(names, as_json):
+    results = []
+    for name, bench in BENCHMARKS:
+        if names and not name in names:
+            continue
+        r = _run_benchmark(name, bench)
+        results.append(r)
+        if not as_json:
+            allocated = '-'
+            if r['bytes_per_op'] is not None:
+                allocated = '%.1f' % r['bytes_per_op']
+            print "%-24s %12.1f ops/s %10.2f us/op %12.1f rss bytes/op %12s bytes/op" % (r['name'], 
+                                                                                      r['ops_per_sec'],
+                                                                                      r['usec_per_op'], 
+                                                                                      r['rss_bytes_per_op'],
+                                                                                      allocated)
+    if as_json:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    as_json = '--json' in args
+    main([a for a in args if a != '--json'], as_json)
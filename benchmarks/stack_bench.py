@@ -0,0 +1,258 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure how long the Ferry server takes to build stacks. Stacks are
+created through the HTTP API and built by the normal stack worker, but
+on the simulated fabric, so no containers are started. The latency of
+the Docker commands, DHCP server and ssh are configured with --latency
+(i.e., --latency run=2 --latency ssh=0.5), and --scale shrinks all of
+them so that the benchmark finishes quickly.
+
+The server needs a Mongo database on port 27017. Either set MONGODB,
+or use --mongod to start a throwaway database.
+
+Usage: python benchmarks/stack_bench.py [--plans hadoop,cassandra]
+         [--sizes 1,2,4] [--runs 3] [--concurrency 1] [--scale 0.1]
+         [--mongod mongod] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+DEFAULT_PLANS = ['hadoop', 'cassandra', 'spark', 'openmpi']
+DEFAULT_SIZES = [1, 2, 4]
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark stack creation')
+    parser.add_argument('--plans', default=','.join(DEFAULT_PLANS),
+                        help='applications to start (from ferry/data/plans)')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='number of instances of each service')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='number of stacks to build for each plan and size')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='number of stacks requested at the same time')
+    parser.add_argument('--scale', type=float, default=0.1,
+                        help='multiply all the simulated latencies')
+    parser.add_argument('--latency', action='append', default=[],
+                        help='latency of an operation, i.e. run=2.0')
+    parser.add_argument('--failure', action='append', default=[],
+                        help='failure rate of an operation, i.e. ssh=0.01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongod', default=None,
+                        help='start this mongod instead of using MONGODB')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='give up on a stack after this many seconds')
+    parser.add_argument('--output', default=None,
+                        help='write the results as JSON to this file')
+    return parser.parse_args()
+
+def _parse_values(args):
+    values = {}
+    for a in args:
+        k, v = a.split('=')
+        values[k] = float(v)
+    return values
+
+def _setup_env(work_dir, args):
+    """
+    Point Ferry at a scratch directory and a configuration that uses
+    the simulated fabric. This has to happen before Ferry is imported.
+    """
+    conf = { 'system' : { 'backend' : 'ferry.fabric.simulated/SimulatedFabric',
+                          'simulate' : { 'scale' : args.scale,
+                                         'seed' : args.seed,
+                                         'latency' : _parse_values(args.latency),
+                                         'failures' : _parse_values(args.failure) } } }
+    with open(os.path.join(work_dir, '.ferry-config.yaml'), 'w') as f:
+        f.write(yaml.dump(conf))
+
+    os.environ['HOME'] = work_dir
+    os.environ['FERRY_DIR'] = os.path.join(work_dir, 'ferry')
+    os.environ['FERRY_SCRATCH'] = os.path.join(work_dir, 'scratch')
+    if not 'MONGODB' in os.environ:
+        os.environ['MONGODB'] = '127.0.0.1'
+    return conf
+
+def _start_mongod(mongod, work_dir):
+    db_dir = os.path.join(work_dir, 'db')
+    os.makedirs(db_dir)
+    proc = subprocess.Popen([mongod, '--dbpath', db_dir,
+                             '--port', '27017',
+                             '--bind_ip', '127.0.0.1',
+                             '--nojournal', '--quiet'],
+                            stdout=open(os.path.join(work_dir, 'mongod.log'), 'w'),
+                            stderr=subprocess.STDOUT)
+    time.sleep(3)
+    return proc
+
+def _read_plan(plan, size):
+    """
+    Read the application and answer all the questions
+    (which are all number of instances) with the size.
+    """
+    import ferry.install
+    path = os.path.join(ferry.install.DEFAULT_BUILTIN_APPS, plan + '.yaml')
+    payload = yaml.load(open(path, 'r'))
+    for q in payload.get('questions', []):
+        q['_answer'] = str(size)
+    payload['_file_path'] = path
+    payload['_file'] = plan
+    return payload
+
+def _percentile(values, p):
+    values = sorted(values)
+    i = int(round(p * (len(values) - 1)))
+    return values[i]
+
+def _build_stacks(api, client, payloads, key, timeout):
+    """
+    Request all the stacks at once and wait for all of them to finish.
+    """
+    start = time.time()
+    stacks = []
+    for payload in payloads:
+        res = client.post('/create', data={ 'payload' : json.dumps(payload),
+                                            'key' : key })
+        reply = json.loads(res.data)
+        stacks.append(reply['text'])
+
+    results = []
+    for uuid in stacks:
+        events = []
+        finished = False
+        while not finished and time.time() - start < timeout:
+            new_events, finished = api.docker.events.wait(uuid, len(events), 5)
+            events += new_events
+
+        status = 'timeout'
+        if finished and len(events) > 0:
+            status = events[-1]['phase']
+
+        phases = {}
+        for e in events:
+            phases[e['phase']] = phases.get(e['phase'], 0) + e['duration']
+
+        trace = api.docker.get_trace(uuid) or {}
+        results.append( { 'uuid' : uuid,
+                          'status' : status,
+                          'latency' : events[-1]['elapsed'] if events else None,
+                          'phases' : phases,
+                          'summary' : trace.get('summary', []) } )
+    return results, time.time() - start
+
+def _remove_stacks(api, results, key):
+    for r in results:
+        api.docker.manage_stack(stack_uuid=r['uuid'], private_key=key, action='stop')
+        api.docker.manage_stack(stack_uuid=r['uuid'], private_key=key, action='rm')
+
+def _summarize(plan, size, results, elapsed_times):
+    ok = [r for r in results if r['status'] == 'running']
+    latencies = [r['latency'] for r in ok]
+    summary = { 'plan' : plan,
+                'size' : size,
+                'stacks' : len(results),
+                'failed' : len(results) - len(ok),
+                'throughput' : round(len(ok) / sum(elapsed_times) * 60, 3) }
+    if latencies:
+        summary['latency'] = { 'min' : min(latencies),
+                               'mean' : round(sum(latencies) / len(latencies), 3),
+                               'p50' : _percentile(latencies, 0.5),
+                               'p95' : _percentile(latencies, 0.95),
+                               'max' : max(latencies) }
+
+    # Average time spent in each phase, and the time
+    # spent in each kind of operation.
+    phases = {}
+    for r in ok:
+        for k, v in r['phases'].items():
+            phases[k] = phases.get(k, 0) + v / len(ok)
+    summary['phases'] = dict((k, round(v, 3)) for k, v in phases.items())
+
+    operations = {}
+    for r in ok:
+        for s in r['summary']:
+            op = operations.setdefault(s['name'], { 'count' : 0, 'total' : 0.0 })
+            op['count'] += s['count']
+            op['total'] = round(op['total'] + s['total'], 3)
+    summary['operations'] = operations
+    return summary
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix='ferry-bench-')
+    conf = _setup_env(work_dir, args)
+    mongod = None
+    if args.mongod:
+        mongod = _start_mongod(args.mongod, work_dir)
+
+    try:
+        # Importing the server creates the manager and stack worker.
+        import ferry.install
+        import ferry.http.httpapi as api
+
+        # The connector images are never used, so don't try to pull them.
+        api.installer._check_image_installed = lambda image: True
+        api.installer.prefetch_images = lambda images: None
+
+        client = api.app.test_client()
+        key = ferry.install.DEFAULT_SSH_KEY
+        summaries = []
+
+        print "%-10s %5s %6s %7s %9s %9s %9s %10s" % ('plan', 'size', 'stacks', 'failed',
+                                                       'mean', 'p95', 'max', 'stacks/min')
+        for plan in args.plans.split(','):
+            for size in [int(s) for s in args.sizes.split(',')]:
+                results = []
+                elapsed_times = []
+                for _ in range(args.runs):
+                    payloads = [_read_plan(plan, size) for _ in range(args.concurrency)]
+                    batch, elapsed = _build_stacks(api, client, payloads, key, args.timeout)
+                    _remove_stacks(api, batch, key)
+                    results += batch
+                    elapsed_times.append(elapsed)
+
+                s = _summarize(plan, size, results, elapsed_times)
+                summaries.append(s)
+                latency = s.get('latency', { 'mean' : 0, 'p95' : 0, 'max' : 0 })
+                print "%-10s %5d %6d %7d %8.2fs %8.2fs %8.2fs %10.2f" % (plan, size, s['stacks'], s['failed'],
+                                                                       latency['mean'], latency['p95'],
+                                                                       latency['max'], s['throughput'])
+
+        output = { 'time' : time.time(),
+                   'concurrency' : args.concurrency,
+                   'runs' : args.runs,
+                   'simulate' : conf['system']['simulate'],
+                   'operations' : api.docker.docker.simulation.counts,
+                   'results' : summaries }
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(json.dumps(output, indent=2, sort_keys=True))
+        return output
+    finally:
+        if mongod:
+            mongod.terminate()
+            mongod.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(_parse_args())
@@ -13,6 +13,7 @@
 # limitations under the License.
 #
 
+import collections
 import errno
 import ferry
 import grp
@@ -27,12 +28,15 @@ import re
 import sets
 import StringIO
 import sys
+import tarfile
+import time
 from termcolor import colored
 import yaml
 from requests.exceptions import ConnectionError
 from ferry.table.prettytable import *
 from ferry.options import CmdHelp
 from ferry.install import Installer, FERRY_HOME, GUEST_DOCKER_REPO, DEFAULT_FERRY_APPS
+from ferry.docker.catalog import AppCatalog, load_app
 
 class CLI(object):
     def __init__(self):
@@ -43,13 +47,17 @@ class CLI(object):
         self.cmds.add_option("-b", "--build", "Build Ferry default images")
         self.cmds.add_option("-c", "--conf", "Deployment configuration")
         self.cmds.add_option("-d", "--dns", "Specify DNS servers")
+        self.cmds.add_option("-i", "--timings", "Show where the time went when building a stack")
+        self.cmds.add_option("-f", "--follow", "Follow the progress of a new stack")
         self.cmds.add_option("-k", "--key", "Specify key directory")
         self.cmds.add_option("-l", "--log", "Log configuration file")
         self.cmds.add_option("-m", "--mode", "Deployment mode")
         self.cmds.add_option("-n", "--naked", "Start in naked mode")
+        self.cmds.add_option("-o", "--clone", "Start a snapshot with a copy of its data")
         self.cmds.add_option("-r", "--retry", "Retry action on failure")
         self.cmds.add_option("-t", "--net", "Use host network device")
         self.cmds.add_option("-u", "--upgrade", "Upgrade Ferry")
+        self.cmds.add_option("-w", "--watch", "Keep refreshing the list of stacks")
         self.cmds.add_cmd("build", "Build a Dockerfile")
         self.cmds.add_cmd("clean", "Clean zombie Ferry processes")
         self.cmds.add_cmd("help", "Print this help message")
@@ -73,21 +81,50 @@ class CLI(object):
         self.cmds.add_cmd("quit", "Stop the Ferry servers")
 
         self.ferry_server = 'http://127.0.0.1:4000'
+
+        # Reuse the connections to the Ferry server. 
+        self.session = requests.Session()
         self.default_user = 'root'
         self.installer = Installer(self)
 
-    def _pull_image(self, image):
+    def _pull_image(self, image, wait=True):
         """
         Pull a remote image to the local registry. 
         """
         try:
             payload = { 'image' : image } 
-            res = requests.get(self.ferry_server + '/image', params=payload)
-            return str(res.text)
+            res = self.session.get(self.ferry_server + '/image', params=payload)
+            job = json.loads(str(res.text))
         except ConnectionError:
             logging.error("could not connect to ferry server")
             return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
 
+        if wait:
+            return self._wait_image_job(job)
+        return job
+
+    def _wait_image_job(self, job):
+        """
+        Print the progress of an image push/pull until it's done. 
+        """
+        while job['status'] in ['queued', 'running']:
+            sys.stdout.write("%s %s: %s, %d/%d layers, %.1f MB\n" % (job['action'], job['image'], job['status'],
+                                                                   job['layers_done'], job['layers_total'],
+                                                                   job['bytes'] / 1000000.0))
+            sys.stdout.flush()
+            time.sleep(2)
+            try:
+                res = self.session.get(self.ferry_server + '/image/job', params={ 'id' : job['id'] })
+                job = json.loads(str(res.text))
+            except ConnectionError:
+                logging.error("could not connect to ferry server")
+                return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
+
+        if job['status'] == 'done':
+            return "success"
+        else:
+            return "fail"
+
     def _pull_app(self, app):
         """
         Pull a local application to Ferry servers. 
@@ -106,14 +143,18 @@ class CLI(object):
             payload = { 'id' : account,
                         'app' : app, 
                         'sig' : sig }
-            res = requests.get(server + '/app', params=payload)
+            res = self.session.get(server + '/app', params=payload)
             status = json.loads(res.text)
             file_name = self.installer.store_app(app, status['ext'], status['content'])
             if file_name:
                 content = self._read_app_content(file_name)
                 images = self._get_user_images(content)
-                for i in images:
-                    self._pull_image(i)
+
+                # Pull all the images at once. 
+                jobs = [self._pull_image(i, wait=False) for i in images]
+                for j in jobs:
+                    if isinstance(j, dict):
+                        self._wait_image_job(j)
                 return app
             else:
                 return "failed"
@@ -142,19 +183,23 @@ class CLI(object):
         else:
             return self._pull_app(image)
 
-    def _push_image(self, image, registry):
+    def _push_image(self, image, registry, wait=True):
         """
         Push a local image to a remote registry. 
         """
         try:
             payload = { 'image' : image,
                         'server' : registry } 
-            res = requests.post(self.ferry_server + '/image', data=payload)
-            return str(res.text)
+            res = self.session.post(self.ferry_server + '/image', data=payload)
+            job = json.loads(str(res.text))
         except ConnectionError:
             logging.error("could not connect to ferry server")
             return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
 
+        if wait:
+            return self._wait_image_job(job)
+        return job
+
     def _builtin_image(self, image):
         """
         Indicates whether the image is a pre-built Ferry image. 
@@ -180,16 +225,7 @@ class CLI(object):
         """
         Read the content of the application. 
         """
-        json_arg = None
-        with open(file_path, "r") as f:
-            n, e = os.path.splitext(file_path)
-            if e == '.json':
-                json_string = self._read_file_arg(file_path)
-                json_arg = json.loads(json_string)
-            elif e == '.yaml' or e == '.yml':
-                yaml_file = open(file_path, 'r')
-                json_arg = yaml.load(yaml_file)
-        return json_arg
+        return load_app(file_path)
 
     def _push_app(self, app, registry):
         """
@@ -200,8 +236,10 @@ class CLI(object):
         content = self._read_app_content(app)
         if content:
             images = self._get_user_images(content)
-            for i in images:
-                self._push_image(i, registry)
+            jobs = [self._push_image(i, registry, wait=False) for i in images]
+            for j in jobs:
+                if isinstance(j, dict):
+                    self._wait_image_job(j)
         
         # Register the application in the Ferry database. 
         account, key, server = self.installer.get_ferry_account()
@@ -223,7 +261,7 @@ class CLI(object):
                                 'ext' : ext, 
                                 'content' : content,
                                 'sig' : sig }
-                    res = requests.post(server + '/app', data=payload)
+                    res = self.session.post(server + '/app', data=payload)
                     status = json.loads(res.text)
                     if status['status'] == 'fail':
                         logging.error("failed to register app " + app)
@@ -285,12 +323,40 @@ class CLI(object):
         Login to a remote registry
         """
         try:
-            res = requests.post(self.ferry_server + '/login')
+            res = self.session.post(self.ferry_server + '/login')
             return str(res.text)
         except ConnectionError:
             logging.error("could not connect to ferry server")
             return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
 
+    def _follow_stack(self, stack_uuid):
+        """
+        Print the progress events of the stack until it's built. 
+        """
+        after = 0
+        while True:
+            payload = { 'uuid' : stack_uuid,
+                        'after' : after,
+                        'timeout' : 10 }
+            try:
+                res = self.session.get(self.ferry_server + '/stack/events', params=payload)
+                reply = json.loads(str(res.text))
+            except ConnectionError:
+                logging.error("could not connect to ferry server")
+                return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
+
+            for e in reply['events']:
+                after = e['seq']
+                details = []
+                for k in ['service', 'type', 'instances', 'error']:
+                    if k in e:
+                        details.append("%s=%s" % (k, e[k]))
+                sys.stdout.write("[%7.1fs] %-22s %s\n" % (e['elapsed'], e['phase'], " ".join(details)))
+                sys.stdout.flush()
+
+            if reply['finished']:
+                return stack_uuid
+
     def _create_stack(self, stack_description, args, private_key):
         """
         Create a new stack. 
@@ -298,7 +364,7 @@ class CLI(object):
         payload = { 'payload' : json.dumps(stack_description),
                     'key' : private_key }
         try:
-            res = requests.post(self.ferry_server + '/create', data=payload)
+            res = self.session.post(self.ferry_server + '/create', data=payload)
             return True, str(res.text)
         except ConnectionError:
             logging.error("could not connect to ferry server")
@@ -352,7 +418,7 @@ class CLI(object):
         return t.get_string(sortby="Date",
                             padding_width=2)
 
-    def _format_table_query(self, json_data):
+    def _format_table_query(self, json_data, sortby="UUID"):
         storage = []
         compute = []
         connectors = []
@@ -397,7 +463,7 @@ class CLI(object):
         t.add_column("Base", base)
         t.add_column("Time", time)
 
-        return t.get_string(sortby="UUID",
+        return t.get_string(sortby=sortby,
                             padding_width=2)
 
     def _stop_all(self, private_key):
@@ -418,15 +484,29 @@ class CLI(object):
 
             # Shutdown any backend services that may have
             # been started (e.g., OpenStack Heat server, etc.). 
-            res = requests.post(self.ferry_server + '/quit')
+            res = self.session.post(self.ferry_server + '/quit')
             logging.info(res.text)
         except ConnectionError:
             logging.error("could not connect to ferry server")
         
-    def _read_stacks(self, show_all=False, args=None):
+    def _query_params(self, args):
+        """
+        Turn the "ps" filters (i.e., status=running sort=-ts limit=10)
+        into query parameters. 
+        """
+        params = {}
+        for a in args or []:
+            if isinstance(a, basestring) and '=' in a and not a.startswith('--'):
+                k, v = a.split('=', 1)
+                if k in ['status', 'sort', 'limit']:
+                    params[k] = v
+        return params
+
+    def _read_stacks(self, show_all=False, args=None, watch=False):
+        params = self._query_params(args)
         try:
-            res = requests.get(self.ferry_server + '/query')
-            query_reply = json.loads(res.text)
+            res = self.session.get(self.ferry_server + '/query', params=params)
+            query_reply = json.loads(res.text, object_pairs_hook=collections.OrderedDict)
 
             deployed_reply = {}
             if show_all:
@@ -435,21 +515,91 @@ class CLI(object):
                 payload = { 'mode' : mode,
                             'conf' : conf }
 
-                res = requests.get(self.ferry_server + '/deployed', params=payload)
+                res = self.session.get(self.ferry_server + '/deployed', params=payload)
                 deployed_reply = json.loads(res.text)
 
-            # Merge the replies and format.
-            return self._format_table_query(dict(query_reply.items() + deployed_reply.items()))
+            # Merge the replies and format. If the stacks were 
+            # sorted by the server, keep that order. 
+            stacks = collections.OrderedDict(query_reply.items() + deployed_reply.items())
+            sortby = "UUID"
+            if 'sort' in params:
+                sortby = None
+
+            if watch:
+                return self._watch_stacks(stacks, params, sortby)
+            return self._format_table_query(stacks, sortby)
         except ConnectionError:
             logging.error("could not connect to ferry server")
             return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
 
+    def _watch_stacks(self, stacks, params, sortby):
+        """
+        Redraw the stacks whenever they change. Only the stacks 
+        updated since the last refresh are fetched. The status filter
+        and limit are applied here instead of by the server, since a 
+        stack that no longer matches them must still be removed. 
+        """
+        status = None
+        if 'status' in params:
+            status = params['status'].split(',')
+
+        payload = {}
+        if 'sort' in params:
+            payload['sort'] = params['sort']
+
+        since = max([s.get('updated', 0) for s in stacks.values()] + [0])
+        try:
+            while True:
+                sys.stdout.write("\033[2J\033[H")
+                sys.stdout.write(self._format_table_query(stacks, sortby) + "\n")
+                sys.stdout.flush()
+
+                changed = False
+                while not changed:
+                    time.sleep(2)
+                    payload['since'] = repr(since)
+                    res = self.session.get(self.ferry_server + '/query', params=payload)
+                    removed = False
+                    for uuid, s in json.loads(res.text).items():
+                        since = max(since, s['updated'])
+                        changed = True
+
+                        # Stacks that no longer match the filter disappear. 
+                        if status and not s['status'] in status:
+                            if stacks.pop(uuid, None):
+                                removed = True
+                        else:
+                            stacks[uuid] = s
+
+                # If a stack disappeared from a limited list, the next 
+                # stack was never fetched, so just read the whole list again. 
+                if removed and 'limit' in params:
+                    res = self.session.get(self.ferry_server + '/query', params=params)
+                    stacks = json.loads(res.text, object_pairs_hook=collections.OrderedDict)
+                else:
+                    stacks = self._order_stacks(stacks, params)
+        except KeyboardInterrupt:
+            return ""
+
+    def _order_stacks(self, stacks, params):
+        """
+        Sort and limit the stacks the same way the server does. 
+        """
+        values = stacks.items()
+        if 'sort' in params:
+            values = sorted(values, 
+                            key = lambda v: v[1].get('order'), 
+                            reverse = params['sort'].startswith('-'))
+        if 'limit' in params:
+            values = values[:int(params['limit'])]
+        return collections.OrderedDict(values)
+
     def _list_apps(self):
         """
         List all installed applications including the built-in applications.
         """
         try:
-            res = requests.get(self.ferry_server + '/apps')
+            res = self.session.get(self.ferry_server + '/apps')
             json_reply = json.loads(res.text)
             return self._format_apps_query(json_reply)
         except ConnectionError:
@@ -461,7 +611,7 @@ class CLI(object):
         List all installed Docker images.
         """
         try:
-            res = requests.get(self.ferry_server + '/images')
+            res = self.session.get(self.ferry_server + '/images')
             json_reply = json.loads(res.text)
             return self._format_images_query(json_reply)
         except ConnectionError:
@@ -473,7 +623,7 @@ class CLI(object):
         List all snapshots.
         """
         try:
-            res = requests.get(self.ferry_server + '/snapshots')
+            res = self.session.get(self.ferry_server + '/snapshots')
             json_reply = json.loads(res.text)
             return self._format_snapshots_query(json_reply)
         except ConnectionError:
@@ -492,22 +642,73 @@ class CLI(object):
         """
         payload = { 'uuid':stack_id }
         try:
-            res = requests.get(self.ferry_server + '/stack', params=payload)
+            res = self.session.get(self.ferry_server + '/stack', params=payload)
             return res.text
         except ConnectionError:
             logging.error("could not connect to ferry server")
             return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
 
-    def _copy_logs(self, stack_id, to_dir):
+    def _inspect_timings(self, stack_id):
         """
-        Copy over the logs. 
+        Show the time spent in each phase of the last stack build. 
         """
-        payload = {'uuid':stack_id,
-                   'dir':to_dir}
+        payload = { 'uuid':stack_id }
         try:
-            res = requests.get(self.ferry_server + '/logs', params=payload)
-            json_value = json.loads(str(res.text))
-            return self._format_stack_inspect(json_value)
+            res = self.session.get(self.ferry_server + '/stack/trace', params=payload)
+            trace = json.loads(str(res.text))
+        except ConnectionError:
+            logging.error("could not connect to ferry server")
+            return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
+        if not 'summary' in trace:
+            return trace['msg']
+
+        t = PrettyTable(["Phase", "Count", "Errors", "Total (s)", "Max (s)"])
+        for s in trace['summary']:
+            t.add_row([s['name'], s['count'], s['errors'], s['total'], s['max']])
+        output = "%s built in %.1fs\n" % (stack_id, trace['elapsed'])
+        output += t.get_string()
+
+        # Also show the slowest individual steps. 
+        slowest = sorted(trace['spans'], key=lambda s: -s['duration'])[:10]
+        t = PrettyTable(["Slowest", "Start (s)", "Duration (s)", "Status"])
+        for s in slowest:
+            name = s['name']
+            if 'cmd' in s:
+                name += " " + s['cmd'][:60]
+            t.add_row([name, s['start'], s['duration'], s['status']])
+        output += "\n" + t.get_string()
+        if trace['dropped'] > 0:
+            output += "\n(%d steps not recorded)" % trace['dropped']
+        return output
+
+    def _copy_logs(self, stack_id, to_dir, args=None):
+        """
+        Copy over the logs. The logs are streamed as a compressed
+        tar and extracted as they arrive. The optional arguments
+        are filters of the form 'key=value' (types, glob, since, tail). 
+        """
+        payload = {'uuid':stack_id}
+        for a in args or []:
+            key, _, value = a.partition('=')
+            if key == 'since':
+                # The user supplies the number of seconds ago. 
+                value = str(int(time.time()) - int(value))
+            payload[key] = value
+
+        try:
+            res = self.session.get(self.ferry_server + '/logs', params=payload, stream=True)
+            if res.status_code != 200:
+                return "could not copy logs (%s)" % res.text
+            if not os.path.isdir(to_dir):
+                os.makedirs(to_dir)
+
+            num_files = 0
+            tar = tarfile.open(fileobj=res.raw, mode='r|gz')
+            for member in tar:
+                tar.extract(member, to_dir)
+                num_files += 1
+            tar.close()
+            return "copied %d log files to %s" % (num_files, to_dir)
         except ConnectionError:
             logging.error("could not connect to ferry server")
             return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
@@ -519,7 +720,7 @@ class CLI(object):
         # Get the IP and default user information for this connector.
         payload = {'uuid':stack_id}
         try:
-            res = requests.get(self.ferry_server + '/stack', params=payload)
+            res = self.session.get(self.ferry_server + '/stack', params=payload)
             json_value = json.loads(str(res.text))
         except ConnectionError:
             logging.error("could not connect to ferry server")
@@ -564,11 +765,33 @@ class CLI(object):
         Manage the stack. 
         """
         try:
-            res = requests.post(self.ferry_server + '/manage/stack', data=stack_info)
+            res = self.session.post(self.ferry_server + '/manage/stack', data=stack_info)
             return str(res.text)        
         except ConnectionError:
             logging.error("could not connect to ferry server")
             return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
+
+    def _manage_many_stacks(self, uuids, constraints, private_key, action):
+        """
+        Manage a list of stacks, and/or all the stacks that match the
+        constraints (i.e., base=hadoop), in a single request. The server
+        manages the stacks concurrently. 
+        """
+        payload = { 'uuids' : json.dumps(uuids),
+                    'key' : private_key,
+                    'action' : action }
+        if constraints:
+            payload['constraints'] = json.dumps(constraints)
+        try:
+            res = self.session.post(self.ferry_server + '/manage/stacks', data=payload)
+            stacks = json.loads(str(res.text))
+        except ConnectionError:
+            logging.error("could not connect to ferry server")
+            return "It appears Ferry servers are not running.\nType sudo ferry server and try again."
+
+        if len(stacks) == 0:
+            return "no matching stacks"
+        return "%s: %s" % (action, " ".join(stacks))
         
     def _print_help(self):
         """
@@ -581,7 +804,7 @@ class CLI(object):
         Output version information.
         """
         try:
-            res = requests.get(self.ferry_server + '/version')
+            res = self.session.get(self.ferry_server + '/version')
             s = self.cmds.description + '\n'
             s += "Version: %s\n" % self.cmds.version
             s += "Docker: %s\n" % res.text.strip()
@@ -614,17 +837,8 @@ class CLI(object):
         Help find the path to the application. Check both the built-in
         global directory and the user-installed directory.
         """
-        file_path = None
-        for item in os.listdir(FERRY_HOME + '/data/plans/'):
-            if app == os.path.splitext(item)[0]:
-                return FERRY_HOME + '/data/plans/' + item
-
-        if not file_path:
-            for user in os.listdir(DEFAULT_FERRY_APPS):
-                if os.path.isdir(DEFAULT_FERRY_APPS + '/' + user):
-                    for item in os.listdir(DEFAULT_FERRY_APPS + '/' + user):
-                        if app == user + '/' + os.path.splitext(item)[0]:
-                            return DEFAULT_FERRY_APPS + '/' + user + '/' + item
+        catalog = AppCatalog([FERRY_HOME + '/data/plans', DEFAULT_FERRY_APPS])
+        return catalog.path(app)
 
     def _format_output(self, reply):
         output = reply['text'] + "\n"
@@ -670,6 +884,11 @@ class CLI(object):
             json_arg['_file_path'] = file_path
         json_arg['_file'] = arg
 
+        # When starting from a snapshot, optionally start
+        # with a copy of the snapshot's storage data. 
+        if '-o' in options:
+            json_arg['_clone'] = True
+
         # Create the application stack and print
         # the status message.
         posted, reply = self._create_stack(json_arg, args, private_key)
@@ -678,11 +897,22 @@ class CLI(object):
                 reply = json.loads(reply)
                 if reply['status'] == 'failed':
                     return 'could not create application'
+                elif '-f' in options and reply['status'] == 'building':
+                    return self._follow_stack(reply['text'])
                 else:
                     return self._format_output(reply)
             except ValueError as e:
                 logging.error(reply)
 
+    def _option_args(self, args, options, option):
+        """
+        An option takes the values that follow it (i.e., "inspect -i sa-0"), 
+        so hand those values back to the command. 
+        """
+        values = [a for a in args if a is not True]
+        values += [a for a in options.get(option, []) if a is not True]
+        return values
+
     def dispatch_cmd(self, cmd, args, options):
         """
         This is the command dispatch table. 
@@ -690,11 +920,13 @@ class CLI(object):
         if(cmd == 'start'):
             return self._start_stack(options, args)
         elif(cmd == 'ps'):
+            watch = '-w' in options
+            args = self._option_args(args, options, '-w')
             if len(args) > 0 and args[0] == '-a':
                 opt = args.pop(0)
-                return self._read_stacks(show_all=True, args = args)
+                return self._read_stacks(show_all=True, args = args, watch = watch)
             else:
-                return self._read_stacks(show_all=False, args = args)
+                return self._read_stacks(show_all=False, args = args, watch = watch)
         elif(cmd == 'snapshots'):
             return self._list_snapshots()
         elif(cmd == 'install'):
@@ -706,9 +938,11 @@ class CLI(object):
             self.installer._stop_docker_daemon(force=True)
             return 'cleaned ferry'
         elif(cmd == 'inspect'):
+            if '-i' in options:
+                return self._inspect_timings(self._option_args(args, options, '-i')[0])
             return self._inspect_stack(args[0])
         elif(cmd == 'logs'):
-            return self._copy_logs(args[0], args[1])
+            return self._copy_logs(args[0], args[1], args[2:])
         elif(cmd == 'server'):
             self.installer.start_web(options)
             return 'started ferry'
@@ -749,10 +983,16 @@ class CLI(object):
             # The user wants to perform some management function
             # over the stack. 
             private_key = self._get_ssh_key(options=options)
-            stack_info = {'uuid' : args[0],
-                          'key' : private_key, 
-                          'action' : cmd}
-            return self._manage_stacks(stack_info)
+            if len(args) == 1 and not '=' in str(args[0]):
+                stack_info = {'uuid' : args[0],
+                              'key' : private_key, 
+                              'action' : cmd}
+                return self._manage_stacks(stack_info)
+            else:
+                # Several stacks and/or constraints (i.e., status=stopped). 
+                uuids = [a for a in args if not '=' in a]
+                constraints = dict(a.split('=', 1) for a in args if '=' in a)
+                return self._manage_many_stacks(uuids, constraints, private_key, cmd)
     
 def main(argv=None):
     # Set up the various logging facilities 
@@ -13,28 +13,56 @@
 # limitations under the License.
 #
 
+import logging
 import os
 import sys
 import sh
 from string import Template
 from ferry.install import FERRY_HOME
+from ferry.workers import WorkerPool
 from ferry.config.titan.titanconfig import *
 
+# Named performance profiles. Each value can also be set
+# directly in the storage "args" of the stack. 
+CASSANDRA_PROFILES = {
+    'default' : { 'concurrent_reads' : 32,
+                  'concurrent_writes' : 32,
+                  'compaction_throughput' : 16,
+                  'key_cache_ratio' : 0.05,
+                  'row_cache_ratio' : 0.0 },
+    'read' :    { 'concurrent_reads' : 64,
+                  'concurrent_writes' : 32,
+                  'compaction_throughput' : 16,
+                  'key_cache_ratio' : 0.1,
+                  'row_cache_ratio' : 0.1 },
+    'write' :   { 'concurrent_reads' : 32,
+                  'concurrent_writes' : 64,
+                  'compaction_throughput' : 64,
+                  'key_cache_ratio' : 0.05,
+                  'row_cache_ratio' : 0.0 }
+}
+
 class CassandraInitializer(object):
     """
     Create a new initializer
     Param user The user login for the git repo
     """
     def __init__(self, system):
+        self.system = system
         self.template_dir = None
         self.template_repo = None
 
         self.titan = TitanInitializer(system)
         self.titan.template_dir = FERRY_HOME + '/data/templates/titan'
+        self.workers = WorkerPool()
 
         self.container_data_dir = CassandraConfig.data_directory
         self.container_log_dir = CassandraConfig.log_directory
 
+        # The commit log is kept on its own host volume so that
+        # sequential commit writes don't compete with data reads. 
+        self.container_commit_dir = CassandraConfig.commit_directory
+
     """
     Generate a new hostname
     """
@@ -113,7 +141,62 @@ class CassandraInitializer(object):
     def _apply_titan(self, config, cass_entry, cass_containers):
         return self.titan.apply(config, cass_containers, cass_entry)
 
-    def _generate_yaml_config(self, container, seed, host_dir, config):
+    def _get_arg(self, args, key, default):
+        if args and key in args:
+            return args[key]
+        return default
+
+    def _apply_profile(self, config, args):
+        """
+        Fill in the performance settings from the named profile and
+        any values that the user has specified explicitly. 
+        """
+        profile_name = self._get_arg(args, 'profile', 'default')
+        if not profile_name in CASSANDRA_PROFILES:
+            logging.warning("unknown cassandra profile %s, using default" % str(profile_name))
+            profile_name = 'default'
+        profile = CASSANDRA_PROFILES[profile_name]
+
+        config.num_seeds = int(self._get_arg(args, 'seeds', config.num_seeds))
+        config.seed_placement = self._get_arg(args, 'seed_placement', config.seed_placement)
+        config.num_tokens = int(self._get_arg(args, 'num_tokens', config.num_tokens))
+        config.concurrent_reads = int(self._get_arg(args, 'concurrent_reads', profile['concurrent_reads']))
+        config.concurrent_writes = int(self._get_arg(args, 'concurrent_writes', profile['concurrent_writes']))
+        config.compaction_throughput = int(self._get_arg(args, 'compaction_throughput', profile['compaction_throughput']))
+
+        # Size the caches from the heap that Cassandra will choose
+        # for the container memory (same formula as cassandra-env.sh). 
+        mem = int(self._get_arg(args, 'memory', self.system.get_total_memory()))
+        heap = max(min(mem / 2, 1024), min(mem / 4, 8192))
+        config.key_cache_size = int(self._get_arg(args, 'key_cache_mb', int(heap * profile['key_cache_ratio'])))
+        config.row_cache_size = int(self._get_arg(args, 'row_cache_mb', int(heap * profile['row_cache_ratio'])))
+
+    def _select_seeds(self, config, cass_containers):
+        """
+        Pick the seed nodes. We don't need the entire list of containers, 
+        just a few. The seeds are either the first containers or spread
+        evenly across the list (which spreads them across hosts when there
+        are multiple containers per host). 
+        """
+        num_nodes = len(cass_containers)
+        num_seeds = max(1, min(config.num_seeds, num_nodes))
+        if config.seed_placement == 'spread':
+            indices = [i * num_nodes / num_seeds for i in range(num_seeds)]
+        else:
+            indices = range(num_seeds)
+        return [cass_containers[i] for i in indices]
+
+    def _initial_token(self, config, index, num_nodes):
+        """
+        When not using virtual nodes, give each node an evenly
+        spaced token on the Murmur3 ring so that data is balanced. 
+        """
+        if config.num_tokens > 1:
+            return '# initial_token:'
+        token = -(2 ** 63) + index * ((2 ** 64) / num_nodes)
+        return 'initial_token: %d' % token
+
+    def _generate_yaml_config(self, container, seed, initial_token, host_dir, config):
         yaml_in_file = open(self.template_dir + '/cassandra.yaml.template', 'r')
         yaml_out_file = open(host_dir + '/cassandra.yaml', 'w+')
 
@@ -121,7 +204,14 @@ class CassandraInitializer(object):
                     "DATA_DIR":config.data_directory,
                     "CACHE_DIR":config.cache_directory,
                     "COMMIT_DIR":config.commit_directory,
-                    "SEEDS":seed}
+                    "SEEDS":seed,
+                    "NUM_TOKENS":config.num_tokens,
+                    "INITIAL_TOKEN":initial_token,
+                    "CONCURRENT_READS":config.concurrent_reads,
+                    "CONCURRENT_WRITES":config.concurrent_writes,
+                    "COMPACTION_THROUGHPUT":config.compaction_throughput,
+                    "KEY_CACHE_SIZE":config.key_cache_size,
+                    "ROW_CACHE_SIZE":config.row_cache_size}
 
         for line in yaml_in_file:
             s = Template(line).substitute(changes)
@@ -143,6 +233,25 @@ class CassandraInitializer(object):
         log4j_out_file.close()
         log4j_in_file.close()
 
+    def _apply_container(self, config, seed, initial_token, container):
+        """
+        Generate the configuration directory for a single container. 
+        """
+        host_dir = "/tmp/" + self._generate_config_dir(config.uuid, container)
+        try:
+            sh.mkdir('-p', host_dir)
+        except:
+            sys.stderr.write('could not create config dir ' + host_dir)
+
+        self._generate_yaml_config(container, seed, initial_token, host_dir, config)
+        self._generate_log4j_config(host_dir, config)
+
+        # The config dirs specifies what to transfer over. We want to 
+        # transfer over specific files into a directory. 
+        return [container['container'], 
+                host_dir + '/*', 
+                config.config_directory]
+
     """
     Apply the configuration to the instances
     """
@@ -162,34 +271,24 @@ class CassandraInitializer(object):
         # as the "entry" node
         entry_point['seed'] = str(containers[0]['data_ip'])
 
-        # Generate list of the seed nodes. We don't need the entire
-        # list of containers, just a few. 
-        seed = ''
-        for i in range(0, len(cass_containers)):
-            if i < 6:
-                if i != 0:
-                    seed += ','
-                seed += cass_containers[i]['data_ip']
+        # Apply the performance profile and choose the seeds. 
+        args = None
+        if len(cass_containers) > 0 and 'args' in cass_containers[0]:
+            args = cass_containers[0]['args']
+        self._apply_profile(config, args)
+        seed = ','.join([c['data_ip'] for c in self._select_seeds(config, cass_containers)])
 
         # Create a new configuration directory, and place
-        # into the template directory. 
+        # into the template directory. Each container gets its
+        # own directory, so these can be generated independently. 
         config_dirs = []
         try:
-            for c in cass_containers:
-                host_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
-                try:
-                    sh.mkdir('-p', host_dir)
-                except:
-                    sys.stderr.write('could not create config dir ' + host_dir)
-
-                # The config dirs specifies what to transfer over. We want to 
-                # transfer over specific files into a directory. 
-                config_dirs.append([c['container'], 
-                                    host_dir + '/*', 
-                                    config.config_directory])
-
-                self._generate_yaml_config(c, seed, host_dir, config)
-                self._generate_log4j_config(host_dir, config)
+            num_nodes = len(cass_containers)
+            config_dirs = self.workers.map(lambda (i, c): self._apply_container(config, 
+                                                                                seed, 
+                                                                                self._initial_token(config, i, num_nodes),
+                                                                                c), 
+                                           enumerate(cass_containers))
         except IOError as err:
             sys.stderr.write('' + str(err))
 
@@ -224,3 +323,14 @@ class CassandraConfig(object):
         self.cache_directory = CassandraConfig.cache_directory
         self.log_directory = CassandraConfig.log_directory
         self.config_directory = CassandraConfig.config_directory
+
+        # Performance settings. These are filled in from
+        # the profile when the configuration is applied. 
+        self.num_seeds = 6
+        self.seed_placement = 'first'
+        self.num_tokens = 256
+        self.concurrent_reads = 32
+        self.concurrent_writes = 32
+        self.compaction_throughput = 16
+        self.key_cache_size = ''
+        self.row_cache_size = 0
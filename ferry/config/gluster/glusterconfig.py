@@ -121,6 +121,102 @@ class GlusterInitializer(object):
     def generate(self, num):
         return GlusterConfig(num)
 
+    def _get_arg(self, args, key, default):
+        if args and key in args:
+            return args[key]
+        return default
+
+    def _largest_divisor(self, num, limit):
+        """
+        Largest divisor of num that is not larger than the limit. 
+        """
+        for d in range(max(1, min(num, limit)), 0, -1):
+            if num % d == 0:
+                return d
+        return 1
+
+    def _plan_layout(self, config, num_bricks, args):
+        """
+        Choose the volume layout (distribute, replicate, stripe) and
+        the performance translator settings. Gluster requires the number
+        of bricks to be a multiple of the replica and stripe counts. 
+        """
+        layout = self._get_arg(args, 'layout', 'auto')
+        # Without a hint, assume large files (the common case for MPI). 
+        file_size = int(self._get_arg(args, 'file_size', GlusterConfig.LARGE_FILE_SIZE))
+        replicas = int(self._get_arg(args, 'replicas', 1))
+        if layout == 'replicate' and replicas < 2:
+            replicas = num_bricks
+
+        config.replica_count = self._largest_divisor(num_bricks, replicas)
+        if config.replica_count != replicas:
+            logging.warning("gluster using %d replicas instead of %d for %d bricks" % 
+                            (config.replica_count, replicas, num_bricks))
+
+        # Striping only helps when individual files are very large and
+        # are read by few clients (i.e., MPI-IO). Otherwise distributing
+        # whole files across the bricks gives better aggregate throughput. 
+        sets = num_bricks / config.replica_count
+        stripes = 1
+        if layout == 'stripe':
+            stripes = int(self._get_arg(args, 'stripes', sets))
+        elif layout == 'auto' and file_size >= GlusterConfig.STRIPE_FILE_SIZE:
+            stripes = int(self._get_arg(args, 'stripes', min(sets, 4)))
+        config.stripe_count = self._largest_divisor(sets, stripes)
+        config.stripe_size = self._get_arg(args, 'stripe_size', config.stripe_size)
+
+        modes = []
+        if config.stripe_count > 1:
+            modes.append('stripe')
+        if config.replica_count > 1:
+            modes.append('replicate')
+        if sets / config.stripe_count > 1 or len(modes) == 0:
+            modes.append('distribute')
+        config.mode = ','.join(modes)
+
+        # Large sequential files benefit from more read-ahead and a larger
+        # write-behind window. Small files benefit from a larger cache. 
+        if file_size >= GlusterConfig.LARGE_FILE_SIZE:
+            defaults = { 'cache_size' : '256MB',
+                         'write_behind_window' : '4MB',
+                         'read_ahead_pages' : 16,
+                         'io_threads' : 32 }
+        else:
+            defaults = { 'cache_size' : '512MB',
+                         'write_behind_window' : '1MB',
+                         'read_ahead_pages' : 4,
+                         'io_threads' : 16 }
+
+        config.options = [('nfs.disable', 'on'),
+                          ('performance.cache-size', self._get_arg(args, 'cache_size', defaults['cache_size'])),
+                          ('performance.write-behind-window-size', self._get_arg(args, 'write_behind_window', defaults['write_behind_window'])),
+                          ('performance.read-ahead-page-count', self._get_arg(args, 'read_ahead_pages', defaults['read_ahead_pages'])),
+                          ('performance.io-thread-count', self._get_arg(args, 'io_threads', defaults['io_threads']))]
+        if config.stripe_count > 1:
+            config.options.append(('cluster.stripe-block-size', config.stripe_size))
+
+    def _order_bricks(self, containers):
+        """
+        Order the bricks by taking one container from each host in turn.
+        Gluster groups consecutive bricks into replica/stripe sets, so this
+        places the members of a set on different hosts whenever possible. 
+        """
+        hosts = []
+        by_host = {}
+        for c in containers:
+            host = c['container'].manage_ip
+            if not host in by_host:
+                by_host[host] = []
+                hosts.append(host)
+            by_host[host].append(c)
+
+        bricks = []
+        while len(bricks) < len(containers):
+            for host in hosts:
+                if len(by_host[host]) > 0:
+                    bricks.append(by_host[host].pop(0))
+        return bricks
+
     """
     Apply the configuration to the instances
     """
@@ -154,22 +250,41 @@ class GlusterInitializer(object):
             in_file = open(self.template_dir + '/configure.template', 'r')
             out_file = open(new_config_dir + '/configure', 'w+')
 
+            # Figure out the volume layout and order the bricks so that
+            # each replica/stripe set is spread across different hosts. 
+            args = None
+            if 'args' in containers[0]:
+                args = containers[0]['args']
+            self._plan_layout(config, len(containers), args)
+            bricks = self._order_bricks(containers)
+
             probe = ""
             volume_id = "gluster-volume-" + str(config.uuid)
             volumes = "gluster volume create " + str(volume_id) + " "
+            if config.stripe_count > 1:
+                volumes += "stripe %d " % config.stripe_count
+            if config.replica_count > 1:
+                volumes += "replica %d " % config.replica_count
             for server in containers:
                 # The head node should not list itself in the peer probe.
                 if server != config.head_node:
                     probe += "gluster peer probe " + str(server['data_ip']) + "\n"
-
+            for server in bricks:
                 # All vumes get listed including the head node. 
                 volumes += str(server['data_ip']) + ":/" + config.data_directory + " "
 
+            # Set the performance translator options. 
+            options = ""
+            for key, value in config.options:
+                options += "gluster volume set %s %s %s >> /tmp/gluster_deploy.log 2>> /tmp/gluster_deploy.err\n" % (volume_id, key, value)
+
             # Now make the changes to the template file. 
             entry_point['volume'] = volume_id
+            entry_point['layout'] = config.mode
             changes = { "BRICK_DIR":config.data_directory, 
                         "PEER_PROBE":probe,
                         "VOLUME_LIST":volumes,
+                        "VOLUME_OPTIONS":options,
                         "VOLUME_ID":volume_id }
             for line in in_file:
                 s = Template(line).substitute(changes)
@@ -214,13 +329,20 @@ class GlusterConfig(object):
     BRICK_PORT = 24009
     MANAGEMENT_PORT = 24007
 
+    # Expected file sizes (in MB) used to plan the layout. Files
+    # are assumed to be large unless the stack says otherwise. 
+    LARGE_FILE_SIZE = 64
+    STRIPE_FILE_SIZE = 1024
+
     def __init__(self, num):
         self.num = num
         self.data_directory = GlusterConfig.data_directory
         self.log_directory = GlusterConfig.log_directory
         self.config_directory = GlusterConfig.config_directory
-        self.mode = 'stripe,replicate' # Use both striping and replication
-        self.stripe_count = 2 * num
-        self.stripe_size = '128kb'
+        self.mode = 'distribute'
+        self.replica_count = 1
+        self.stripe_count = 1
+        self.stripe_size = '128KB'
+        self.options = []
         self.head_node = None
         self.uuid = None
@@ -20,6 +20,7 @@ import time
 import sh
 from string import Template
 from ferry.install import FERRY_HOME
+from ferry.workers import WorkerPool
 from ferry.config.hadoop.hiveconfig import *
 from ferry.config.hadoop.metastore  import *
 
@@ -41,6 +42,7 @@ class HadoopInitializer(object):
         self.hive_ms = MetaStoreInitializer(system)
         self.hive_client.template_dir = FERRY_HOME + '/data/templates/hive-metastore/'
         self.hive_ms.template_dir = FERRY_HOME + '/data/templates/hive-metastore/'
+        self.workers = WorkerPool()
 
     def new_host_name(self, instance_id):
         """
@@ -371,44 +373,50 @@ class HadoopInitializer(object):
         entry_point['hdfs'] = str(hdfs_master['data_ip'])
         entry_point['instances'] = []
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
-        config_dirs = []
+        # Only add each container to the instances list once. 
         for c in containers:
-            new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
-            try:
-                sh.mkdir('-p', new_config_dir)
-            except:
-                sys.stderr.write('could not create config dir ' + new_config_dir)
-
-            # Only add the container to the instances list once. 
             entry_point['instances'].append([c['data_ip'], c['host_name']])
 
-            # Generate some mapred-site config
-            self._generate_mapred_site(yarn_master, config, containers, new_config_dir)
-            self._generate_mapred_env(new_config_dir)
+        # Create a new configuration directory, and place
+        # into the template directory. The directories are
+        # independent, so generate them in parallel. 
+        config_dirs = self.workers.map(lambda c: self._apply_hadoop_container(config, yarn_master, hdfs_master, containers, c),
+                                       containers)
+        return config_dirs, entry_point
+
+    def _apply_hadoop_container(self, config, yarn_master, hdfs_master, containers, c):
+        """
+        Generate the Hadoop configuration directory for a single container. 
+        """
+        new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
+        try:
+            sh.mkdir('-p', new_config_dir)
+        except:
+            sys.stderr.write('could not create config dir ' + new_config_dir)
 
-            # Now generate the yarn config files
-            self._generate_yarn_site(yarn_master, new_config_dir)
-            self._generate_yarn_env(yarn_master, new_config_dir)
+        # Generate some mapred-site config
+        self._generate_mapred_site(yarn_master, config, containers, new_config_dir)
+        self._generate_mapred_env(new_config_dir)
 
-            # Now generate the core config
-            self._generate_core_site(hdfs_master, new_config_dir)
+        # Now generate the yarn config files
+        self._generate_yarn_site(yarn_master, new_config_dir)
+        self._generate_yarn_env(yarn_master, new_config_dir)
 
-            # Now generate the HDFS config
-            self._generate_hdfs_site(config, hdfs_master, new_config_dir)
+        # Now generate the core config
+        self._generate_core_site(hdfs_master, new_config_dir)
 
-            # Now generate the HDFS config
-            self._generate_httpfs_site(config, new_config_dir)
+        # Now generate the HDFS config
+        self._generate_hdfs_site(config, hdfs_master, new_config_dir)
 
-            # Generate the log4j config
-            self._generate_log4j(new_config_dir)
+        # Now generate the HDFS config
+        self._generate_httpfs_site(config, new_config_dir)
 
-            config_dirs.append([c['container'], 
-                                new_config_dir + '/*',
-                                config.config_directory])
+        # Generate the log4j config
+        self._generate_log4j(new_config_dir)
 
-        return config_dirs, entry_point
+        return [c['container'], 
+                new_config_dir + '/*',
+                config.config_directory]
 
     def _find_hadoop_storage(self, containers):
         """
@@ -431,43 +439,52 @@ class HadoopInitializer(object):
         entry_point['yarn'] = str(yarn_master['data_ip'])
         entry_point['instances'] = []
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
-        config_dirs = []
-        for c in containers:            
-            new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
-            try:
-                sh.mkdir('-p', new_config_dir)
-            except:
-                sys.stderr.write('could not create config dir ' + new_config_dir)
-
-            # Slaves file used to figure out who hosts the actual work/data
+        # Slaves file used to figure out who hosts the actual work/data
+        for c in containers:
             for server in containers:
                 entry_point['instances'].append([server['data_ip'], server['host_name']])
 
-            # Generate the log4j config
-            self._generate_log4j(new_config_dir)
+        # Now we need to configure additional storage parameters. For example,
+        # for Gluster, etc. 
+        storage_entry = self._find_hadoop_storage(containers)
+        entry_point['hdfs_type'] = storage_entry['type']
 
-            # Generate some mapred-site config
-            self._generate_mapred_site(yarn_master, config, containers, new_config_dir, c)
-            self._generate_mapred_env(new_config_dir)
+        # Create a new configuration directory, and place
+        # into the template directory. The directories are
+        # independent, so generate them in parallel. 
+        config_dirs = self.workers.map(lambda c: self._apply_yarn_container(config, yarn_master, storage_entry, containers, c),
+                                       containers)
+        if storage_entry['type'] == 'gluster':
+            entry_point['gluster_url'] = self._gluster_url(storage_entry)
+        return config_dirs, entry_point
 
-            # Now generate the yarn config files
-            self._generate_yarn_site(yarn_master, new_config_dir, c)
-            self._generate_yarn_env(yarn_master, new_config_dir)
+    def _apply_yarn_container(self, config, yarn_master, storage_entry, containers, c):
+        """
+        Generate the YARN configuration directory for a single container. 
+        """
+        new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
+        try:
+            sh.mkdir('-p', new_config_dir)
+        except:
+            sys.stderr.write('could not create config dir ' + new_config_dir)
 
-            # Now we need to configure additional storage parameters. For example,
-            # for Gluster, etc. 
-            storage_entry = self._find_hadoop_storage(containers)
-            entry_point['hdfs_type'] = storage_entry['type']
-            if storage_entry['type'] == 'gluster':
-                url = self._apply_gluster(config, storage_entry, new_config_dir, c)
-                entry_point['gluster_url'] = url
+        # Generate the log4j config
+        self._generate_log4j(new_config_dir)
 
-            config_dirs.append([c['container'], 
-                                new_config_dir + '/*',
-                                config.config_directory])
-        return config_dirs, entry_point
+        # Generate some mapred-site config
+        self._generate_mapred_site(yarn_master, config, containers, new_config_dir, c)
+        self._generate_mapred_env(new_config_dir)
+
+        # Now generate the yarn config files
+        self._generate_yarn_site(yarn_master, new_config_dir, c)
+        self._generate_yarn_env(yarn_master, new_config_dir)
+
+        if storage_entry['type'] == 'gluster':
+            self._apply_gluster(config, storage_entry, new_config_dir, c)
+
+        return [c['container'], 
+                new_config_dir + '/*',
+                config.config_directory]
 
     def _apply_hive(self, config, hadoop_entry, hadoop_dirs, hadoop_containers, hive_containers):
         # First configure the metastore service
@@ -490,10 +507,13 @@ class HadoopInitializer(object):
         # We assume that the new configuration directory has already 
         # been created. In the future, may want to check for this. 
         self._generate_gluster_core_site(new_config_dir, container)
+        return self._gluster_url(storage_entry)
 
-        # The mount URL specifies how to connect to Gluster. 
-        mount_url = "%s:/%s" % (storage_entry['gluster'], storage_entry['volume'])
-        return mount_url
+    def _gluster_url(self, storage_entry):
+        """
+        The mount URL specifies how to connect to Gluster. 
+        """
+        return "%s:/%s" % (storage_entry['gluster'], storage_entry['volume'])
 
     def apply(self, config, containers):
         """
@@ -0,0 +1,195 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import logging
+import os
+import stat
+import threading2
+import yaml
+
+# Use the C YAML parser if PyYAML was built with libyaml.
+YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+
+def load_app(file_path):
+    """
+    Read an application description (JSON or YAML). Returns
+    None if the file is not an application.
+    """
+    ext = os.path.splitext(file_path)[1]
+    with open(file_path, 'r') as f:
+        if ext == '.json':
+            return json.load(f)
+        elif ext == '.yaml' or ext == '.yml':
+            return yaml.load(f, Loader=YAML_LOADER)
+    return None
+
+def _app_entry(name, file_path, content):
+    """
+    Summarize the application for the clients.
+    """
+    if content and 'metadata' in content:
+        entry = { 'name' : name,
+                  'file' : file_path,
+                  'tags' : content['metadata']['tags'],
+                  'author' : content['metadata']['author'],
+                  'version': content['metadata']['version'],
+                  'url': content['metadata']['url'],
+                  'short' : content['metadata']['description'][:21] + "...",
+                  'description': content['metadata']['description'],
+                  'plan' : { 'params' : content['params'],
+                             'backend' : content['backend'],
+                             'connectors' : content['connectors'] }}
+
+        # Check if this application template has any
+        # user questions.
+        if 'questions' in content:
+            entry['questions'] = content['questions']
+        else:
+            entry['questions'] = []
+
+        # See if the application author has provided an icon name.
+        # This is completely optional.
+        if 'icon' in content['metadata']:
+            entry['icon'] = content['metadata']['icon']
+        else:
+            entry['icon'] = ""
+        return entry
+    else:
+        return { 'name' : name,
+                 'file' : '',
+                 'tags' : [],
+                 'author' : "Unknown",
+                 'version': "Unknown",
+                 'url': "",
+                 'short' : "",
+                 'icon': "",
+                 'description': "",
+                 'questions': [],
+                 'plan' : {} }
+
+class AppCatalog(object):
+    """
+    Index of the installed applications. Applications are named after
+    their path (i.e., "hadoop" or "user/myapp") and are only parsed the
+    first time they are needed. Each lookup checks the modification
+    times of the directories and files, so new or changed applications
+    are picked up without re-reading everything else. If an application
+    is in more than one directory, the first directory wins when looking
+    up its file, and the last one wins when listing the applications.
+    """
+    def __init__(self, directories):
+        self.directories = list(directories)
+        self.lock = threading2.Lock()
+        self.dirs = {}
+        self.files = {}
+
+    def _scan(self, directory, prefix, apps, dirs):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        dirs.add(directory)
+
+        # Only list the directory again if something was added or removed.
+        cached = self.dirs.get(directory)
+        if cached and cached[0] == mtime:
+            items = cached[1]
+        else:
+            items = sorted(os.listdir(directory))
+            self.dirs[directory] = (mtime, items)
+
+        for item in items:
+            file_path = os.path.join(directory, item)
+            try:
+                s = os.stat(file_path)
+            except OSError:
+                continue
+
+            if stat.S_ISDIR(s.st_mode):
+                self._scan(file_path, prefix + item + '/', apps, dirs)
+                continue
+
+            record = self.files.get(file_path)
+            if not record or record['mtime'] != s.st_mtime or record['size'] != s.st_size:
+                record = { 'name' : prefix + os.path.splitext(item)[0],
+                           'path' : file_path,
+                           'mtime' : s.st_mtime,
+                           'size' : s.st_size,
+                           'entry' : None }
+                self.files[file_path] = record
+            apps.append(record)
+
+    def _refresh(self):
+        """
+        Bring the index up to date. Returns the applications
+        in the order of the directories.
+        """
+        apps = []
+        dirs = set()
+        for d in self.directories:
+            self._scan(d, '', apps, dirs)
+
+        # Forget about deleted applications and directories.
+        current = set(r['path'] for r in apps)
+        for file_path in list(self.files.keys()):
+            if not file_path in current:
+                del self.files[file_path]
+        for d in list(self.dirs.keys()):
+            if not d in dirs:
+                del self.dirs[d]
+        return apps
+
+    def _entry(self, record):
+        if record['entry'] is None:
+            content = None
+            try:
+                content = load_app(record['path'])
+            except Exception as e:
+                logging.warning("could not read application %s (%s)" % (record['path'], str(e)))
+            record['entry'] = _app_entry(record['name'], record['path'], content)
+        return record['entry']
+
+    def path(self, name):
+        """
+        Path of the application file, or None if it's not installed.
+        """
+        with self.lock:
+            for record in self._refresh():
+                if record['name'] == name:
+                    return record['path']
+        return None
+
+    def names(self):
+        with self.lock:
+            return set(r['name'] for r in self._refresh())
+
+    def query(self, name=None, tag=None, author=None):
+        """
+        Summaries of the applications, optionally filtered by
+        name, tag, or author.
+        """
+        apps = {}
+        with self.lock:
+            for record in self._refresh():
+                if name and record['name'] != name:
+                    continue
+                entry = self._entry(record)
+                if tag and not tag in entry['tags']:
+                    continue
+                if author and entry['author'] != author:
+                    continue
+                apps[record['name']] = entry
+        return apps
@@ -18,6 +18,8 @@ import logging
 from pymongo import MongoClient
 from ferry.install import FERRY_HOME, DEFAULT_TEMPLATE_DIR
 from ferry.docker.docker import DockerInstance
+from ferry.workers import WorkerPool
+from ferry import tracing
 from ferry.config.gluster.glusterconfig     import *
 from ferry.config.hadoop.hadoopconfig       import *
 from ferry.config.hadoop.hadoopclientconfig import *
@@ -49,6 +51,7 @@ class ConfigFactory(object):
         self.mpi_client = OpenMPIClientInitializer(self.system)
         self.hadoop_client = HadoopClientInitializer(self.system)
         self.spark_client = SparkClientInitializer(self.system)
+        self.workers = WorkerPool()
 
         # Get the Ferry home to find the templates.
         template_dir = DEFAULT_TEMPLATE_DIR
@@ -75,6 +78,7 @@ class ConfigFactory(object):
         config.uuid = uuid
         return config_factory.apply(config, container_info)
 
+    @tracing.traced('generate_compute_configuration')
     def generate_compute_configuration(self, 
                                        uuid,
                                        containers,
@@ -102,6 +106,7 @@ class ConfigFactory(object):
                                             container_info, 
                                             service)
 
+    @tracing.traced('generate_storage_configuration')
     def generate_storage_configuration(self, 
                                        uuid,
                                        containers,
@@ -153,6 +158,29 @@ class ConfigFactory(object):
             container_info.append(s)
         return self._generate_configuration(uuid, container_info, service) 
 
+    @tracing.traced('generate_connector_configurations')
+    def generate_connector_configurations(self, 
+                                          uuid,
+                                          containers,
+                                          services, 
+                                          storage_info=None,
+                                          compute_info=None,
+                                          args=None):
+        """
+        Generate the connector configuration for multiple client services. 
+        Each service writes into its own directories, so the services are
+        generated in parallel. The services are ordered by name so that 
+        the results (and any merged entry points) are always the same. 
+        """
+        services = sorted(services, key=lambda s: type(s).__name__)
+        return self.workers.map(lambda s: self.generate_connector_configuration(uuid, 
+                                                                                containers, 
+                                                                                s,
+                                                                                storage_info,
+                                                                                compute_info,
+                                                                                args),
+                                services)
+
     def _generate_key_value(self,
                             json_data,
                             base_key):
@@ -176,6 +204,7 @@ class ConfigFactory(object):
                     env = dict(env.items() + values.items())
         return env
 
+    @tracing.traced('generate_env_vars')
     def generate_env_vars(self,
                           storage_info=None,
                           compute_info=None):
@@ -13,6 +13,7 @@
 # limitations under the License.
 #
 
+from ferry import metrics, tracing
 from ferry.fabric.com import robust_com
 import json
 import logging
@@ -128,7 +129,21 @@ class DockerCLI(object):
         """
         Execute the command on the server via ssh. 
         """
+        with tracing.span('docker', cmd=cmd[:120], server=server):
+            with metrics.DOCKER_SECONDS.time(command=self._command_name(cmd)):
+                return self._execute(cmd, server, user, read_output)
 
+    def _command_name(self, cmd):
+        """
+        Get the Docker sub-command (i.e., run, commit) for the metrics. 
+        """
+        if cmd.startswith(self.docker):
+            args = cmd[len(self.docker):].split()
+            if len(args) > 0:
+                return args[0]
+        return 'other'
+
+    def _execute(self, cmd, server, user, read_output):
         if not server:
             # The server is not supplied, so just execute
             # the command locally. 
@@ -250,14 +265,19 @@ class DockerCLI(object):
             logging.error(output.strip())
             return False
 
-    def _continuous_print(self, process, msg):
+    def _continuous_print(self, process, msg, progress=None):
+        # Docker prints the progress of each layer on its own line,
+        # so pass each line to the progress callback. 
         while True:
             try:
-                out = process.stdout.read(161)
+                out = process.stdout.readline()
                 if out == '':
                     break
-                else:
+                out = out.strip()
+                if out != '':
                     logging.warning(out)
+                    if progress:
+                        progress(out)
             except IOError as e:
                 logging.warning(e)
 
@@ -272,7 +292,7 @@ class DockerCLI(object):
             pass
         return True
 
-    def push(self, image, registry=None, server=None):
+    def push(self, image, registry=None, server=None, progress=None):
         """
         Push an image to a remote registry.
         """
@@ -287,16 +307,16 @@ class DockerCLI(object):
         push = self.docker + ' ' + self.push_cmd + ' ' + new_image
         logging.warning(push)
         child = self._execute_cmd(push, server, read_output=False)
-        return self._continuous_print(child, "uploading image...")
+        return self._continuous_print(child, "uploading image...", progress)
 
-    def pull(self, image, server=None):
+    def pull(self, image, server=None, progress=None):
         """
         Pull a remote image to the local registry. 
         """
         pull = self.docker + ' ' + self.pull_cmd + ' ' + image
         logging.warning(pull)
         child = self._execute_cmd(pull, server, read_output=False)
-        return self._continuous_print(child, "downloading image...")
+        return self._continuous_print(child, "downloading image...", progress)
 
     def commit(self, container, snapshot_name, server=None):
         """
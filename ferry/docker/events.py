@@ -0,0 +1,119 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import threading2
+import time
+
+class StackEvents(object):
+    """
+    Record the progress of each stack as a list of events (containers
+    allocated, configuration generated, services started, etc.) so that
+    clients can follow a stack as it is built instead of polling its status.
+    Only the events of the most recent stacks are kept in memory.
+    """
+    def __init__(self, max_stacks=64):
+        self.max_stacks = max_stacks
+        self.cond = threading2.Condition()
+        self.stacks = collections.OrderedDict()
+        self.listeners = {}
+
+    def start(self, uuid, phase='queued', **info):
+        """
+        Start a new list of events for the stack.
+        """
+        with self.cond:
+            self.stacks.pop(uuid, None)
+            self.stacks[uuid] = { 'start' : time.time(),
+                                  'last' : time.time(),
+                                  'finished' : False,
+                                  'events' : [] }
+            while len(self.stacks) > self.max_stacks:
+                self.stacks.popitem(last=False)
+        self.emit(uuid, phase, **info)
+
+    def emit(self, uuid, phase, **info):
+        """
+        Add an event to the stack. Each event records the time since
+        the stack started and the time since the previous event.
+        """
+        with self.cond:
+            stack = self.stacks.get(uuid)
+            if not stack:
+                return
+            now = time.time()
+            event = dict(info)
+            event['seq'] = len(stack['events']) + 1
+            event['phase'] = phase
+            event['ts'] = now
+            event['elapsed'] = round(now - stack['start'], 3)
+            event['duration'] = round(now - stack['last'], 3)
+            stack['last'] = now
+            stack['events'].append(event)
+            self.cond.notify_all()
+        self._notify(uuid)
+
+    def finish(self, uuid, phase, **info):
+        """
+        Add the last event (i.e., running or failed).
+        """
+        self.emit(uuid, phase, **info)
+        with self.cond:
+            if uuid in self.stacks:
+                self.stacks[uuid]['finished'] = True
+                self.cond.notify_all()
+        self._notify(uuid)
+
+    def listen(self, uuid, callback):
+        """
+        Call the function whenever the stack changes, so that 
+        clients can wait without holding a thread. The function is 
+        called on the thread that changed the stack.
+        """
+        with self.cond:
+            self.listeners.setdefault(uuid, set()).add(callback)
+
+    def unlisten(self, uuid, callback):
+        with self.cond:
+            callbacks = self.listeners.get(uuid)
+            if callbacks:
+                callbacks.discard(callback)
+                if len(callbacks) == 0:
+                    del self.listeners[uuid]
+
+    def _notify(self, uuid):
+        with self.cond:
+            callbacks = list(self.listeners.get(uuid, []))
+        for c in callbacks:
+            c(uuid)
+
+    def wait(self, uuid, after=0, timeout=0):
+        """
+        Return the events after the given sequence number, waiting
+        up to the timeout for new events to arrive. Also returns whether
+        the stack is finished (or unknown), so that clients know to stop.
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                stack = self.stacks.get(uuid)
+                if not stack:
+                    return [], True
+
+                events = stack['events'][after:]
+                remaining = deadline - time.time()
+                if len(events) > 0 or stack['finished'] or remaining <= 0:
+                    return events, stack['finished']
+                self.cond.wait(remaining)
@@ -0,0 +1,183 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import logging
+import Queue
+import re
+import threading2
+import time
+import uuid
+
+# Docker prints one line per layer, i.e., "511136ea3c5a: Download complete".
+LAYER_LINE = re.compile(r'^([0-9a-f]{12}): (.*)$')
+
+# Progress of a layer, i.e., "Downloading 12.3 MB/45.2 MB 10s".
+LAYER_SIZE = re.compile(r'([\d.]+) ?([kKMG]?B)/([\d.]+) ?([kKMG]?B)')
+
+# States of a layer that is completely transferred.
+LAYER_DONE = ['download complete',
+              'pull complete',
+              'already exists',
+              'image already pushed',
+              'image already exists',
+              'image successfully pushed',
+              'layer already exists',
+              'pushed']
+
+UNITS = { 'B' : 1,
+          'kB' : 1000,
+          'KB' : 1000,
+          'MB' : 1000 * 1000,
+          'GB' : 1000 * 1000 * 1000 }
+
+def _parse_size(value, unit):
+    return int(float(value) * UNITS.get(unit, 1))
+
+class ImageJobs(object):
+    """
+    Push and pull images on a few background threads so that clients
+    don't have to hold a request open for the whole transfer. Each job
+    records the progress reported by Docker (layers and bytes transferred).
+    Concurrent requests for the same image share a single job, and only
+    the most recent jobs are kept in memory.
+    """
+    def __init__(self, workers=4, max_jobs=128):
+        self.max_jobs = max_jobs
+        self.lock = threading2.Lock()
+        self.jobs = collections.OrderedDict()
+        self.active = {}
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(max(int(workers), 1)):
+            t = threading2.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, action, image, func, registry=None):
+        """
+        Queue a push or pull. The function is called with a progress
+        callback and should return True if the transfer succeeded. If the
+        same transfer is already queued or running, that job is returned.
+        """
+        key = (action, image, registry)
+        with self.lock:
+            if key in self.active:
+                return self._copy(self.jobs[self.active[key]])
+
+            job_id = str(uuid.uuid4())
+            job = { 'id' : job_id,
+                    'action' : action,
+                    'image' : image,
+                    'registry' : registry,
+                    'status' : 'queued',
+                    'queued' : time.time(),
+                    'started' : None,
+                    'finished' : None,
+                    'layers' : {},
+                    'message' : None,
+                    'error' : None }
+            self.jobs[job_id] = job
+            self.active[key] = job_id
+            self._trim()
+            reply = self._copy(job)
+
+        self.queue.put( (job_id, key, func) )
+        return reply
+
+    def get(self, job_id):
+        """
+        Current status of the job, or None if the job is unknown.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job:
+                return self._copy(job)
+        return None
+
+    def list(self):
+        with self.lock:
+            return [self._copy(j) for j in self.jobs.values()]
+
+    def _trim(self):
+        # Only forget jobs that have finished.
+        for job_id in list(self.jobs.keys()):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[job_id]['finished']:
+                del self.jobs[job_id]
+
+    def _copy(self, job):
+        """
+        Summarize the job for the clients.
+        """
+        reply = dict((k, v) for k, v in job.items() if k != 'layers')
+        layers = job['layers'].values()
+        reply['layers_total'] = len(layers)
+        reply['layers_done'] = len([l for l in layers if l['done']])
+        reply['bytes'] = sum(l['current'] for l in layers)
+        reply['bytes_total'] = sum(l['total'] for l in layers)
+        return reply
+
+    def _progress(self, job_id, line):
+        """
+        Update the job with a line of Docker output.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return
+            job['message'] = line
+
+            m = LAYER_LINE.match(line)
+            if not m:
+                return
+            layer_id, state = m.group(1), m.group(2)
+            layer = job['layers'].setdefault(layer_id, { 'done' : False,
+                                                         'current' : 0,
+                                                         'total' : 0 })
+            size = LAYER_SIZE.search(state)
+            if size:
+                layer['current'] = _parse_size(size.group(1), size.group(2))
+                layer['total'] = _parse_size(size.group(3), size.group(4))
+            elif state.strip().lower() in LAYER_DONE:
+                layer['done'] = True
+                layer['current'] = layer['total']
+
+    def _work(self):
+        while True:
+            job_id, key, func = self.queue.get()
+            with self.lock:
+                self.jobs[job_id]['status'] = 'running'
+                self.jobs[job_id]['started'] = time.time()
+
+            error = None
+            try:
+                success = func(lambda line: self._progress(job_id, line))
+            except Exception as e:
+                logging.exception("could not %s %s" % (key[0], key[1]))
+                success = False
+                error = str(e)
+
+            with self.lock:
+                job = self.jobs[job_id]
+                job['finished'] = time.time()
+                if success:
+                    job['status'] = 'done'
+                else:
+                    job['status'] = 'failed'
+                    job['error'] = error or job['message']
+                self.active.pop(key, None)
@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
 import datetime
+import fnmatch
 import grp
 import importlib
 import inspect
@@ -21,19 +23,100 @@ import logging
 import os
 import os.path
 import pwd
+import Queue
 import sh
 import shutil
 import stat
+import StringIO
 import sys
+import tarfile
 import time
 import uuid
 import yaml
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING
 from sets import Set
 from ferry.install import *
 from ferry.docker.resolve       import DefaultResolver
 from ferry.docker.docker        import DockerInstance
 from ferry.docker.configfactory import ConfigFactory
+from ferry.docker.catalog       import AppCatalog
+from ferry.docker.events        import StackEvents
+from ferry.docker.jobs          import ImageJobs
+from ferry.docker.trash         import Trash
+from ferry.workers              import BackgroundTask, WorkerPool
+from ferry                      import metrics, tracing
+
+# Number of compressed pieces of a log stream that are buffered
+# while waiting for the client to read them. 
+LOG_QUEUE_SIZE = 64
+
+class _TarStream(object):
+    """
+    File-like object that hands the output of a streaming tar from
+    the thread writing it to the thread sending it. Only a few pieces
+    are buffered, so the writer waits for the client to catch up. 
+    """
+    def __init__(self, max_chunks=LOG_QUEUE_SIZE):
+        self.queue = Queue.Queue(max_chunks)
+        self.closed = False
+        self.aborted = False
+
+    def _put(self, data):
+        # Stop waiting if the client went away. 
+        while not self.closed:
+            try:
+                self.queue.put(data, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def write(self, data):
+        # Stop the writer once, but ignore whatever the 
+        # tar writes while it's being cleaned up. 
+        if not self._put(data) and not self.aborted:
+            self.aborted = True
+            raise IOError("log stream closed")
+
+    def finish(self):
+        self._put(None)
+
+    def chunks(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            yield data
+
+class _LogFile(object):
+    """
+    Read a log for a tar. Logs may still be written or truncated, 
+    so exactly 'size' bytes are returned, padded with zeros if the
+    file is shorter or can no longer be read. This keeps the tar 
+    consistent with the size in the header. 
+    """
+    def __init__(self, f, path, size):
+        self.f = f
+        self.path = path
+        self.remaining = size
+        self.failed = False
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        data = ''
+        if not self.failed:
+            try:
+                data = self.f.read(size)
+            except IOError as e:
+                logging.warning("could not read log %s (%s)" % (self.path, str(e)))
+                self.failed = True
+        data += tarfile.NUL * (size - len(data))
+        self.remaining -= len(data)
+        return data
+
+# Fields of the stacks needed to answer queries. 
+STACK_QUERY_FIELDS = ['uuid', 'base', 'ts', 'snapshot_uuid', 'backends', 
+                      'connectors', 'status', 'updated']
 
 class DockerManager(object):
     SSH_PORT = '22'
@@ -43,6 +126,20 @@ class DockerManager(object):
         # AWS, Openstack, local, etc. 
         self.docker = self._get_system_backend()
 
+        # Old data directories are deleted in the background. 
+        self.trash = Trash(os.path.join(self.docker.get_data_dir(), 'trash'))
+        self.trash.recover()
+
+        # Progress of the stacks being built. 
+        self.events = StackEvents()
+
+        # Installed applications. 
+        self.catalog = AppCatalog([ferry.install.DEFAULT_BUILTIN_APPS,
+                                   ferry.install.DEFAULT_FERRY_APPS])
+
+        # Images being pushed and pulled. 
+        self.image_jobs = ImageJobs(DEFAULT_IMAGE_WORKERS)
+
         # Generate configuration.
         self.config = ConfigFactory(self.docker.system)
         self.resolver = DefaultResolver()
@@ -89,9 +186,9 @@ class DockerManager(object):
         """
         self.mongo = MongoClient(os.environ['MONGODB'], 27017, connectTimeoutMS=6000)
 
-        self.cluster_collection = self.mongo['state']['clusters']
-        self.service_collection = self.mongo['state']['services']
-        self.snapshot_collection = self.mongo['state']['snapshots']
+        self.cluster_collection = metrics.TimedCollection(self.mongo['state']['clusters'])
+        self.service_collection = metrics.TimedCollection(self.mongo['state']['services'])
+        self.snapshot_collection = metrics.TimedCollection(self.mongo['state']['snapshots'])
 
     def _clean_state_db(self):
         """
@@ -221,69 +318,178 @@ class DockerManager(object):
                 service_names.append(compute['type'])
         return client_services, service_names
 
-    def _copytree(src, dst):
+    def _copytree(self, src, dst):
         """
         Helper method to copy directories. shutil fails if the 
         destination already exists. 
         """
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
         for item in os.listdir(src):
             s = os.path.join(src, item)
             d = os.path.join(dst, item)
             if os.path.isdir(s):
-                shutil.copytree(s, d)
+                self._copytree(s, d)
             else:
                 shutil.copy2(s, d)
 
-    def _copy_instance_logs(self, instance, to_dir):
+    def _get_instance_log_dir(self, instance):
         service = self._get_service(instance.service_type)
-        log_dir = service.container_log_dir
+        if not service or not instance.volumes:
+            return None
 
         # We're performing a reverse lookup. 
         for d in instance.volumes.keys():
-            if instance.volumes[d] == log_dir:
-                self._copytree(d, to_dir)
-                return
+            if instance.volumes[d] == service.container_log_dir:
+                return d
+        return None
 
-    def copy_logs(self, stack_uuid, to_dir):
+    def _copy_instance_logs(self, instance, to_dir):
+        log_dir = self._get_instance_log_dir(instance)
+        if log_dir and os.path.isdir(log_dir):
+            self._copytree(log_dir, to_dir)
+
+    def _get_log_instances(self, stack_uuid, service_types=None):
+        """
+        Get the instances whose logs we want, along with
+        the directory to store their logs under. 
+        """
+        instances = []
         _, compute, storage = self._get_cluster_instances(stack_uuid)
-        storage_dir = to_dir + '/' + stack_uuid + '/storage'
-        compute_dir = to_dir + '/' + stack_uuid + '/compute'
+        for kind, services in [('compute', compute), ('storage', storage)]:
+            for s in services:
+                if service_types and not s['type'] in service_types:
+                    continue
+                for i in s['instances']:
+                    prefix = '%s/%s/%s/%s' % (stack_uuid, kind, s['uuid'], i.host_name)
+                    instances.append( (i, prefix) )
+        return instances
 
-        for c in compute:
-            for i in c['instances']:
-                self._copy_instance_logs(i, compute_dir)
-        for c in storage:
-            for i in c['instances']:
-                self._copy_instance_logs(i, storage_dir)
+    def copy_logs(self, stack_uuid, to_dir):
+        """
+        Copy the logs into a directory on the host. 
+        """
+        instances = self._get_log_instances(stack_uuid)
+        pool = WorkerPool()
+        pool.map(lambda i: self._copy_instance_logs(i[0], os.path.join(to_dir, i[1])), 
+                 instances)
+        return json.dumps({ 'status' : 'ok', 
+                            'text' : to_dir })
+
+    def stream_logs(self, stack_uuid, filters=None):
+        """
+        Stream the logs as a compressed tar. The filters select the
+        service types ('types'), files ('glob'), a time window on the
+        modification time ('since' and 'until'), and the last lines of
+        each file ('tail'). The log directories are scanned in parallel, 
+        and the tar is written by a background thread while it's sent, 
+        so that large logs are never held in memory. 
+        """
+        if not filters:
+            filters = {}
+        instances = self._get_log_instances(stack_uuid, filters.get('types'))
+        pool = WorkerPool()
+        collected = pool.imap(lambda i: self._collect_instance_logs(i[0], i[1], filters), 
+                              instances)
+
+        out = _TarStream()
+        BackgroundTask(self._write_logs, out, collected)
+        try:
+            for chunk in out.chunks():
+                yield chunk
+        finally:
+            out.closed = True
 
-    def _inspect_application(self, app, directory):
+    def _write_logs(self, out, collected):
         """
-        Read out the contents of an application
+        Write the collected logs into a compressed tar. 
         """
-        s = app.split('/')
-        if len(s) > 1:
-            name = s[1]
-        else:
-            name = s[0]
-
-        dir_path = os.path.dirname(os.path.join(directory, app))
-        if os.path.exists(dir_path):
-            for item in os.listdir(dir_path):
-                n, e = item.split('.')
-                if n == name:
-                    with open(os.path.join(dir_path, item), 'r') as f:
-                        return f.read()
+        try:
+            tar = tarfile.open(fileobj=out, mode='w|gz')
+            for files in collected:
+                for path, name, st, content in files:
+                    info = tarfile.TarInfo(name)
+                    info.mtime = st.st_mtime
+                    info.mode = st.st_mode & 0777
+                    if content is not None:
+                        info.size = len(content)
+                        tar.addfile(info, StringIO.StringIO(content))
+                        continue
+
+                    try:
+                        f = open(path, 'rb')
+                    except IOError as e:
+                        logging.warning("could not read log %s (%s)" % (path, str(e)))
+                        continue
+
+                    # Logs may still be written, so only 
+                    # send what was there when we looked. 
+                    with f:
+                        info.size = st.st_size
+                        tar.addfile(info, _LogFile(f, path, info.size))
+            tar.close()
+        except Exception:
+            if not out.closed:
+                logging.exception("could not stream logs")
+        finally:
+            out.finish()
+
+    def _collect_instance_logs(self, instance, prefix, filters):
+        log_dir = self._get_instance_log_dir(instance)
+        if not log_dir or not os.path.isdir(log_dir):
+            return []
+
+        pattern = filters.get('glob')
+        since = filters.get('since')
+        until = filters.get('until')
+        tail = filters.get('tail')
+        files = []
+        for root, dirs, names in os.walk(log_dir):
+            dirs.sort()
+            for n in sorted(names):
+                path = os.path.join(root, n)
+                rel = os.path.relpath(path, log_dir)
+                if pattern and not fnmatch.fnmatch(rel, pattern) and not fnmatch.fnmatch(n, pattern):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                if (since and st.st_mtime < since) or (until and st.st_mtime > until):
+                    continue
+
+                content = None
+                if tail:
+                    content = self._tail_file(path, tail)
+                files.append( (path, prefix + '/' + rel, st, content) )
+        return files
+
+    def _tail_file(self, path, num_lines, block_size=8192):
+        """
+        Read the last lines of a file without reading the whole file. 
+        """
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            data = ''
+            while end > 0 and data.count('\n') <= num_lines:
+                start = max(0, end - block_size)
+                f.seek(start)
+                data = f.read(end - start) + data
+                end = start
+        lines = data.splitlines(True)
+        return ''.join(lines[-num_lines:])
 
     def inspect_installed(self, app):
         """
         Inspect an installed application
         """
-        content = self._inspect_application(app, ferry.install.DEFAULT_BUILTIN_APPS)
-        if not content:
-            content = self._inspect_application(app, ferry.install.DEFAULT_FERRY_APPS)
-        
-        if content:
-            return content
+        file_path = self.catalog.path(app)
+        if file_path:
+            with open(file_path, 'r') as f:
+                return f.read()
         else:
             return ""
         
@@ -356,82 +562,11 @@ class DockerManager(object):
 
         return json_text
 
-    def _list_applications(self, directory):
-        apps = set()
-        content = os.listdir(directory)
-        for c in content:
-            if os.path.isdir(os.path.join(directory, c)):
-                user_apps = self._list_applications(os.path.join(directory, c))
-                for u in user_apps:
-                    apps.add(c + '/' + u)
-            else:
-                apps.add(c)
-        return apps
-
-    def _query_application(self, directory, app):
-        apps = {}
-        app_files = self._list_applications(directory)
-        for f in app_files:
-            file_path = directory + '/' + f
-            n, e = f.split(".")
-            content = None
-
-            # Check if there is a filter or not. 
-            if not app or app == n:
-                if e == 'json':
-                    json_string = self._read_file_arg(file_path)
-                    content = json.loads(json_string)
-                elif e == 'yaml' or e == 'yml':
-                    yaml_file = open(file_path, 'r')
-                    content = yaml.load(yaml_file)
-
-                if content and 'metadata' in content:
-                    apps[n] = { 'name' : n,
-                                'file' : file_path, 
-                                'tags' : content['metadata']['tags'],
-                                'author' : content['metadata']['author'],
-                                'version': content['metadata']['version'],
-                                'url': content['metadata']['url'],
-                                'short' : content['metadata']['description'][:21] + "...",
-                                'description': content['metadata']['description'],
-                                'plan' : { 'params' : content['params'],
-                                           'backend' : content['backend'],
-                                           'connectors' : content['connectors'] }}
-
-                    # Check if this application template has any
-                    # user questions. 
-                    if 'questions' in content:
-                        apps[n]['questions'] = content['questions']
-                    else:
-                        apps[n]['questions'] = []
-
-                    # See if the application author has provided an icon name.
-                    # This is completely optional. 
-                    if 'icon' in content['metadata']:
-                        apps[n]['icon'] = content['metadata']['icon']
-                    else:
-                        apps[n]['icon'] = ""
-                else:
-                    apps[n] = { 'name' : n,
-                                'file' : '', 
-                                'tags' : [], 
-                                'author' : "Unknown",
-                                'version': "Unknown",
-                                'url': "",
-                                'short' : "", 
-                                'icon': "",
-                                'description': "",
-                                'questions': [],
-                                'plan' : {} }
-        return apps
-    
-    def query_applications(self, app=None):
+    def query_applications(self, app=None, tag=None, author=None):
         """
         Get list of installed applications.
         """
-        builtin = self._query_application(ferry.install.DEFAULT_BUILTIN_APPS, app)
-        installed = self._query_application(ferry.install.DEFAULT_FERRY_APPS, app)
-        return json.dumps(dict(builtin.items() + installed.items()))
+        return json.dumps(self.catalog.query(app, tag, author))
 
     def query_images(self):
         """
@@ -458,22 +593,44 @@ class DockerManager(object):
                           indent=2,
                           separators=(',',':'))
     
-    def query_stacks(self, constraints=None):
-        """
-        Query the available stacks. 
-        """
-        json_reply = {}
-
-        if constraints:
-            values = self.cluster_collection.find(constraints)
-        else:
-            values = self.cluster_collection.find()
-
+    def query_stacks(self, constraints=None, fields=None, status=None, sort=None, limit=None, since=None):
+        """
+        Query the available stacks. The stacks can be filtered by status
+        and by the time they were last updated (so that clients only fetch
+        what changed), sorted by a field ("-" for descending), limited, and
+        trimmed down to the given fields. Sorted stacks include the value 
+        they were sorted by ('order'), so that clients can merge updates. 
+        """
+        query = dict(constraints or {})
+        if status:
+            query['status'] = { '$in' : list(status) }
+        if since is not None:
+            query['updated'] = { '$gt' : since }
+
+        # Don't read the output and traces of the stacks. 
+        values = self.cluster_collection.find(query, STACK_QUERY_FIELDS)
+        if sort:
+            if sort.startswith('-'):
+                values = values.sort(sort[1:], DESCENDING)
+            else:
+                values = values.sort(sort, ASCENDING)
+        if limit:
+            values = values.limit(limit)
+        values = list(values)
+
+        # Look up all the snapshots at once. 
+        snapshots = set()
+        snapshot_uuids = list(set(v['snapshot_uuid'] for v in values if 'snapshot_uuid' in v))
+        if len(snapshot_uuids) > 0:
+            for s in self.snapshot_collection.find( {'snapshot_uuid': {'$in' : snapshot_uuids}},
+                                                    {'snapshot_uuid':1} ):
+                snapshots.add(s['snapshot_uuid'])
+
+        json_reply = collections.OrderedDict()
         for v in values:
-            time = ''
-            s = self.snapshot_collection.find_one( {'snapshot_uuid':v['snapshot_uuid']} )
-            if s:
-                time = v['ts'].strftime("%m/%w/%Y (%I:%M %p)")
+            ts = ''
+            if v.get('snapshot_uuid') in snapshots:
+                ts = v['ts'].strftime("%m/%w/%Y (%I:%M %p)")
 
             backends = []
             if 'backends' in v:
@@ -483,14 +640,25 @@ class DockerManager(object):
             if 'connectors' in v:
                 connectors = v['connectors']
 
-            json_reply[v['uuid']] = { 'uuid' : v['uuid'],
-                                      'base' : v['base'], 
-                                      'ts' : time,
-                                      'backends' : backends,
-                                      'connectors': connectors,
-                                      'status' : v['status']}
+            stack = { 'uuid' : v['uuid'],
+                      'base' : v['base'], 
+                      'ts' : ts,
+                      'backends' : backends,
+                      'connectors': connectors,
+                      'status' : v['status'],
+                      'updated' : v.get('updated', 0) }
+            if sort:
+                order = v.get(sort.lstrip('-'))
+                if isinstance(order, datetime.datetime):
+                    order = time.mktime(order.timetuple()) + order.microsecond / 1e6
+                stack['order'] = order
+            if fields:
+                stack = dict((k, stack[k]) for k in stack.keys() if k in ['uuid', 'order'] or k in fields)
+            json_reply[v['uuid']] = stack
+
+        # Keep the order of the stacks if they were sorted. 
         return json.dumps(json_reply, 
-                          sort_keys=True,
+                          sort_keys=not sort,
                           indent=2,
                           separators=(',',':'))
 
@@ -556,8 +724,20 @@ class DockerManager(object):
         """
         Indicate whether the application is installed. 
         """
-        apps = self.query_applications()
-        return app in apps
+        return self.catalog.path(app) != None
+
+    def save_trace(self, uuid, trace):
+        """
+        Store the timings of the stack build with the stack. 
+        """
+        self.cluster_collection.update( {'uuid':uuid}, 
+                                        {'$set': { 'trace' : trace }} )
+
+    def get_trace(self, uuid):
+        cluster = self.cluster_collection.find_one( {'uuid':uuid}, {'trace':1} )
+        if cluster:
+            return cluster.get('trace')
+        return None
 
     def get_stack(self, uuid):
         """
@@ -590,11 +770,24 @@ class DockerManager(object):
         new_dir = scratch_dir + '/%s/log_%s' % (service_uuid, storage_type + '_' + str(storage_id))
         return self._create_dir(new_dir, replace=replace)
 
+    def _new_commit_dir(self, service_uuid, storage_type, storage_id, args=None):
+        """
+        Create a new commit log directory. The user can place these on
+        a different device than the data via the "commit_dir" argument. 
+        """
+        if args and 'commit_dir' in args:
+            scratch_dir = args['commit_dir']
+        else:
+            scratch_dir = self.docker.get_data_dir()
+
+        new_dir = scratch_dir + '/%s/commit_%s' % (service_uuid, storage_type + '_' + str(storage_id))
+        return self._create_dir(new_dir, replace=True)
+
     def _create_dir(self, new_dir, replace=False):
         # See if we need to delete an existing data dir.
         if os.path.exists(new_dir) and replace:
             logging.warning("deleting dir " + new_dir)
-            shutil.rmtree(new_dir)
+            self.trash.discard(new_dir)
 
         try:
             # Now create the new directory and assign
@@ -675,6 +868,12 @@ class DockerManager(object):
             new_data_dir = self._new_data_dir(service_uuid, t, i)
             dir_info[new_data_dir] = container_dir
 
+            # Some services (i.e., Cassandra) keep their commit
+            # logs on a separate volume from the data. 
+            if hasattr(service, 'container_commit_dir'):
+                new_commit_dir = self._new_commit_dir(service_uuid, t, i, args)
+                dir_info[new_commit_dir] = service.container_commit_dir
+
             container_info = {'image':instance_type,
                               'type':t, 
                               'volumes':dir_info,
@@ -783,6 +982,7 @@ class DockerManager(object):
         plan['localhost']['containers'].append(container_info)
         return plan
 
+    @tracing.traced('transfer_config')
     def _transfer_config(self, config_dirs):
         """
         Transfer the configuration to the containers. 
@@ -794,6 +994,7 @@ class DockerManager(object):
             self.docker.copy([container], from_dir, to_dir)
             logging.warning("transferred config %s -> %s" % (from_dir, to_dir))
 
+    @tracing.traced('transfer_ip')
     def _transfer_ip(self, private_key, ips):
         """
         Transfer the hostname/IP addresses to all the containers. 
@@ -821,14 +1022,120 @@ class DockerManager(object):
                             "echo export %s=%s >> /etc/profile" % (k, env_vars[k]))
         logging.warning("finished transfer env vars")
 
-    def _start_containers(self, cluster_uuid, service_uuid, plan, ctype):
+    def _start_containers(self, cluster_uuid, service_uuid, plan, ctype, reservation=None):
+        """
+        Start the containers on the specified environment. The containers
+        are recorded in the reservation so that they can be removed if
+        the rest of the stack fails. 
+        """
+        containers = self.docker.alloc(cluster_uuid = cluster_uuid,
+                                       service_uuid = service_uuid, 
+                                       container_info = plan['localhost']['containers'], 
+                                       ctype = ctype);
+        if reservation:
+            reservation['containers'] = containers
+        return containers
+
+    def _reserve(self, cluster_uuid, service_uuid, plan, ctype):
+        """
+        Ask the fabric to start provisioning the machines for this
+        plan in the background. The reservation is later handed to
+        one of the allocate methods. 
+        """
+        self.docker.provision(cluster_uuid = cluster_uuid,
+                              service_uuid = service_uuid, 
+                              container_info = plan['localhost']['containers'], 
+                              ctype = ctype)
+        return { 'uuid' : service_uuid,
+                 'plan' : plan,
+                 'ctype' : ctype,
+                 'claimed' : False }
+
+    def _claim_reservation(self, reservation):
+        reservation['claimed'] = True
+        return reservation['uuid'], reservation['plan']
+
+    def reserve_storage(self, cluster_uuid, storage_type, key_name, num_instances=1, layers=[], args=None, replace=False):
+        """
+        Reserve the machines for a storage cluster. 
+        """
+        service_uuid = self._new_service_uuid()
+        plan = self._prepare_storage_environment(service_uuid = service_uuid, 
+                                                 num_instances = num_instances, 
+                                                 storage_type = storage_type, 
+                                                 layers = layers, 
+                                                 key_name = key_name, 
+                                                 args = args, 
+                                                 replace = replace)
+        return self._reserve(cluster_uuid, service_uuid, plan, "storage")
+
+    def reserve_compute(self, cluster_uuid, compute_type, key_name, args, num_instances=1, layers=[]):
+        """
+        Reserve the machines for a compute cluster. 
+        """
+        service_uuid = self._new_service_uuid()
+        plan = self._prepare_compute_environment(service_uuid = service_uuid, 
+                                                 num_instances = num_instances, 
+                                                 compute_type = compute_type, 
+                                                 key_name = key_name,
+                                                 layers = layers, 
+                                                 args = args)
+        return self._reserve(cluster_uuid, service_uuid, plan, "compute")
+
+    def reserve_connector(self, cluster_uuid, connector_type, key_name, name=None, args=None, ports=None, image=None):
+        """
+        Reserve the machines for a connector. 
+        """
+        service_uuid = self._new_service_uuid()
+        plan = self._prepare_connector_environment(service_uuid = service_uuid, 
+                                                   connector_type = connector_type, 
+                                                   key_name = key_name, 
+                                                   instance_type = image,
+                                                   name = name,
+                                                   ports = ports, 
+                                                   args = args)
+        return self._reserve(cluster_uuid, service_uuid, plan, "connector")
+
+    def release_reservations(self, cluster_uuid, reservations, claimed=False):
+        """
+        Release any reservations that were never claimed (i.e., because
+        an earlier service in the stack failed to start). If the stack
+        could not be built at all, the claimed reservations can be
+        released too. 
+        """
+        for r in reservations:
+            if claimed or not r['claimed']:
+                logging.warning("releasing reservation for %s" % r['uuid'])
+                containers = self._reserved_containers(r)
+                self.docker.stop(cluster_uuid, r['uuid'], containers)
+                if len(containers) > 0:
+                    self._discard_containers(cluster_uuid, r, containers)
+
+    def _reserved_containers(self, reservation):
+        """
+        Containers already started for a claimed reservation. 
+        """
+        if not reservation['claimed']:
+            return []
+        if reservation.get('containers'):
+            return reservation['containers']
+
+        conf = self._get_service_configuration(reservation['uuid'], detailed=True)
+        if conf and 'containers' in conf:
+            return [DockerInstance(c) for c in conf['containers']]
+        return []
+
+    def _discard_containers(self, cluster_uuid, reservation, containers):
         """
-        Start the containers on the specified environment
+        Remove the containers of a service that was started for a stack
+        that failed, so that their IP addresses, ports, and data
+        directories are freed. 
         """
-        return self.docker.alloc(cluster_uuid = cluster_uuid,
-                                 service_uuid = service_uuid, 
-                                 container_info = plan['localhost']['containers'], 
-                                 ctype = ctype);
+        self.docker.remove(cluster_uuid, reservation['uuid'], containers)
+        if reservation['ctype'] == 'storage':
+            for c in containers:
+                for v in (c.volumes or {}).keys():
+                    self.trash.discard(v)
 
     def _restart_containers(self, cluster_uuid, service_uuid, containers):
         """
@@ -884,7 +1191,8 @@ class DockerManager(object):
                     'status': status,
                     'output' : output, 
                     'key' : key, 
-                    'ts':ts }
+                    'ts':ts,
+                    'updated' : time.time() }
 
         if new_stack:
             self.cluster_collection.insert( cluster )
@@ -896,6 +1204,8 @@ class DockerManager(object):
         """
         Helper method to update a cluster's status. 
         """
+        state = dict(state)
+        state['updated'] = time.time()
         self.cluster_collection.update( {'uuid' : cluster_uuid},
                                         {'$set' : state} )
 
@@ -972,26 +1282,76 @@ class DockerManager(object):
     def _purge_stack(self, cluster_uuid):
         volumes = []
         connectors, compute, storage = self._get_cluster_instances(cluster_uuid)
-        for c in connectors:
-            self.docker.remove(cluster_uuid, c['uuid'], c['instances'])
-        for c in compute:
-            self.docker.remove(cluster_uuid, c['uuid'], c['instances'])
         for s in storage:
             for i in s['instances']:
                 for v in i.volumes.keys():
                     volumes.append(v)
-            self.docker.remove(cluster_uuid, s['uuid'], s['instances'])
 
-        # Now remove the data directories. 
+        # Remove the containers of all the services at the same time. 
+        services = connectors + compute + storage
+        pool = WorkerPool()
+        pool.map(lambda s: self.docker.remove(cluster_uuid, s['uuid'], s['instances']), 
+                 services)
+
+        # Now move the data directories into the trash. They
+        # are actually deleted in the background. 
         for v in volumes:
-            shutil.rmtree(v)
+            self.trash.discard(v)
     
+    def _get_data_volumes(self, services):
+        """
+        The data directories of the services, without the logs. 
+        """
+        volumes = []
+        for s in services:
+            for i in s['instances']:
+                log_dir = self._get_instance_log_dir(i)
+                for host_dir, container_dir in (i.volumes or {}).items():
+                    if host_dir != log_dir:
+                        volumes.append( { 'service' : s['uuid'],
+                                          'source' : host_dir,
+                                          'volume' : container_dir } )
+        return volumes
+
+    def _remove_snapshot(self, snapshot_uuid):
+        """
+        Forget about the snapshot. The copies of the data 
+        directories are deleted in the background. 
+        """
+        snapshot = self.snapshot_collection.find_one( {'snapshot_uuid':snapshot_uuid} )
+        self.snapshot_collection.remove( {'snapshot_uuid':snapshot_uuid} )
+
+        # The copies are stored under <snapshot dir>/<service>/. 
+        snapshot_dirs = set()
+        for v in snapshot.get('snapshot_volumes') or []:
+            snapshot_dirs.add(os.path.dirname(os.path.dirname(v['snapshot'].rstrip('/'))))
+        for d in snapshot_dirs:
+            self.trash.discard(d)
+
     def _snapshot_stack(self, cluster_uuid):
         """
         Take a snapshot of an existing stack. 
         """
         cluster = self.cluster_collection.find_one( {'uuid':cluster_uuid} )
         if cluster:
+            snapshot_uuid = self._new_snapshot_uuid(cluster_uuid)
+
+            # If the stack already has a snapshot, the new snapshot
+            # only needs to store the changes since then. 
+            parent_uuid = None
+            if self.is_snapshot(cluster['snapshot_uuid']):
+                parent_uuid = cluster['snapshot_uuid']
+
+            # Copy the storage data directories while the connectors 
+            # are being committed (if the fabric can copy them). 
+            volume_task = None
+            if hasattr(self.docker, 'snapshot_volumes'):
+                _, _, storage = self._get_cluster_instances(cluster_uuid)
+                volume_task = BackgroundTask(self.docker.snapshot_volumes, 
+                                             self._get_data_volumes(storage), 
+                                             snapshot_uuid, 
+                                             parent_uuid)
+
             # We need to deserialize the docker containers from the cluster/service
             # description so that the snapshot code has access to certain pieces
             # of information (service type, etc.). 
@@ -1004,22 +1364,29 @@ class DockerManager(object):
             cs_snapshots = self.docker.snapshot(connectors, 
                                                 cluster_uuid, 
                                                 cluster['num_snapshots'])
+            volumes = []
+            if volume_task:
+                try:
+                    volumes = volume_task.wait()
+                except Exception as e:
+                    logging.error("could not snapshot data directories (%s)" % str(e))
 
             # Register the snapshot in the snapshot state. 
-            snapshot_uuid = self._new_snapshot_uuid(cluster_uuid)
             snapshot_ts = str(datetime.datetime.now())
             snapshot_state = { 'snapshot_ts' : snapshot_ts, 
                                'snapshot_uuid' : snapshot_uuid,
                                'snapshot_cs' : cs_snapshots,
+                               'snapshot_volumes' : volumes, 
+                               'parent_uuid' : parent_uuid, 
                                'cluster_uuid' : cluster_uuid}
             self.snapshot_collection.insert( snapshot_state )
 
             # Now update the cluster state. 
             cluster_state = { 'num_snapshots' : cluster['num_snapshots'] + 1,
                               'snapshot_uuid' : snapshot_uuid }
-            self.cluster_collection.update( {'uuid':cluster_uuid}, 
-                                             {"$set": cluster_state } )
+            self._update_stack(cluster_uuid, cluster_state)
 
+    @tracing.traced('start_service')
     def start_service(self, uuid, containers):
         """
         Start the service.
@@ -1030,6 +1397,7 @@ class DockerManager(object):
         else:
             return {}
 
+    @tracing.traced('allocate_compute')
     def allocate_compute(self,
                          cluster_uuid, 
                          compute_type, 
@@ -1037,34 +1405,41 @@ class DockerManager(object):
                          storage_uuid,
                          args, 
                          num_instances=1,
-                         layers=[]):
+                         layers=[],
+                         reservation=None):
         """
         Allocate a new compute cluster.
         """
-        # Allocate a UUID.
-        service_uuid = self._new_service_uuid()
         service = self._get_service(compute_type)
-
-        # Generate the data volumes. This basically defines which
-        # directories on the host get mounted in the container. 
-        plan = self._prepare_compute_environment(service_uuid = service_uuid, 
-                                                 num_instances = num_instances, 
-                                                 compute_type = compute_type, 
-                                                 key_name = key_name,
-                                                 layers = layers, 
-                                                 args = args)
+        if reservation:
+            # The machines were provisioned ahead of time. 
+            service_uuid, plan = self._claim_reservation(reservation)
+        else:
+            # Allocate a UUID.
+            service_uuid = self._new_service_uuid()
+
+            # Generate the data volumes. This basically defines which
+            # directories on the host get mounted in the container. 
+            plan = self._prepare_compute_environment(service_uuid = service_uuid, 
+                                                     num_instances = num_instances, 
+                                                     compute_type = compute_type, 
+                                                     key_name = key_name,
+                                                     layers = layers, 
+                                                     args = args)
 
         # Get the entry point for the storage layer. 
         storage_entry = self._get_service_configuration(storage_uuid)
 
         # Allocate all the containers. 
-        containers = self._start_containers(cluster_uuid, service_uuid, plan, ctype="compute")
+        containers = self._start_containers(cluster_uuid, service_uuid, plan, ctype="compute", reservation=reservation)
         if containers == None:
             # The containers could not be allocated for some
             # reason. Make sure the calling method knows this so
             # that it can return a failure message.
             return None, None
         elif len(containers) > 0:
+            self._emit_allocated(cluster_uuid, service_uuid, compute_type, containers)
+
             # The containers were instantiated successfully. 
             # Generate storage-specific configuration and transfer
             # it over to the new containers. 
@@ -1079,8 +1454,10 @@ class DockerManager(object):
                 # internal error, but try to catch it so that we can cancel the stack.
                 logging.error(str(e))
                 return None, None
+            self.events.emit(cluster_uuid, 'config_generated', service=service_uuid)
                 
             self._transfer_config(config_dirs)
+            self.events.emit(cluster_uuid, 'config_transferred', service=service_uuid)
         else:
             # The container allocator did not allocate any containers
             # but it did so without any errors (perhaps the user requested
@@ -1099,6 +1476,12 @@ class DockerManager(object):
         self._update_service_configuration(service_uuid, service)
         return service_uuid, containers
         
+    def _emit_allocated(self, cluster_uuid, service_uuid, service_type, containers):
+        self.events.emit(cluster_uuid, 'containers_allocated', 
+                         service=service_uuid, 
+                         type=service_type, 
+                         instances=len(containers))
+
     def _start_service(self,
                        uuid,
                        containers,
@@ -1171,6 +1554,7 @@ class DockerManager(object):
                    'status':'running'}
         self._update_service_configuration(service_uuid, service)
                         
+    @tracing.traced('allocate_storage')
     def allocate_storage(self, 
                          cluster_uuid, 
                          storage_type, 
@@ -1178,33 +1562,40 @@ class DockerManager(object):
                          num_instances=1,
                          layers=[], 
                          args=None,
-                         replace=False):
+                         replace=False,
+                         reservation=None):
         """
         Create a storage cluster and start a particular
         personality on that cluster. 
         """
-        # Allocate a UUID.
-        service_uuid = self._new_service_uuid()
         service = self._get_service(storage_type)
-
-        # Generate the data volumes. This basically defines which
-        # directories on the host get mounted in the container. 
-        plan = self._prepare_storage_environment(service_uuid = service_uuid, 
-                                                 num_instances = num_instances, 
-                                                 storage_type = storage_type, 
-                                                 layers = layers, 
-                                                 key_name = key_name, 
-                                                 args = args, 
-                                                 replace = replace)
+        if reservation:
+            # The machines were provisioned ahead of time. 
+            service_uuid, plan = self._claim_reservation(reservation)
+        else:
+            # Allocate a UUID.
+            service_uuid = self._new_service_uuid()
+
+            # Generate the data volumes. This basically defines which
+            # directories on the host get mounted in the container. 
+            plan = self._prepare_storage_environment(service_uuid = service_uuid, 
+                                                     num_instances = num_instances, 
+                                                     storage_type = storage_type, 
+                                                     layers = layers, 
+                                                     key_name = key_name, 
+                                                     args = args, 
+                                                     replace = replace)
 
         # Allocate all the containers. 
-        containers = self._start_containers(cluster_uuid, service_uuid, plan, ctype="storage")
+        containers = self._start_containers(cluster_uuid, service_uuid, plan, ctype="storage", reservation=reservation)
         if containers == None:
             # The containers could not be allocated for some
             # reason. Make sure the calling method knows this so
             # that it can return a failure message.
             return None, None
         elif len(containers) > 0:
+            self._emit_allocated(cluster_uuid, service_uuid, storage_type, containers)
+
             # The containers were instantiated successfully. 
             # Generate storage-specific configuration and transfer
             # it over to the new containers. 
@@ -1218,8 +1609,10 @@ class DockerManager(object):
                 # internal error, but try to catch it so that we can cancel the stack.
                 logging.error(str(e))
                 return None, None
+            self.events.emit(cluster_uuid, 'config_generated', service=service_uuid)
 
             self._transfer_config(config_dirs)
+            self.events.emit(cluster_uuid, 'config_transferred', service=service_uuid)
         else:
             # The container allocator did not allocate any containers
             # but it did so without any errors (perhaps the user requested
@@ -1261,8 +1654,12 @@ class DockerManager(object):
                 service_status = { 'uuid':stack_uuid, 'status':status }
                 self._update_stack(stack_uuid, service_status)
         elif(action == 'rm'):
-            # First need to check if the stack is stopped.
-            if self.is_stopped(stack_uuid):
+            # Snapshots can be removed at any time, but first 
+            # need to check if the stack is stopped.
+            if self.is_snapshot(stack_uuid):
+                self._remove_snapshot(stack_uuid)
+                status = 'removed'
+            elif self.is_stopped(stack_uuid):
                 self._purge_stack(stack_uuid)
                 status = 'removed'
                 service_status = { 'uuid':stack_uuid, 'status':status }
@@ -1276,6 +1673,34 @@ class DockerManager(object):
                  'status' : True,
                  'msg': status }
 
+    def manage_stacks(self, stack_uuids, private_key, action):
+        """
+        Manage several stacks at the same time. 
+        """
+        def _manage(stack_uuid):
+            try:
+                return self.manage_stack(stack_uuid, private_key, action)
+            except Exception as e:
+                logging.exception("could not %s %s" % (action, stack_uuid))
+                return { 'uuid' : stack_uuid,
+                         'status' : False,
+                         'msg' : str(e) }
+
+        # Managing a stack mostly waits on ssh and Docker, so
+        # don't limit the workers to the number of CPUs. 
+        pool = WorkerPool(DEFAULT_MANAGE_WORKERS)
+        return pool.map(_manage, stack_uuids)
+
+    def find_stacks(self, constraints):
+        """
+        UUIDs of the stacks that match the constraints. Removed
+        stacks are ignored unless a status is given. 
+        """
+        constraints = dict(constraints)
+        if not 'status' in constraints:
+            constraints['status'] = { '$ne' : 'removed' }
+        return [c['uuid'] for c in self.cluster_collection.find(constraints, {'uuid':1})]
+
     def fetch_stopped_backend(self, uuid):
         """
         Lookup the stopped backend info. 
@@ -1365,6 +1790,41 @@ class DockerManager(object):
         return connector_info, connector_plan
                 
 
+    def clone_snapshot_volumes(self, snapshot_uuid, storage_plan):
+        """
+        Fill the data directories of the new storage services
+        with the data captured by the snapshot. 
+        """
+        snapshot = self.snapshot_collection.find_one( {'snapshot_uuid':snapshot_uuid} )
+        if not snapshot or not snapshot.get('snapshot_volumes'):
+            logging.warning("snapshot %s has no data to clone" % snapshot_uuid)
+            return False
+
+        # The storage services are allocated in the same order as the
+        # original stack, and each data directory keeps the same name. 
+        services = []
+        snapshot_volumes = {}
+        for v in snapshot['snapshot_volumes']:
+            if not v['service'] in snapshot_volumes:
+                services.append(v['service'])
+                snapshot_volumes[v['service']] = {}
+            snapshot_volumes[v['service']][os.path.basename(v['source'].rstrip('/'))] = v['snapshot']
+
+        volumes = []
+        for service_uuid, s in zip(services, storage_plan):
+            for c in s['containers']:
+                for host_dir in (c.volumes or {}).keys():
+                    name = os.path.basename(host_dir.rstrip('/'))
+                    if name in snapshot_volumes[service_uuid]:
+                        volumes.append( { 'snapshot' : snapshot_volumes[service_uuid][name],
+                                          'clone' : host_dir } )
+        try:
+            self.docker.clone_volumes(volumes)
+        except Exception as e:
+            logging.error("could not clone snapshot %s (%s)" % (snapshot_uuid, str(e)))
+            return False
+        return True
+
     def _restart_connectors(self,
                             service_uuid, 
                             connectors, 
@@ -1388,20 +1848,20 @@ class DockerManager(object):
                                                  compute_entry)
         services, backend_names = self._get_client_services(storage_entry, compute_entry)
         entry_points = {}
-        for service in services:
-            try:
-                config_dirs, entry_point = self.config.generate_connector_configuration(service_uuid, 
-                                                                                        connectors, 
-                                                                                        service,
-                                                                                        storage_entry,
-                                                                                        compute_entry,
-                                                                                        connectors[0].args)
-            except Error as e:
-                # Could not generate the configuration. This is probably an 
-                # internal error, but try to catch it so that we can cancel the stack.
-                logging.error(str(e))
-                return None, None
-            
+        try:
+            configs = self.config.generate_connector_configurations(service_uuid, 
+                                                                    connectors, 
+                                                                    services,
+                                                                    storage_entry,
+                                                                    compute_entry,
+                                                                    connectors[0].args)
+        except Error as e:
+            # Could not generate the configuration. This is probably an 
+            # internal error, but try to catch it so that we can cancel the stack.
+            logging.error(str(e))
+            return None, None
+
+        for config_dirs, entry_point in configs:
             # Merge all the entry points. 
             entry_points = dict(entry_point.items() + entry_points.items())
 
@@ -1420,6 +1880,7 @@ class DockerManager(object):
         self._update_service_configuration(service_uuid, service)
         return output
 
+    @tracing.traced('allocate_connector')
     def allocate_connector(self,
                            cluster_uuid, 
                            connector_type, 
@@ -1428,7 +1889,8 @@ class DockerManager(object):
                            name=None, 
                            args=None,
                            ports=None, 
-                           image=None):
+                           image=None,
+                           reservation=None):
         """
         Allocate a new connector and associate with an existing storage service. 
         """
@@ -1448,48 +1910,56 @@ class DockerManager(object):
         env_vars = self.config.generate_env_vars(storage_entry,
                                                  compute_entry)
 
-        # Allocate a UUID.
-        service_uuid = self._new_service_uuid()
-        plan = self._prepare_connector_environment(service_uuid = service_uuid, 
-                                                   connector_type = connector_type, 
-                                                   key_name = key_name, 
-                                                   instance_type = image,
-                                                   name = name,
-                                                   ports = ports, 
-                                                   args = args)
-        containers = self._start_containers(cluster_uuid, service_uuid, plan, ctype="connector")
+        if reservation:
+            # The machines were provisioned ahead of time. 
+            service_uuid, plan = self._claim_reservation(reservation)
+        else:
+            # Allocate a UUID.
+            service_uuid = self._new_service_uuid()
+            plan = self._prepare_connector_environment(service_uuid = service_uuid, 
+                                                       connector_type = connector_type, 
+                                                       key_name = key_name, 
+                                                       instance_type = image,
+                                                       name = name,
+                                                       ports = ports, 
+                                                       args = args)
+        containers = self._start_containers(cluster_uuid, service_uuid, plan, ctype="connector", reservation=reservation)
         if containers == None:
             # The containers could not be allocated for some
             # reason. Make sure the calling method knows this so
             # that it can return a failure message.
             return None, None
         elif len(containers) > 0:            
+            self._emit_allocated(cluster_uuid, service_uuid, connector_type, containers)
+
             # The containers were instantiated successfully. 
             # Generate storage-specific configuration and transfer
             # it over to the new containers.         
             entry_points = {}
             backend_names = []
             services, backend_names = self._get_client_services(storage_entry, compute_entry)
-            for service in services:
-                try:
-                    config_dirs, entry_point = self.config.generate_connector_configuration(service_uuid, 
-                                                                                            containers, 
-                                                                                            service,
-                                                                                            storage_entry,
-                                                                                            compute_entry,
-                                                                                            args)
-                except Error as e:
-                    # Could not generate the configuration. This is probably an 
-                    # internal error, but try to catch it so that we can cancel the stack.
-                    logging.error(str(e))
-                    return None, None
-                    
+            try:
+                configs = self.config.generate_connector_configurations(service_uuid, 
+                                                                        containers, 
+                                                                        services,
+                                                                        storage_entry,
+                                                                        compute_entry,
+                                                                        args)
+            except Error as e:
+                # Could not generate the configuration. This is probably an 
+                # internal error, but try to catch it so that we can cancel the stack.
+                logging.error(str(e))
+                return None, None
+            self.events.emit(cluster_uuid, 'config_generated', service=service_uuid)
+
+            for config_dirs, entry_point in configs:
                 # Merge all the entry points. 
                 entry_points = dict(entry_point.items() + entry_points.items())
 
                 # Now copy over the configuration.
                 self._transfer_config(config_dirs)
                 self._transfer_env_vars(containers, env_vars)
+            self.events.emit(cluster_uuid, 'config_transferred', service=service_uuid)
         else:
             # The container allocator did not allocate any containers
             # but it did so without any errors (perhaps the user requested
@@ -1512,17 +1982,40 @@ class DockerManager(object):
         self._update_service_configuration(service_uuid, service_info)
         return service_uuid, containers
 
-    def push_image(self, image, registry=None):
+    def push_image(self, image, registry=None, progress=None):
         """
         Push a local image to a remote registry.         
         """
-        return self.docker.push(image, registry)
+        return self.docker.push(image, registry, progress=progress)
 
-    def pull_image(self, image):
+    def pull_image(self, image, progress=None):
         """
         Pull a remote image to the local registry. 
         """
-        return self.docker.pull(image)
+        return self.docker.pull(image, progress=progress)
+
+    def submit_push(self, image, registry=None):
+        """
+        Push the image in the background. Returns the job.
+        """
+        return self.image_jobs.submit('push', image, 
+                                      lambda progress: self.push_image(image, registry, progress),
+                                      registry)
+
+    def submit_pull(self, image):
+        """
+        Pull the image in the background. Returns the job.
+        """
+        return self.image_jobs.submit('pull', image, 
+                                      lambda progress: self.pull_image(image, progress))
+
+    def image_job(self, job_id=None):
+        """
+        Status of an image job, or all the recent jobs. 
+        """
+        if job_id:
+            return self.image_jobs.get(job_id)
+        return self.image_jobs.list()
 
     def login_registry(self):
         """
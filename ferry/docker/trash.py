@@ -0,0 +1,155 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import errno
+import logging
+import os
+import Queue
+import shutil
+import threading2
+import time
+import uuid
+from distutils import spawn
+from subprocess import Popen, PIPE
+
+class Trash(object):
+    """
+    Delete data directories in the background. Directories are first
+    renamed into the trash, which is quick, and then a single reaper
+    thread deletes them one at a time at a low I/O priority so that
+    large deletes don't slow down the running stacks. Directories on
+    other filesystems are trashed in place, and their paths are kept
+    in a manifest in the trash so that they can be recovered.
+    """
+    MANIFEST = '.elsewhere'
+
+    def __init__(self, trash_dir, delay=1.0):
+        self.trash_dir = trash_dir
+        self.delay = delay
+        self.queue = Queue.Queue()
+        self.reaper = None
+        self.lock = threading2.Lock()
+
+    def discard(self, path):
+        """
+        Move the directory into the trash and schedule it for deletion.
+        """
+        if not os.path.exists(path):
+            return
+
+        name = "%s-%s" % (os.path.basename(path.rstrip('/')), str(uuid.uuid4())[:8])
+        try:
+            if not os.path.isdir(self.trash_dir):
+                os.makedirs(self.trash_dir)
+            trashed = os.path.join(self.trash_dir, name)
+            os.rename(path, trashed)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+            # The directory is on a different filesystem (i.e., a
+            # custom commit directory), so leave it next to the original.
+            trashed = os.path.join(os.path.dirname(path.rstrip('/')), '.trash-' + name)
+            os.rename(path, trashed)
+            with self.lock:
+                with open(self._manifest(), 'a') as f:
+                    f.write(trashed + '\n')
+
+        logging.info("moved %s to the trash" % path)
+        self._schedule(trashed)
+
+    def recover(self):
+        """
+        Schedule anything left in the trash from a previous run.
+        """
+        if os.path.isdir(self.trash_dir):
+            for f in os.listdir(self.trash_dir):
+                if f != Trash.MANIFEST:
+                    self._schedule(os.path.join(self.trash_dir, f))
+
+        for path in self._read_manifest():
+            if os.path.exists(path):
+                self._schedule(path)
+            else:
+                self._forget(path)
+
+    def _manifest(self):
+        return os.path.join(self.trash_dir, Trash.MANIFEST)
+
+    def _read_manifest(self):
+        with self.lock:
+            if not os.path.exists(self._manifest()):
+                return []
+            with open(self._manifest(), 'r') as f:
+                return [l.strip() for l in f if l.strip() != '']
+
+    def _forget(self, path):
+        """
+        Remove a deleted directory from the manifest.
+        """
+        with self.lock:
+            if not os.path.exists(self._manifest()):
+                return
+            with open(self._manifest(), 'r') as f:
+                paths = [l.strip() for l in f if l.strip() != '']
+            if not path in paths:
+                return
+            paths = [p for p in paths if p != path]
+            if len(paths) > 0:
+                with open(self._manifest(), 'w') as f:
+                    f.write(''.join(p + '\n' for p in paths))
+            else:
+                os.remove(self._manifest())
+
+    def _schedule(self, path):
+        self.queue.put(path)
+        with self.lock:
+            if not self.reaper:
+                self.reaper = threading2.Thread(target=self._reap)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+    def _reap(self):
+        while True:
+            try:
+                path = self.queue.get(timeout=30)
+            except Queue.Empty:
+                # Only stop if nothing was scheduled in the meantime.
+                with self.lock:
+                    if self.queue.empty():
+                        self.reaper = None
+                        return
+                continue
+
+            start = time.time()
+            try:
+                self._delete(path)
+                self._forget(path)
+                logging.info("deleted %s (%.1fs)" % (path, time.time() - start))
+            except Exception as e:
+                logging.error("could not delete %s (%s)" % (path, str(e)))
+            time.sleep(self.delay)
+
+    def _delete(self, path):
+        # Use the idle I/O class if it's available, so that
+        # the delete only uses the disk when nothing else does.
+        if spawn.find_executable('ionice'):
+            child = Popen(['ionice', '-c', '3', 'nice', 'rm', '-rf', path],
+                          stdout=PIPE, stderr=PIPE)
+            _, err = child.communicate()
+            if child.returncode != 0:
+                raise OSError(err.strip())
+        else:
+            shutil.rmtree(path)
@@ -24,12 +24,15 @@ from boto.ec2.blockdevicemapping import BlockDeviceType, EBSBlockDeviceType, Blo
 import copy
 import ferry.install
 from ferry.config.system.aws import System
+from ferry.fabric.waiter import BatchPoller, Waiter, READY, FAILED
+from ferry.workers import BackgroundTask
 import json
 import logging
 import math
 import os
 from pymongo import MongoClient
 import sys
+import threading2
 import time
 import yaml
 
@@ -46,6 +49,13 @@ class AWSLauncher(object):
         self.controller = controller
         self.subnets = []
         self.stacks = {}
+        self.provisions = {}
+        self.network_lock = threading2.Lock()
+        self.stack_waiter = Waiter(BatchPoller(self._fetch_stack_status), "stacks")
+        self.instance_waiter = Waiter(BatchPoller(self._fetch_instance_status), "instances",
+                                      initial = 2.0,
+                                      maximum = 15.0)
+        self.stack_events = {}
         self.num_network_hosts = 1024
         self.num_subnet_hosts = 256
         self.vpc_cidr = None
@@ -96,6 +106,12 @@ class AWSLauncher(object):
         else:
             self.data_volume = "ebs:8"
 
+        # Number of servers to bootstrap concurrently. 
+        if 'bootstrap' in params:
+            self.bootstrap_workers = int(params['bootstrap'])
+        else:
+            self.bootstrap_workers = 8
+
         # This gives us information about the image to use
         # for the supplied provider. 
         deploy = conf[provider]['deploy']
@@ -617,7 +633,7 @@ class AWSLauncher(object):
                  "name" : igw_name }
         return plan, desc
 
-    def _create_instance_plan(self, cluster_uuid, subnet, num_instances, image, size, sec_group_name, ctype): 
+    def _create_instance_plan(self, cluster_uuid, service_uuid, subnet, num_instances, image, size, sec_group_name, ctype): 
         plan = { "AWSTemplateFormatVersion" : "2010-09-09",
                  "Description" : "Ferry generated Heat plan",
                  "Resources" : {},
@@ -626,7 +642,7 @@ class AWSLauncher(object):
 
         # Create all the instances. Each instance gets a unique name. 
         for i in range(0, num_instances):
-            instance_name = "FerryInstance%s%s%d" % (cluster_uuid.replace("-", ""), ctype, i)
+            instance_name = "FerryInstance%s%s%s%d" % (cluster_uuid.replace("-", ""), service_uuid.replace("-", ""), ctype, i)
             user_data = self._create_server_init()
             instance_plan, instance_desc = self._create_instance(name = instance_name, 
                                                                  subnet = subnet, 
@@ -676,26 +692,60 @@ class AWSLauncher(object):
 
         return stack_desc
 
+    def _fetch_stack_status(self, stack_ids):
+        """
+        Fetch the status of the pending stacks. Each stack is described
+        on its own, since listing all the stacks in the account is
+        paged (and boto doesn't follow the pages). 
+        """
+        statuses = {}
+        for stack_id in stack_ids:
+            try:
+                stacks = self.cf.describe_stacks(stack_id)
+            except Exception as e:
+                logging.warning("could not describe stack %s (%s)" % (stack_id, str(e)))
+                continue
+
+            for stack in stacks:
+                if stack.stack_status == "CREATE_COMPLETE":
+                    statuses[stack_id] = READY
+                elif stack.stack_status.endswith("FAILED") or "ROLLBACK" in stack.stack_status:
+                    statuses[stack_id] = FAILED
+                else:
+                    statuses[stack_id] = None
+        return statuses
+
+    def _log_stack_events(self, stack_ids):
+        """
+        Log any new stack events so that the user can see
+        how the stack creation is progressing. 
+        """
+        for stack_id in stack_ids:
+            seen = self.stack_events.setdefault(stack_id, set())
+            try:
+                events = self.cf.describe_stack_events(stack_id)
+            except BotoServerError as e:
+                logging.warning(str(e))
+                continue
+
+            # Events are returned newest first. 
+            for e in reversed(list(events)):
+                if not e.event_id in seen:
+                    seen.add(e.event_id)
+                    logging.warning("%s %s %s" % (e.logical_resource_id, 
+                                                  e.resource_status, 
+                                                  e.resource_status_reason or ""))
+
     def _wait_for_stack(self, stack_id):
         """
         Wait for stack completion.
         """
         logging.warning("waiting for cloudformation completion")
-        stacks = self.cf.describe_stacks(stack_id)
-        for stack in stacks:
-            while(True):
-                try:
-                    if stack.stack_status == "CREATE_COMPLETE":
-                        return True
-                    elif stack.stack_status == "CREATE_FAILED":
-                        logging.warning("cloudformation FAILED")
-                        return False
-                    else:
-                        stack.update()
-                        time.sleep(4)
-                except:
-                    logging.error("could not fetch stack status (%s)" % str(stack_id))
-                    return False
+        ready = self.stack_waiter.wait_all([stack_id], progress=self._log_stack_events)
+        self.stack_events.pop(stack_id, None)
+        if not ready:
+            logging.warning("cloudformation FAILED")
+        return ready
 
     def _collect_resources(self, stack_id):
         """
@@ -877,33 +927,42 @@ class AWSLauncher(object):
 
         return self.vpc_id, self.data_subnet, self.manage_subnet
 
+    def _fetch_instance_status(self, instance_ids):
+        """
+        Fetch the status of many instances at once. An instance is ready
+        once it is running and has finished its reachability check. 
+        """
+        statuses = {}
+        for s in self.ec2.get_all_instance_status(instance_ids=instance_ids, 
+                                                  include_all_instances=True):
+            reachability = s.instance_status.details.get('reachability')
+            if s.state_name == 'running' and reachability != 'initializing':
+                statuses[s.id] = READY
+            elif s.state_name in ['shutting-down', 'terminated']:
+                statuses[s.id] = FAILED
+            else:
+                statuses[s.id] = None
+        return statuses
+
     def _check_instance_status(self, stack_desc):
         logging.warning("waiting for instance status")
         servers = self._get_servers(stack_desc)
         instance_ids = []
         for s in servers:
             instance_ids.append(s["id"])
-        
-        while(True):
-            all_init = True
-            statuses = self.ec2.get_all_instance_status(instance_ids=instance_ids)
-            for s in statuses:
-                if s.instance_status.details['reachability'] == 'initializing':
-                    all_init = False
-            if all_init:
-                break
-            else:
-                time.sleep(20)
+        return self.instance_waiter.wait_all(instance_ids)
 
-    def _create_app_stack(self, cluster_uuid, num_instances, security_group_ports, internal_ports, assign_floating_ip, ctype):
+    def _create_app_stack(self, cluster_uuid, service_uuid, num_instances, security_group_ports, internal_ports, assign_floating_ip, ctype):
         """
         Create an empty application stack. This includes the instances, 
         security groups, and floating IPs. 
         """
 
         # Check if a VPC and subnets has been assigned. If not
-        # we'll go ahead and create some. 
-        vpc, data_subnet, manage_subnet = self._create_network(cluster_uuid)
+        # we'll go ahead and create some. Multiple stacks may be
+        # created concurrently, but only one should create the network. 
+        with self.network_lock:
+            vpc, data_subnet, manage_subnet = self._create_network(cluster_uuid)
         
         # Create the main data security group. This is the security
         # group that controls both internal and external communication with
@@ -926,6 +985,7 @@ class AWSLauncher(object):
 
         logging.info("creating instances for %s" % cluster_uuid)
         stack_plan, stack_desc = self._create_instance_plan(cluster_uuid = cluster_uuid, 
+                                                            service_uuid = service_uuid, 
                                                             subnet = subnet, 
                                                             num_instances = num_instances, 
                                                             image = self.default_image,
@@ -956,8 +1016,10 @@ class AWSLauncher(object):
                                  sort_keys=True,
                                  indent=2,
                                  separators=(',',':')))
-        stack_name = "FerryApp%s%s" % (ctype.upper(), cluster_uuid.replace("-", ""))
+        stack_name = "FerryApp%s%s%s" % (ctype.upper(), cluster_uuid.replace("-", ""), service_uuid.replace("-", ""))
         stack_desc = self._launch_cloudformation(stack_name, stack_plan, stack_desc)
+        if not stack_desc:
+            return None
 
         # Wait for the application instances to actually
         # be available (status checks ok)
@@ -1079,9 +1141,34 @@ class AWSLauncher(object):
             if nic["index"] == 1:
                 return nic["ip_address"]
 
-    def alloc(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+    def provision(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
         """
-        Allocate a new cluster. 
+        Start creating the application stack in the background. This lets
+        independent services (storage, compute, connectors) create their
+        stacks concurrently. The stack is claimed later by alloc. 
+        """
+        self.provisions[service_uuid] = BackgroundTask(self._provision_stack,
+                                                       cluster_uuid, 
+                                                       service_uuid, 
+                                                       container_info, 
+                                                       ctype, 
+                                                       proxy)
+
+    def _claim_stack(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Wait for a stack that was provisioned in the background. If the
+        stack was never provisioned, create it now. 
+        """
+        task = self.provisions.pop(service_uuid, None)
+        if task:
+            return task.wait()
+        else:
+            return self._provision_stack(cluster_uuid, service_uuid, container_info, ctype, proxy)
+
+    def _provision_stack(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Create the application stack and record it in the
+        application database. 
         """
 
         # Now take the cluster and create the security group
@@ -1125,30 +1212,73 @@ class AWSLauncher(object):
 
         # Tell AWS to allocate the cluster. 
         resources = self._create_app_stack(cluster_uuid = cluster_uuid, 
+                                           service_uuid = service_uuid, 
                                            num_instances = len(container_info), 
                                            security_group_ports = sec_group_ports,
                                            internal_ports = internal_ports, 
                                            assign_floating_ip = floating_ip,
                                            ctype = ctype)
 
-        logging.debug(json.dumps(resources,
-                                 sort_keys=True,
-                                 indent=2,
-                                 separators=(',',':')))
+        # Store the resources cluster ID so that the stack can
+        # be deleted even if it is never claimed. 
+        if resources:
+            self._update_app_db(cluster_uuid, service_uuid, resources)
+        return resources
+
+    def _claim_stacks(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Collect the stacks for this service. Some of the servers may have
+        been claimed from the warm pool. The rest are in a new stack. 
+        """
+        stacks = list(self.apps.find( { "_cluster_uuid" : cluster_uuid,
+                                        "_service_uuid" : service_uuid,
+                                        "_warm" : True } ))
+        num_warm = sum([len(self._get_servers(s)) for s in stacks])
+        if num_warm < len(container_info):
+            resources = self._claim_stack(cluster_uuid, service_uuid, container_info[num_warm:], ctype, proxy)
+            if not resources:
+                return None
+            stacks.append(resources)
+        return stacks
+
+    def _reassign_stack(self, cluster_uuid, service_uuid, new_cluster_uuid, new_service_uuid, warm=False):
+        """
+        Move the stacks from one service to another (i.e., to
+        and from the warm pool). 
+        """
+        self.apps.update( { "_cluster_uuid" : cluster_uuid,
+                            "_service_uuid" : service_uuid },
+                          { "$set" : { "_cluster_uuid" : new_cluster_uuid,
+                                       "_service_uuid" : new_service_uuid,
+                                       "_warm" : warm } },
+                          multi=True )
+
+    def _get_stack_ips(self, cluster_uuid, service_uuid):
+        ips = []
+        stacks = self.apps.find( { "_cluster_uuid" : cluster_uuid,
+                                   "_service_uuid" : service_uuid } )
+        for stack in stacks:
+            for s in self._get_servers(stack):
+                ips.append(self._get_manage_ip(s, public=False))
+        return ips
+
+    def alloc(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Allocate a new cluster. 
+        """
+        stacks = self._claim_stacks(cluster_uuid, service_uuid, container_info, ctype, proxy)
 
         # Now we need to ask the cluster to start the 
         # Docker containers.
-        containers = []
-        mounts = {}
+        if stacks:
+            servers = []
+            for resources in stacks:
+                servers += [(s, resources) for s in self._get_servers(resources)]
 
-        if resources:
-            # Store the resources cluster ID. 
-            self._update_app_db(cluster_uuid, service_uuid, resources)
-
-            servers = self._get_servers(resources)
+            hosts = []
             for i in range(0, len(container_info)):
                 # Fetch a server to run the Docker commands. 
-                server = servers[i]
+                server, resources = servers[i]
 
                 # Get the LXC networking options
                 lxc_opts, container_ip = self._get_net_info(server, resources)
@@ -1170,38 +1300,27 @@ class AWSLauncher(object):
                     # else:
                     #     server_ip = self._get_manage_ip(server, public=True)
 
-                # Verify that the user_data processes all started properly
-                # and that the docker daemon is actually running. If it is
-                # not running, we should cancel the stack. 
-                if not self.controller._verify_ferry_server(server_ip):
-                    # self.controller._execute_server_init(server_ip)
-                    logging.error("Could not create Ferry cluster, cancelling stack")
-                    return None
-
-                # Copy over the public keys, but also verify that it does
-                # get copied over properly. 
-                self.controller._copy_public_keys(container_info[i], server_ip)
-                if self.controller._verify_public_keys(server_ip):
-                    container, cmounts = self.controller.execute_docker_containers(container_info[i], lxc_opts, container_ip, server_ip, background=True)
-                
-                    if container:
-                        mounts = dict(mounts.items() + cmounts.items())
-                        containers.append(container)
-                else:
-                    logging.error("could not copy over ssh key!")
-                    return None
-
-            # Check if we need to set the file permissions
-            # for the mounted volumes. 
-            for c, i in mounts.items():
-                for _, v in i['vols']:
-                    self.controller.cmd([c], 'chown -R %s %s' % (i['user'], v))
-            return containers
+                hosts.append( { 'lxc_opts' : lxc_opts,
+                                'private_ip' : container_ip,
+                                'server_ip' : server_ip } )
+
+            # Bootstrap all the servers concurrently. If the Ferry
+            # server can't be verified, we should cancel the stack. 
+            return self.controller.bootstrap_containers(container_info, hosts)
         else:
             # AWS failed to launch the application stack.
             return None
 
     def _delete_stack(self, cluster_uuid, service_uuid):
+        # If the stack is still being provisioned, wait for 
+        # it to finish so that we can delete it. 
+        task = self.provisions.pop(service_uuid, None)
+        if task:
+            try:
+                task.wait()
+            except Exception as e:
+                logging.error(str(e))
+
         # Find the relevant stack information. 
         ips = []
         stacks = self.apps.find( { "_cluster_uuid" : cluster_uuid,
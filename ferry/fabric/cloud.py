@@ -16,6 +16,8 @@
 import ferry.install
 from ferry.docker.docker import DockerInstance, DockerCLI
 from ferry.fabric.com import robust_com
+from ferry.fabric.pool import WarmPool
+from ferry.workers import WorkerPool
 import importlib
 import inspect
 import json
@@ -27,6 +29,10 @@ import yaml
 
 class CloudFabric(object):
 
+    # Number of times to try bootstrapping a single
+    # virtual machine before giving up. 
+    BOOTSTRAP_ATTEMPTS = 2
+
     def __init__(self, bootstrap=False):
         self.name = "cloud"
         self.repo = 'public'
@@ -74,6 +80,13 @@ class CloudFabric(object):
         if self.proxy and not self.launcher.support_proxy():
             logging.error("%s does not support proxy mode" % self.launcher.name)
 
+        # Optionally keep a pool of warm virtual machines 
+        # so that new stacks can start more quickly. 
+        provider = conf["system"]["provider"]
+        self.pool = None
+        if 'pool' in conf[provider]:
+            self.pool = WarmPool(self, conf[provider]['pool'])
+
     def get_data_dir(self):
         return "/ferry/data"
 
@@ -266,10 +279,131 @@ class CloudFabric(object):
         else:
             return None, None
 
+    def bootstrap_containers(self, container_info, hosts, restart_server=False):
+        """
+        Start the containers on the virtual machines of a new stack. Each
+        virtual machine is bootstrapped independently (verify the Ferry server, 
+        copy the keys, run the container, and set the volume permissions) using
+        a bounded number of workers. A virtual machine that fails is retried 
+        without affecting the others. 
+
+        The hosts are a list of dictionaries with the LXC options, the
+        private IP address, and the server IP address. 
+        """
+        start = time.time()
+        pool = WorkerPool(self.launcher.bootstrap_workers)
+        jobs = [(container_info[i], hosts[i], restart_server) for i in range(len(container_info))]
+        results = pool.map(self._bootstrap_server, jobs)
+        self._log_bootstrap_timings([timings for _, timings in results], time.time() - start)
+
+        containers = []
+        failed = []
+        for i, (container, _) in enumerate(results):
+            if container:
+                containers.append(container)
+            else:
+                failed.append(hosts[i]['server_ip'])
+        if len(failed) > 0:
+            logging.error("could not bootstrap servers %s" % str(failed))
+            return None
+        return containers
+
+    def _bootstrap_server(self, job):
+        """
+        Bootstrap a single virtual machine, retrying if necessary. 
+        """
+        cinfo, host, restart_server = job
+        timings = {}
+        for attempt in range(0, CloudFabric.BOOTSTRAP_ATTEMPTS):
+            try:
+                container = self._bootstrap_server_once(cinfo, host, restart_server, timings)
+            except Exception as e:
+                logging.exception("could not bootstrap %s" % host['server_ip'])
+                container = None
+
+            if container:
+                return container, timings
+            logging.warning("bootstrap of %s failed (attempt %d)" % (host['server_ip'], attempt + 1))
+        return None, timings
+
+    def _bootstrap_server_once(self, cinfo, host, restart_server, timings):
+        server_ip = host['server_ip']
+
+        # Verify that the user_data processes all started properly
+        # and that the docker daemon is actually running. 
+        start = time.time()
+        verified = self._verify_ferry_server(server_ip)
+        if not verified and restart_server:
+            self._execute_server_init(server_ip)
+            verified = True
+        timings['verify'] = timings.get('verify', 0) + time.time() - start
+        if not verified:
+            logging.error("ferry server is not running on %s" % server_ip)
+            return None
+
+        # Copy over the public keys, but also verify that it does
+        # get copied over properly. 
+        start = time.time()
+        self._copy_public_keys(cinfo, server_ip)
+        copied = self._verify_public_keys(server_ip)
+        timings['keys'] = timings.get('keys', 0) + time.time() - start
+        if not copied:
+            logging.error("could not copy over ssh key to %s" % server_ip)
+            return None
+
+        start = time.time()
+        container, mounts = self.execute_docker_containers(cinfo, 
+                                                           host['lxc_opts'], 
+                                                           host['private_ip'], 
+                                                           server_ip)
+        timings['container'] = timings.get('container', 0) + time.time() - start
+        if not container:
+            return None
+
+        # Check if we need to set the file permissions
+        # for the mounted volumes. 
+        start = time.time()
+        for c, i in mounts.items():
+            for _, v in i['vols']:
+                self.cmd([c], 'chown -R %s %s' % (i['user'], v))
+        timings['permissions'] = timings.get('permissions', 0) + time.time() - start
+        return container
+
+    def _log_bootstrap_timings(self, all_timings, elapsed):
+        """
+        Log the slowest and average time for each bootstrap phase. 
+        """
+        phases = ['verify', 'keys', 'container', 'permissions']
+        for phase in phases:
+            values = [t[phase] for t in all_timings if phase in t]
+            if len(values) > 0:
+                logging.warning("bootstrap %s: max %.1fs avg %.1fs" % (phase, 
+                                                                       max(values),
+                                                                       sum(values) / len(values)))
+        logging.warning("bootstrapped %d servers in %.1fs" % (len(all_timings), elapsed))
+
+    def provision(self, cluster_uuid, service_uuid, container_info, ctype):
+        """
+        Start creating the virtual machines for a service cluster
+        in the background. The machines are claimed by alloc. 
+        """
+        num_warm = self._claim_warm(cluster_uuid, service_uuid, container_info, ctype)
+        if num_warm < len(container_info):
+            self.launcher.provision(cluster_uuid, service_uuid, container_info[num_warm:], ctype, self.proxy)
+
+    def _claim_warm(self, cluster_uuid, service_uuid, container_info, ctype):
+        """
+        Claim virtual machines from the warm pool. 
+        """
+        if self.pool:
+            return self.pool.claim(cluster_uuid, service_uuid, container_info, ctype)
+        return 0
+
     def alloc(self, cluster_uuid, service_uuid, container_info, ctype):
         """
         Allocate a new service cluster. 
         """
+        self._claim_warm(cluster_uuid, service_uuid, container_info, ctype)
         containers = self.launcher.alloc(cluster_uuid, service_uuid, container_info, ctype, self.proxy)
         
         if not containers:
@@ -286,7 +420,7 @@ class CloudFabric(object):
         """
         Stop the running containers
         """
-        self.remove(cluster_uuid, service_uuid, containers)
+        self._delete_stack(cluster_uuid, service_uuid)
 
     def halt(self, cluster_uuid, service_uuid, containers):
         """
@@ -307,8 +441,16 @@ class CloudFabric(object):
 
     def remove(self, cluster_uuid, service_uuid, containers):
         """
-        Remove the running instances
+        Remove the halted instances. If there is room, the virtual
+        machines are returned to the warm pool instead of being deleted. 
         """
+        if self.pool and self.pool.release(cluster_uuid, service_uuid, containers):
+            return
+        self._delete_stack(cluster_uuid, service_uuid)
+
+    def _delete_stack(self, cluster_uuid, service_uuid):
+        if self.pool:
+            self.pool.forget(service_uuid)
         self.launcher._delete_stack(cluster_uuid, service_uuid)
 
     def copy(self, containers, from_dir, to_dir):
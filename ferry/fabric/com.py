@@ -17,11 +17,23 @@ import logging
 import re
 from subprocess import Popen, PIPE
 import time
+from ferry import metrics, tracing
 
 # Maximum number of tries to contact. 
 MAX_COM_RETRIES = 10
 
 def robust_com(cmd):
+    with tracing.span('robust_com', cmd=cmd[:120]) as s:
+        with metrics.SSH_SECONDS.time():
+            output, err, success = _robust_com(cmd)
+        if success:
+            metrics.SSH_COMMANDS.inc(status='ok')
+        else:
+            metrics.SSH_COMMANDS.inc(status='failed')
+            s.fail("could not communicate")
+        return output, err, success
+
+def _robust_com(cmd):
     # All the possible errors that might happen when
     # we try to connect via ssh. 
     route_closed = re.compile('.*No route to host.*', re.DOTALL)
@@ -38,6 +50,7 @@ def robust_com(cmd):
         if route_closed.match(err) or conn_closed.match(err) or refused_closed.match(err) or timed_out.match(err) or permission.match(err):            
             if num_tries < MAX_COM_RETRIES:
                 logging.warning("com error, trying again...")
+                metrics.SSH_RETRIES.inc()
                 num_tries += 1
                 time.sleep(10 * num_tries)
             else: 
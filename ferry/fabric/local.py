@@ -16,17 +16,25 @@
 from ferry.docker.docker import DockerCLI
 from ferry.docker.docker import DockerInspector
 from ferry.fabric.com import robust_com
+from ferry.fabric.pool import ContainerPool
 from ferry.ip.client import DHCPClient
 from ferry.config.system.info import System
+from ferry.workers import WorkerPool
 import ferry.install
 import json
 import logging
 import os
+from distutils import spawn
 from subprocess import Popen, PIPE
 import time
 import yaml
 
 class LocalFabric(object):
+    # Seconds to wait for the ssh server to start
+    # on new and restarted containers. 
+    RUN_WAIT = 3
+    RESTART_WAIT = 2
+
     def __init__(self, bootstrap=False):
         self.name = "local"
         self.repo = 'public'
@@ -41,9 +49,16 @@ class LocalFabric(object):
 
         # Bootstrap mode means that the DHCP network
         # isn't available yet, so we can't use the network. 
+        self.pool = None
         if not bootstrap:
             self.network = DHCPClient(ferry.install._get_gateway())
 
+            # Optionally keep a pool of idle containers so
+            # that new stacks can start more quickly. 
+            conf = ferry.install.read_ferry_config()
+            if 'pool' in conf['system']:
+                self.pool = ContainerPool(self, conf['system']['pool'])
+
     def _get_host(self):
         cmd = "ifconfig eth0 | grep 'inet addr:' | cut -d: -f2 | awk '{ print $1}'"
         return Popen(cmd, stdout=PIPE, shell=True).stdout.read().strip()
@@ -88,6 +103,8 @@ class LocalFabric(object):
         Quit the local fabric. 
         """
         logging.info("quitting local fabric")
+        if self.pool:
+            self.pool.drain()
 
     def restart(self, cluster_uuid, service_uuid, containers):
         """
@@ -109,9 +126,47 @@ class LocalFabric(object):
 
         # We should wait for a second to let the ssh server start
         # on the containers (otherwise sometimes we get a connection refused)
-        time.sleep(2)
+        time.sleep(self.RESTART_WAIT)
         return new_containers
 
+    def provision(self, cluster_uuid, service_uuid, container_info, ctype):
+        """
+        Containers are created directly by alloc, so there is
+        nothing to provision ahead of time. 
+        """
+        pass
+
+    def _get_lxc_opts(self, ip):
+        """
+        The LXC networking options for a container with this IP address. 
+        """
+        gw = ferry.install._get_gateway().split("/")[0]
+        return ["lxc.network.type = veth",
+                "lxc.network.ipv4 = %s/24" % ip, 
+                "lxc.network.ipv4.gateway = %s" % gw,
+                "lxc.network.link = ferry0",
+                "lxc.network.name = eth0",
+                "lxc.network.flags = up"]
+
+    def _forward_ports(self, ip, ports):
+        """
+        Forward the host ports to the container. 
+        """
+        host_map = {}
+        for p in ports:
+            p = str(p)
+            s = p.split(":")
+            if len(s) > 1:
+                host = s[0]
+                dest = s[1]
+            else:
+                host = self.network.random_port()
+                dest = s[0]
+            host_map[dest] = [{'HostIp' : '0.0.0.0',
+                               'HostPort' : host}]
+            self.network.forward_rule('0.0.0.0/0', host, ip, dest)
+        return host_map
+
     def alloc(self, cluster_uuid, service_uuid, container_info, ctype):
         """
         Allocate several instances.
@@ -119,67 +174,22 @@ class LocalFabric(object):
         containers = []
         mounts = {}
         for c in container_info:
-            # Get a new IP address for this container and construct
-            # a default command. 
-            gw = ferry.install._get_gateway().split("/")[0]
+            if not 'default_cmd' in c:
+                c['default_cmd'] = "/service/sbin/startnode init"
 
-            # Check if we should use the manual LXC option. 
-            if not 'netenable' in c:
-                ip = self.network.assign_ip(c)
-                lxc_opts = ["lxc.network.type = veth",
-                            "lxc.network.ipv4 = %s/24" % ip, 
-                            "lxc.network.ipv4.gateway = %s" % gw,
-                            "lxc.network.link = ferry0",
-                            "lxc.network.name = eth0",
-                            "lxc.network.flags = up"]
-
-                # Check if we need to forward any ports. 
-                host_map = {}
-                for p in c['ports']:
-                    p = str(p)
-                    s = p.split(":")
-                    if len(s) > 1:
-                        host = s[0]
-                        dest = s[1]
-                    else:
-                        host = self.network.random_port()
-                        dest = s[0]
-                    host_map[dest] = [{'HostIp' : '0.0.0.0',
-                                       'HostPort' : host}]
-                    self.network.forward_rule('0.0.0.0/0', host, ip, dest)
-                host_map_keys = host_map.keys()
+            # Try to use an idle container first. 
+            container = None
+            if self.pool:
+                container = self.pool.claim(c)
+            if container:
+                host_map = self._forward_ports(container.internal_ip, c['ports'])
+                for p in host_map.keys():
+                    container.ports[p] = host_map[p]
             else:
-                lxc_opts = None
-                host_map = None
-                host_map_keys = []
+                container = self._run_container(c)
 
-            # Start a container with a specific image, in daemon mode,
-            # without TTY, and on a specific port
-            if not 'default_cmd' in c:
-                c['default_cmd'] = "/service/sbin/startnode init"
-            container = self.cli.run(service_type = c['type'], 
-                                     image = c['image'], 
-                                     volumes = c['volumes'],
-                                     keydir = c['keydir'], 
-                                     keyname = c['keyname'], 
-                                     privatekey = c['privatekey'], 
-                                     open_ports = host_map_keys,
-                                     host_map = host_map, 
-                                     expose_group = c['exposed'], 
-                                     hostname = c['hostname'],
-                                     default_cmd = c['default_cmd'],
-                                     args= c['args'],
-                                     lxc_opts = lxc_opts,
-                                     inspector = self.inspector,
-                                     background = False)
             if container:
-                container.default_user = self.docker_user
                 containers.append(container)
-                if not 'netenable' in c:
-                    container.internal_ip = ip
-                    container.external_ip = ip
-                    self.network.set_owner(ip, container.container)
-
                 if 'name' in c:
                     container.name = c['name']
 
@@ -187,10 +197,6 @@ class LocalFabric(object):
                     mounts[container] = {'user':c['volume_user'],
                                          'vols':c['volumes'].items()}
 
-                # We should wait for a second to let the ssh server start
-                # on the containers (otherwise sometimes we get a connection refused)
-                time.sleep(3)
-
         # Check if we need to set the file permissions
         # for the mounted volumes. 
         for c, i in mounts.items():
@@ -199,6 +205,53 @@ class LocalFabric(object):
 
         return containers
 
+    def _run_container(self, c):
+        """
+        Start a brand new container. 
+        """
+        # Check if we should use the manual LXC option. 
+        if not 'netenable' in c:
+            # Get a new IP address for this container. 
+            ip = self.network.assign_ip(c)
+            lxc_opts = self._get_lxc_opts(ip)
+
+            # Check if we need to forward any ports. 
+            host_map = self._forward_ports(ip, c['ports'])
+            host_map_keys = host_map.keys()
+        else:
+            lxc_opts = None
+            host_map = None
+            host_map_keys = []
+
+        # Start a container with a specific image, in daemon mode,
+        # without TTY, and on a specific port
+        container = self.cli.run(service_type = c['type'], 
+                                 image = c['image'], 
+                                 volumes = c['volumes'],
+                                 keydir = c['keydir'], 
+                                 keyname = c['keyname'], 
+                                 privatekey = c['privatekey'], 
+                                 open_ports = host_map_keys,
+                                 host_map = host_map, 
+                                 expose_group = c['exposed'], 
+                                 hostname = c['hostname'],
+                                 default_cmd = c['default_cmd'],
+                                 args= c['args'],
+                                 lxc_opts = lxc_opts,
+                                 inspector = self.inspector,
+                                 background = False)
+        if container:
+            container.default_user = self.docker_user
+            if not 'netenable' in c:
+                container.internal_ip = ip
+                container.external_ip = ip
+                self.network.set_owner(ip, container.container)
+
+            # We should wait for a second to let the ssh server start
+            # on the containers (otherwise sometimes we get a connection refused)
+            time.sleep(self.RUN_WAIT)
+        return container
+
     def stop(self, cluster_uuid, service_uuid, containers):
         """
         Forceably stop the running containers
@@ -221,11 +274,13 @@ class LocalFabric(object):
 
     def snapshot(self, containers, cluster_uuid, num_snapshots):
         """
-        Save/commit the running instances
+        Save/commit the running instances. The containers are committed
+        in parallel. If a container was started from a previous snapshot, 
+        the new image is layered on top of it, so it only stores the changes. 
         """
         snapshots = []
         for c in containers:
-            snapshot_name = '%s-%s-%s:SNAPSHOT-%s' % (c.image, 
+            snapshot_name = '%s-%s-%s:SNAPSHOT-%s' % (self._image_repository(c.image), 
                                                       cluster_uuid,
                                                       c.host_name,
                                                       num_snapshots)
@@ -235,20 +290,105 @@ class LocalFabric(object):
                                'name' : c.name, 
                                'args' : c.args,
                                'ports': c.ports} )
-            self.cli.commit(c, snapshot_name)
+
+        pool = WorkerPool()
+        pool.map(lambda i: self.cli.commit(containers[i], snapshots[i]['image']), 
+                 range(len(containers)))
         return snapshots
 
-    def push(self, image, registry=None):
+    def _image_repository(self, image):
+        """
+        Strip the tag from the image name (i.e., the SNAPSHOT tag
+        of an image that was started from a snapshot). 
+        """
+        name, sep, tag = image.rpartition(':')
+        if sep and not '/' in tag:
+            return name
+        return image
+
+    def snapshot_volumes(self, volumes, snapshot_uuid, parent_uuid=None):
+        """
+        Copy the data directories ('source' of each 'service') into the 
+        snapshot directory. Copies are copy-on-write if the filesystem supports it. 
+        Otherwise files that haven't changed since the parent snapshot are
+        hard-linked to it, so successive snapshots only store the changes. 
+        Note that the services keep running, so this is only a crash-consistent
+        copy of the data. 
+        """
+        snapshot_dir = self.get_snapshot_dir(snapshot_uuid)
+        parent_dir = None
+        if parent_uuid:
+            parent_dir = self.get_snapshot_dir(parent_uuid)
+
+        copies = []
+        for v in volumes:
+            name = os.path.basename(v['source'].rstrip('/'))
+            parent = None
+            if parent_dir:
+                parent = os.path.join(parent_dir, v['service'], name)
+            copies.append( { 'service' : v['service'], 
+                             'source' : v['source'],
+                             'volume' : v['volume'], 
+                             'snapshot' : os.path.join(snapshot_dir, v['service'], name),
+                             'parent' : parent } )
+
+        pool = WorkerPool()
+        pool.map(lambda v: self._copy_volume(v['source'], v['snapshot'], v['parent']), copies)
+        return copies
+
+    def get_snapshot_dir(self, snapshot_uuid):
+        """
+        Snapshots are stored next to the data directories, so that
+        they can share the same blocks. 
+        """
+        return os.path.join(self.get_data_dir(), 'snapshots', snapshot_uuid)
+
+    def clone_volumes(self, volumes):
+        """
+        Fill new data directories from a snapshot. The data directories
+        are already mounted in the containers, so the contents are copied
+        into the existing directories. The copies are copy-on-write if 
+        the filesystem supports it (i.e., btrfs), which makes cloning large 
+        datasets cheap. The snapshot is never hard-linked, since the services
+        may modify their files in place. 
+        """
+        pool = WorkerPool()
+        pool.map(lambda v: self._copy_volume(v['snapshot'], v['clone']), volumes)
+
+    def _copy_volume(self, src, dst, parent=None):
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+
+        # Copy the contents so that it doesn't matter
+        # whether the destination already exists. 
+        if self._get_dir_fs(src) == 'btrfs':
+            cmd = 'cp -a --reflink=always %s/. %s' % (src, dst)
+        elif parent and os.path.isdir(parent) and spawn.find_executable('rsync'):
+            cmd = 'rsync -a --link-dest=%s %s/ %s/' % (parent, src, dst)
+        else:
+            cmd = 'cp -a --reflink=auto %s/. %s' % (src, dst)
+        logging.warning(cmd)
+        child = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
+        _, err = child.communicate()
+        if child.returncode != 0:
+            logging.error("could not copy %s (%s)" % (src, err.strip()))
+            raise OSError(err.strip())
+
+    def _get_dir_fs(self, path):
+        cmd = 'stat -f -c %%T %s 2> /dev/null' % path
+        return Popen(cmd, stdout=PIPE, shell=True).stdout.read().strip()
+
+    def push(self, image, registry=None, progress=None):
         """
         Push an image to a remote registry.
         """        
-        return self.cli.push(image, registry)
+        return self.cli.push(image, registry, progress=progress)
 
-    def pull(self, image):
+    def pull(self, image, progress=None):
         """
         Pull a remote image to the local registry. 
         """        
-        return self.cli.pull(image)
+        return self.cli.pull(image, progress=progress)
 
     def halt(self, cluster_uuid, service_uuid, containers):
         """
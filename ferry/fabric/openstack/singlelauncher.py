@@ -17,6 +17,8 @@ import copy
 import ferry.install
 from ferry.install import Installer
 from ferry.config.system.info import System
+from ferry.fabric.waiter import BatchPoller, Waiter, READY, FAILED
+from ferry.workers import BackgroundTask
 from heatclient import client as heat_client
 from heatclient.exc import HTTPUnauthorized, HTTPNotFound, HTTPBadRequest
 import json
@@ -49,6 +51,10 @@ class SingleLauncher(object):
         self.system = System()
         self.installer = Installer()
         self.controller = controller
+        self.provisions = {}
+        self.stack_waiter = Waiter(BatchPoller(self._fetch_stack_status), "stacks")
+        self.server_waiter = Waiter(BatchPoller(self._fetch_server_status), "servers")
+        self.stack_events = {}
         self._init_open_stack()
         self._init_app_db()
 
@@ -76,6 +82,12 @@ class SingleLauncher(object):
         self.default_dc = params['dc']
         self.default_zone = params['zone']
 
+        # Number of servers to bootstrap concurrently. 
+        if 'bootstrap' in params:
+            self.bootstrap_workers = int(params['bootstrap'])
+        else:
+            self.bootstrap_workers = 8
+
         # Some OpenStack login credentials. 
         if self._check_openstack_credentials():
             self.openstack_user = os.environ['OS_USERNAME']
@@ -489,21 +501,75 @@ class SingleLauncher(object):
                                    "type": "OS::Heat::Stack" }
         return stack_desc
 
-    def _wait_for_stack(self, stack_id):
+    def _fetch_stack_status(self, stack_ids):
         """
-        Wait for stack completion.
+        Fetch the status of the pending stacks. Each stack is fetched
+        on its own, since Heat pages the list of all stacks. 
         """
-        while(True):
+        statuses = {}
+        for stack_id in stack_ids:
             try:
                 stack = self.heat.stacks.get(stack_id)
-                if stack.status == "COMPLETE":
-                    return True
-                elif stack.status == "FAILED":
-                    return False
-                else:
-                    time.sleep(4)
+            except Exception as e:
+                logging.warning("could not fetch stack %s (%s)" % (str(stack_id), str(e)))
+                continue
+
+            if stack.status == "COMPLETE":
+                statuses[stack_id] = READY
+            elif stack.status == "FAILED":
+                statuses[stack_id] = FAILED
+            else:
+                statuses[stack_id] = None
+        return statuses
+
+    def _log_stack_events(self, stack_ids):
+        """
+        Log any new stack events so that the user can see
+        how the stack creation is progressing. 
+        """
+        for stack_id in stack_ids:
+            seen = self.stack_events.setdefault(stack_id, set())
+            try:
+                events = self.heat.events.list(stack_id)
             except:
-                logging.error("could not fetch stack status (%s)" % str(stack_id))
+                logging.warning("could not fetch events for stack %s" % str(stack_id))
+                continue
+
+            for e in events:
+                if not e.id in seen:
+                    seen.add(e.id)
+                    logging.warning("%s %s %s" % (e.resource_name, 
+                                                  e.resource_status, 
+                                                  e.resource_status_reason or ""))
+
+    def _wait_for_stack(self, stack_id):
+        """
+        Wait for stack completion.
+        """
+        ready = self.stack_waiter.wait_all([stack_id], progress=self._log_stack_events)
+        self.stack_events.pop(stack_id, None)
+        return ready
+
+    def _fetch_server_status(self, server_ids):
+        """
+        Fetch the status of the pending servers. Each server is fetched
+        on its own, since Nova pages the list of all servers. 
+        """
+        statuses = {}
+        for server_id in server_ids:
+            try:
+                f = self.nova.servers.get(server_id)
+            except Exception as e:
+                logging.warning("could not fetch server %s (%s)" % (str(server_id), str(e)))
+                continue
+
+            if f.status == "ACTIVE":
+                statuses[server_id] = READY
+            elif f.status == "ERROR":
+                statuses[server_id] = FAILED
+            else:
+                statuses[server_id] = None
+        return statuses
 
     def _collect_resources(self, stack_id):
         """
@@ -568,20 +634,24 @@ class SingleLauncher(object):
                 instance_desc["id"] = s.id
         return stack_desc
 
-    def _create_app_stack(self, cluster_uuid, num_instances, security_group_ports, internal_ports, assign_floating_ip, ctype):
+    def _create_app_stack(self, cluster_uuid, service_uuid, num_instances, security_group_ports, internal_ports, assign_floating_ip, ctype):
         """
         Create an empty application stack. This includes the instances, 
         security groups, and floating IPs. 
         """
 
+        # Resource names must be unique across all the services in the
+        # cluster, since the stacks may be created concurrently. 
+        stack_uuid = "%s-%s" % (cluster_uuid, service_uuid)
+
         logging.info("creating security group for %s" % cluster_uuid)
-        sec_group_plan, sec_group_desc = self._create_security_plan(cluster_uuid = cluster_uuid,
+        sec_group_plan, sec_group_desc = self._create_security_plan(cluster_uuid = stack_uuid,
                                                                     ports = security_group_ports,
                                                                     internal = internal_ports, 
                                                                     ctype = ctype) 
 
         logging.info("creating instances for %s" % cluster_uuid)
-        stack_plan, stack_desc = self._create_instance_plan(cluster_uuid = cluster_uuid, 
+        stack_plan, stack_desc = self._create_instance_plan(cluster_uuid = stack_uuid, 
                                                             num_instances = num_instances, 
                                                             image = self.default_image,
                                                             size = self.default_personality, 
@@ -597,7 +667,7 @@ class SingleLauncher(object):
             for k in stack_desc.keys():
                 if stack_desc[k]["type"] == "OS::Neutron::Port" and stack_desc[k]["role"] == "manage":
                     ifaces.append(k)
-            ip_plan, ip_desc = self._create_floatingip_plan(cluster_uuid = cluster_uuid,
+            ip_plan, ip_desc = self._create_floatingip_plan(cluster_uuid = stack_uuid,
                                                             ifaces = ifaces)
         else:
             ip_plan = { "Resources" : {}}
@@ -612,7 +682,7 @@ class SingleLauncher(object):
         stack_desc = dict(stack_desc.items() + 
                           sec_group_desc.items() +
                           ip_desc.items())
-        stack_desc = self._launch_heat_plan("ferry-app-%s-%s" % (ctype.upper(), cluster_uuid), stack_plan, stack_desc)
+        stack_desc = self._launch_heat_plan("ferry-app-%s-%s" % (ctype.upper(), stack_uuid), stack_plan, stack_desc)
 
         # Now find all the IP addresses of the various machines. 
         if stack_desc:
@@ -671,9 +741,34 @@ class SingleLauncher(object):
         heat_plan["_service_uuid"] = service_uuid
         self.apps.insert(copy.deepcopy(heat_plan))
 
-    def alloc(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+    def provision(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
         """
-        Allocate a new cluster. 
+        Start creating the application stack in the background. This lets
+        independent services (storage, compute, connectors) create their
+        stacks concurrently. The stack is claimed later by alloc. 
+        """
+        self.provisions[service_uuid] = BackgroundTask(self._provision_stack,
+                                                       cluster_uuid, 
+                                                       service_uuid, 
+                                                       container_info, 
+                                                       ctype, 
+                                                       proxy)
+
+    def _claim_stack(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Wait for a stack that was provisioned in the background. If the
+        stack was never provisioned, create it now. 
+        """
+        task = self.provisions.pop(service_uuid, None)
+        if task:
+            return task.wait()
+        else:
+            return self._provision_stack(cluster_uuid, service_uuid, container_info, ctype, proxy)
+
+    def _provision_stack(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Create the application stack and record it in the
+        application database. 
         """
 
         # Now take the cluster and create the security group
@@ -723,25 +818,73 @@ class SingleLauncher(object):
 
         # Tell OpenStack to allocate the cluster. 
         resources = self._create_app_stack(cluster_uuid = cluster_uuid, 
+                                           service_uuid = service_uuid, 
                                            num_instances = len(container_info), 
                                            security_group_ports = sec_group_ports,
                                            internal_ports = internal_ports, 
                                            assign_floating_ip = floating_ip,
                                            ctype = ctype)
-        
-        # Now we need to ask the cluster to start the 
-        # Docker containers.
-        containers = []
-        mounts = {}
 
+        # Store the resources cluster ID so that the stack can
+        # be deleted even if it is never claimed. 
         if resources:
-            # Store the resources cluster ID. 
             self._update_app_db(cluster_uuid, service_uuid, resources)
+        return resources
+
+    def _claim_stacks(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Collect the stacks for this service. Some of the servers may have
+        been claimed from the warm pool. The rest are in a new stack. 
+        """
+        stacks = list(self.apps.find( { "_cluster_uuid" : cluster_uuid,
+                                        "_service_uuid" : service_uuid,
+                                        "_warm" : True } ))
+        num_warm = sum([len(self._get_servers(s)) for s in stacks])
+        if num_warm < len(container_info):
+            resources = self._claim_stack(cluster_uuid, service_uuid, container_info[num_warm:], ctype, proxy)
+            if not resources:
+                return None
+            stacks.append(resources)
+        return stacks
+
+    def _reassign_stack(self, cluster_uuid, service_uuid, new_cluster_uuid, new_service_uuid, warm=False):
+        """
+        Move the stacks from one service to another (i.e., to
+        and from the warm pool). 
+        """
+        self.apps.update( { "_cluster_uuid" : cluster_uuid,
+                            "_service_uuid" : service_uuid },
+                          { "$set" : { "_cluster_uuid" : new_cluster_uuid,
+                                       "_service_uuid" : new_service_uuid,
+                                       "_warm" : warm } },
+                          multi=True )
+
+    def _get_stack_ips(self, cluster_uuid, service_uuid):
+        ips = []
+        stacks = self.apps.find( { "_cluster_uuid" : cluster_uuid,
+                                   "_service_uuid" : service_uuid } )
+        for stack in stacks:
+            for s in self._get_servers(stack):
+                ips.append(self._get_public_ip(s, stack))
+        return ips
+
+    def alloc(self, cluster_uuid, service_uuid, container_info, ctype, proxy):
+        """
+        Allocate a new cluster. 
+        """
+        stacks = self._claim_stacks(cluster_uuid, service_uuid, container_info, ctype, proxy)
 
-            servers = self._get_servers(resources)
+        # Now we need to ask the cluster to start the 
+        # Docker containers.
+        if stacks:
+            servers = []
+            for resources in stacks:
+                servers += [(s, resources) for s in self._get_servers(resources)]
+
+            hosts = []
             for i in range(0, len(container_info)):
                 # Fetch a server to run the Docker commands. 
-                server = servers[i]
+                server, resources = servers[i]
 
                 # Get the LXC networking options
                 lxc_opts, private_ip = self._get_net_info(server, self.subnet, resources)
@@ -754,31 +897,13 @@ class SingleLauncher(object):
                 else:
                     server_ip = self._get_public_ip(server, resources)
 
-                # Verify that the user_data processes all started properly
-                # and that the docker daemon is actually running. If it is
-                # not running, try re-executing. 
-                if not self.controller._verify_ferry_server(server_ip):
-                    self.controller._execute_server_init(server_ip)
-
-                # Copy over the public keys, but also verify that it does
-                # get copied over properly. 
-                self.controller._copy_public_keys(container_info[i], server_ip)
-                if self.controller._verify_public_keys(server_ip):
-                    container, cmounts = self.controller.execute_docker_containers(container_info[i], lxc_opts, private_ip, server_ip)
-                
-                    if container:
-                        mounts = dict(mounts.items() + cmounts.items())
-                        containers.append(container)
-                else:
-                    logging.error("could not copy over ssh key!")
-                    return None
-
-            # Check if we need to set the file permissions
-            # for the mounted volumes. 
-            for c, i in mounts.items():
-                for _, v in i['vols']:
-                    self.controller.cmd([c], 'chown -R %s %s' % (i['user'], v))
-            return containers
+                hosts.append( { 'lxc_opts' : lxc_opts,
+                                'private_ip' : private_ip,
+                                'server_ip' : server_ip } )
+
+            # Bootstrap all the servers concurrently. If the Ferry
+            # server is not running, try re-executing. 
+            return self.controller.bootstrap_containers(container_info, hosts, restart_server=True)
         else:
             # OpenStack failed to launch the application stack.
             # This can be caused by improper OpenStack credentials
@@ -787,6 +912,15 @@ class SingleLauncher(object):
             return None
 
     def _delete_stack(self, cluster_uuid, service_uuid):
+        # If the stack is still being provisioned, wait for 
+        # it to finish so that we can delete it. 
+        task = self.provisions.pop(service_uuid, None)
+        if task:
+            try:
+                task.wait()
+            except Exception as e:
+                logging.error(str(e))
+
         # Find the relevant stack information. 
         ips = []
         stacks = self.apps.find( { "_cluster_uuid" : cluster_uuid,
@@ -839,13 +973,7 @@ class SingleLauncher(object):
 
             # Wait for the servers to actually be in the 
             # "running" status before returning. 
-            for s in servers:
-                while(True):
-                    found = self.nova.servers.list(search_opts = { "name" : s["name"] })
-                    for f in found["servers"]:
-                        if f["status"] == "ACTIVE":
-                            break
-                    time.sleep(4)
+            self.server_waiter.wait_all([s["id"] for s in servers])
         return ips
 
     def quit(self):
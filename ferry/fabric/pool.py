@@ -0,0 +1,440 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import logging
+import os
+from pymongo import MongoClient
+import shutil
+import threading2
+import time
+import uuid
+from ferry.workers import BackgroundTask
+
+# Stacks in the warm pool are stored in the launcher
+# application database under this cluster UUID.
+POOL_CLUSTER = "pool"
+
+class WarmPool(object):
+    """
+    Keep a pool of Ferry-ready virtual machines (docker daemon running)
+    so that new stacks don't have to wait for the cloud to create instances.
+    Virtual machines are grouped by the instance type and the ports the
+    service needs (since those determine the security groups).
+
+    The pool is configured under the provider section of the ferry config:
+
+      pool:
+        size: 2       # warm VMs to keep for each group
+        ttl: 3600     # seconds a VM may stay in the pool unused
+        max-vms: 8    # cap on the total number of VMs held by the pool
+    """
+    def __init__(self, fabric, conf):
+        self.fabric = fabric
+        self.launcher = fabric.launcher
+        self.size = int(conf.get('size', 1))
+        self.ttl = int(conf.get('ttl', 3600))
+        self.max_vms = int(conf.get('max-vms', self.size))
+        self.lock = threading2.Lock()
+        self.replenishing = {}
+        self._init_pool_db()
+
+    def _init_pool_db(self):
+        self.mongo = MongoClient(os.environ['MONGODB'], 27017, connectTimeoutMS=6000)
+        self.entries = self.mongo['cloud']['pool']
+        self.assignments = self.mongo['cloud']['pool_assignments']
+
+    def _new_entry_uuid(self):
+        return 'wp-' + str(uuid.uuid4()).split('-')[0]
+
+    def _get_template(self, container_info):
+        """
+        The parts of the container information that
+        determine what the virtual machines look like.
+        """
+        c = container_info[0]
+        return { 'ports' : c.get('ports', []),
+                 'exposed' : c.get('exposed', []),
+                 'internal' : c.get('internal', []) }
+
+    def _get_key(self, ctype, template):
+        desc = json.dumps([ctype, self.launcher.default_personality, template], sort_keys=True)
+        return hashlib.sha1(desc).hexdigest()
+
+    def _num_vms(self, query={}):
+        return sum([e['num'] for e in self.entries.find(query)])
+
+    def claim(self, cluster_uuid, service_uuid, container_info, ctype):
+        """
+        Claim warm virtual machines for this service and return the number
+        of machines claimed. The rest must be provisioned normally.
+        """
+        assignment = self.assignments.find_one( { 'service' : service_uuid } )
+        if assignment:
+            return assignment['num_warm']
+
+        template = self._get_template(container_info)
+        key = self._get_key(ctype, template)
+        self.expire()
+
+        num_warm = 0
+        remaining = len(container_info)
+        for entry in self.entries.find( { 'key' : key, 'status' : 'ready' } ).sort('num', -1):
+            if entry['num'] > remaining:
+                continue
+
+            # Make sure that no one else has claimed this entry.
+            entry = self.entries.find_and_modify( { 'uuid' : entry['uuid'], 'status' : 'ready' },
+                                                  { '$set' : { 'status' : 'claimed' } } )
+            if entry:
+                self.launcher._reassign_stack(POOL_CLUSTER, entry['uuid'],
+                                              cluster_uuid, service_uuid,
+                                              warm=True)
+                self.entries.remove( { 'uuid' : entry['uuid'] } )
+                num_warm += entry['num']
+                remaining -= entry['num']
+
+        logging.warning("claimed %d warm servers for %s" % (num_warm, service_uuid))
+        self.assignments.insert( { 'service' : service_uuid,
+                                   'cluster' : cluster_uuid,
+                                   'key' : key,
+                                   'template' : template,
+                                   'ctype' : ctype,
+                                   'num_warm' : num_warm } )
+        self.replenish(key, template, ctype)
+        return num_warm
+
+    def release(self, cluster_uuid, service_uuid, containers):
+        """
+        Return the halted virtual machines of a removed service to the
+        pool. Returns False if the pool is full, in which case the caller
+        should delete the stack.
+        """
+        assignment = self.assignments.find_one( { 'service' : service_uuid } )
+        self.assignments.remove( { 'service' : service_uuid } )
+        if not assignment or len(containers) == 0:
+            return False
+
+        with self.lock:
+            if self._num_vms() + len(containers) > self.max_vms:
+                return False
+
+            # The old containers and their data are removed
+            # when the virtual machines are warmed up again.
+            cleanup = []
+            for c in containers:
+                cleanup.append( { 'ip' : c.manage_ip,
+                                  'container' : c.container,
+                                  'volumes' : (c.volumes or {}).keys() } )
+            entry_uuid = self._new_entry_uuid()
+            self.launcher._reassign_stack(cluster_uuid, service_uuid,
+                                          POOL_CLUSTER, entry_uuid)
+            self.entries.insert( { 'uuid' : entry_uuid,
+                                   'key' : assignment['key'],
+                                   'template' : assignment['template'],
+                                   'ctype' : assignment['ctype'],
+                                   'num' : len(containers),
+                                   'status' : 'halted',
+                                   'cleanup' : cleanup,
+                                   'time' : time.time() } )
+        logging.warning("returned %d servers from %s to the pool" % (len(containers), service_uuid))
+        self.replenish(assignment['key'], assignment['template'], assignment['ctype'])
+        return True
+
+    def forget(self, service_uuid):
+        """
+        The service stack was deleted.
+        """
+        self.assignments.remove( { 'service' : service_uuid } )
+
+    def expire(self):
+        """
+        Delete any virtual machines that have been in the
+        pool for too long.
+        """
+        deadline = time.time() - self.ttl
+        for entry in self.entries.find( { 'time' : { '$lt' : deadline },
+                                          'status' : { '$in' : ['ready', 'halted'] } } ):
+            logging.warning("expiring warm servers %s" % entry['uuid'])
+            self._delete_entry(entry)
+
+    def _delete_entry(self, entry):
+        self.launcher._delete_stack(POOL_CLUSTER, entry['uuid'])
+        self.entries.remove( { 'uuid' : entry['uuid'] } )
+
+    def replenish(self, key, template, ctype):
+        """
+        Bring the pool back up to size in the background.
+        """
+        with self.lock:
+            task = self.replenishing.get(key)
+            if task and not task.done():
+                return
+            self.replenishing[key] = BackgroundTask(self._replenish, key, template, ctype)
+
+    def _replenish(self, key, template, ctype):
+        try:
+            # First warm up any halted servers.
+            while self._num_vms( { 'key' : key, 'status' : { '$in' : ['ready', 'warming'] } } ) < self.size:
+                entry = self.entries.find_and_modify( { 'key' : key, 'status' : 'halted' },
+                                                      { '$set' : { 'status' : 'warming' } } )
+                if not entry:
+                    break
+                try:
+                    self._warm_halted(entry)
+                except:
+                    self._delete_entry(entry)
+                    raise
+
+            # Then create new servers as long as we are under the cap.
+            while self._num_vms( { 'key' : key, 'status' : { '$in' : ['ready', 'warming'] } } ) < self.size:
+                with self.lock:
+                    if self._num_vms() >= self.max_vms:
+                        logging.warning("warm pool is at capacity (%d servers)" % self.max_vms)
+                        break
+                    entry = { 'uuid' : self._new_entry_uuid(),
+                              'key' : key,
+                              'template' : template,
+                              'ctype' : ctype,
+                              'num' : 1,
+                              'status' : 'warming',
+                              'cleanup' : [],
+                              'time' : time.time() }
+                    self.entries.insert(entry)
+                if not self._warm_new(entry):
+                    break
+        except Exception as e:
+            logging.error("could not replenish warm pool (%s)" % str(e))
+
+    def _warm_new(self, entry):
+        """
+        Create a new stack for the pool.
+        """
+        resources = self.launcher._provision_stack(POOL_CLUSTER,
+                                                   entry['uuid'],
+                                                   [entry['template']] * entry['num'],
+                                                   entry['ctype'],
+                                                   self.fabric.proxy)
+        if not resources:
+            logging.error("could not create warm servers %s" % entry['uuid'])
+            self._delete_entry(entry)
+            return False
+        return self._mark_ready(entry, self.launcher._get_stack_ips(POOL_CLUSTER, entry['uuid']))
+
+    def _warm_halted(self, entry):
+        """
+        Restart halted servers, restart Ferry, and remove
+        the containers of the previous service.
+        """
+        ips = self.launcher._restart_stack(POOL_CLUSTER, entry['uuid'])
+        for ip in ips:
+            self.fabric.cmd_raw(self.fabric.cli.key, ip,
+                                "source /etc/profile && ferry server -n",
+                                self.fabric.docker_user)
+        for c in entry['cleanup']:
+            cmd = "%s %s %s" % (self.fabric.cli.docker, self.fabric.cli.rm_cmd, c['container'])
+            if len(c['volumes']) > 0:
+                cmd += " && sudo -n rm -rf %s" % " ".join(c['volumes'])
+            _, err, success = self.fabric.cmd_raw(self.fabric.cli.key, c['ip'], cmd,
+                                                  self.launcher.ssh_user)
+            if not success:
+                logging.warning("could not clean up %s on %s" % (c['container'], c['ip']))
+        return self._mark_ready(entry, ips)
+
+    def _mark_ready(self, entry, ips):
+        for ip in ips:
+            if not self.fabric._verify_ferry_server(ip):
+                logging.error("warm server %s is not ready" % ip)
+                self._delete_entry(entry)
+                return False
+        self.entries.update( { 'uuid' : entry['uuid'] },
+                             { '$set' : { 'status' : 'ready',
+                                          'cleanup' : [],
+                                          'time' : time.time() } } )
+        logging.warning("warm servers %s are ready" % entry['uuid'])
+        return True
+
+class ContainerPool(object):
+    """
+    Keep idle, networked containers running on the local fabric so that
+    alloc can personalize an existing container instead of starting a new
+    one. The image, keys, and mounted directories can't be changed once a
+    container is running, so idle containers are grouped by those.
+
+    The pool is configured under the system section of the ferry config:
+
+      pool:
+        size: 2       # idle containers to keep for each group
+        ttl: 1800     # seconds a container may stay idle
+    """
+    def __init__(self, fabric, conf):
+        self.fabric = fabric
+        self.size = int(conf.get('size', 1))
+        self.ttl = int(conf.get('ttl', 1800))
+        self.lock = threading2.Lock()
+        self.idle = {}
+        self.replenishing = {}
+
+    def _get_template(self, c):
+        return { 'image' : c['image'],
+                 'keydir' : c['keydir'],
+                 'keyname' : c['keyname'],
+                 'exposed' : c['exposed'],
+                 'default_cmd' : c['default_cmd'],
+                 'mounts' : sorted(c['volumes'].values()) }
+
+    def claim(self, c):
+        """
+        Claim an idle container and personalize it (volumes, hostname) 
+        for this container description. Returns None if there are
+        no idle containers.
+        """
+        if 'netenable' in c:
+            return None
+
+        template = self._get_template(c)
+        key = json.dumps(template, sort_keys=True)
+        self.expire()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            entry = None
+            if len(idle) > 0:
+                entry = idle.pop(0)
+        self.replenish(key, template)
+        if not entry:
+            return None
+
+        # The idle container mounts directories owned by the pool. Move
+        # those directories to where the plan expects them. The bind mounts 
+        # follow the directories, so the container sees the same data. 
+        container = entry['container']
+        try:
+            for host_dir, container_dir in c['volumes'].items():
+                if os.path.isdir(host_dir):
+                    os.rmdir(host_dir)
+                os.rename(entry['mounts'][container_dir], host_dir)
+        except OSError as e:
+            logging.warning("could not claim idle container %s (%s)" % (container.container, str(e)))
+            self._destroy(entry)
+            return None
+        shutil.rmtree(entry['base'], ignore_errors=True)
+
+        container.host_name = c['hostname']
+        container.service_type = c['type']
+        container.args = c['args']
+        container.privatekey = c['privatekey']
+        container.volumes = c['volumes']
+        self.fabric.cmd([container], "hostname %s && echo %s > /etc/hostname" % (c['hostname'], c['hostname']))
+        logging.warning("claimed idle container %s for %s" % (container.container, c['hostname']))
+        return container
+
+    def replenish(self, key, template):
+        """
+        Bring the pool back up to size in the background.
+        """
+        with self.lock:
+            task = self.replenishing.get(key)
+            if task and not task.done():
+                return
+            self.replenishing[key] = BackgroundTask(self._replenish, key, template)
+
+    def _replenish(self, key, template):
+        try:
+            while len(self.idle.get(key, [])) < self.size:
+                entry = self._start_idle(template)
+                if not entry:
+                    break
+                with self.lock:
+                    self.idle.setdefault(key, []).append(entry)
+        except Exception as e:
+            logging.error("could not replenish container pool (%s)" % str(e))
+
+    def _start_idle(self, template):
+        """
+        Start a new idle container. 
+        """
+        pool_id = 'pool-' + str(uuid.uuid4()).split('-')[0]
+        base = os.path.join(self.fabric.get_data_dir(), 'pool', pool_id)
+        mounts = {}
+        volumes = {}
+        for i, d in enumerate(template['mounts']):
+            host_dir = os.path.join(base, 'vol%d' % i)
+            os.makedirs(host_dir)
+            mounts[d] = host_dir
+            volumes[host_dir] = d
+
+        ip = self.fabric.network.assign_ip(template)
+        container = self.fabric.cli.run(service_type = None,
+                                        image = template['image'],
+                                        volumes = volumes,
+                                        keydir = template['keydir'],
+                                        keyname = template['keyname'],
+                                        privatekey = None,
+                                        open_ports = [],
+                                        expose_group = template['exposed'],
+                                        hostname = pool_id,
+                                        default_cmd = template['default_cmd'],
+                                        lxc_opts = self.fabric._get_lxc_opts(ip),
+                                        inspector = self.fabric.inspector,
+                                        background = False)
+        if not container:
+            self.fabric.network.free_ip(ip)
+            shutil.rmtree(base, ignore_errors=True)
+            return None
+
+        container.default_user = self.fabric.docker_user
+        container.internal_ip = ip
+        container.external_ip = ip
+        self.fabric.network.set_owner(ip, container.container)
+
+        # Let the ssh server start so that the container is
+        # ready as soon as it is claimed. 
+        time.sleep(3)
+        return { 'container' : container,
+                 'mounts' : mounts,
+                 'base' : base,
+                 'time' : time.time() }
+
+    def _destroy(self, entry):
+        container = entry['container']
+        self.fabric.cli.stop(container.container)
+        self.fabric.cli.remove(container.container)
+        self.fabric.network.free_ip(container.internal_ip)
+        shutil.rmtree(entry['base'], ignore_errors=True)
+
+    def expire(self):
+        """
+        Remove containers that have been idle for too long.
+        """
+        deadline = time.time() - self.ttl
+        expired = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                expired += [e for e in idle if e['time'] < deadline]
+                self.idle[key] = [e for e in idle if e['time'] >= deadline]
+        for e in expired:
+            self._destroy(e)
+
+    def drain(self):
+        """
+        Remove all the idle containers.
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for key in idle.keys():
+            for e in idle[key]:
+                self._destroy(e)
@@ -0,0 +1,311 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from ferry.docker.docker import DockerCLI
+from ferry.docker.docker import DockerInspector
+from ferry.fabric.local import LocalFabric
+from ferry.config.system.info import System
+from ferry import tracing
+import ferry.install
+import json
+import logging
+import os
+import random
+import shlex
+import StringIO
+import threading2
+import time
+import uuid
+
+# Default latency (in seconds) of each simulated operation.
+# Docker commands are named after the sub-command.
+DEFAULT_LATENCIES = { 'run' : 1.0,
+                      'start' : 0.5,
+                      'stop' : 0.5,
+                      'rm' : 0.2,
+                      'commit' : 2.0,
+                      'inspect' : 0.05,
+                      'pull' : 10.0,
+                      'push' : 10.0,
+                      'boot' : 3.0,
+                      'restart' : 2.0,
+                      'ssh' : 0.2,
+                      'scp' : 0.3,
+                      'dhcp' : 0.005,
+                      'copy' : 0.5 }
+
+# Options of "docker run" that take a value.
+RUN_VALUE_FLAGS = ['-h', '-v', '-e', '-p', '-expose', '-lxc-conf', '--cidfile']
+
+class Simulation(object):
+    """
+    Latencies and failure rates of the simulated operations. Latencies
+    vary randomly by the jitter (i.e., 0.1 is +/- 10%) and are multiplied
+    by the scale, so that benchmarks can run faster than real time.
+    """
+    def __init__(self, latencies=None, failures=None, jitter=0.1, scale=1.0, seed=None):
+        self.latencies = dict(DEFAULT_LATENCIES)
+        if latencies:
+            self.latencies.update(latencies)
+        self.failures = failures or {}
+        self.jitter = jitter
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.lock = threading2.Lock()
+
+    def latency(self, op):
+        return self.latencies.get(op, 0) * self.scale
+
+    def wait(self, op):
+        """
+        Pretend to perform the operation. Returns False if the
+        operation should fail.
+        """
+        with self.lock:
+            self.counts[op] = self.counts.get(op, 0) + 1
+            delay = self.latency(op) * (1 + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.failures.get(op, 0)
+        if delay > 0:
+            time.sleep(delay)
+        return not failed
+
+class _SimulatedProcess(object):
+    """
+    Stand-in for a process that has already exited.
+    """
+    def __init__(self, out='', err=''):
+        self.stdout = StringIO.StringIO(out)
+        self.stderr = StringIO.StringIO(err)
+        self.returncode = 0
+
+class SimulatedCLI(DockerCLI):
+    """
+    Docker CLI that pretends to execute the commands. Containers
+    only exist in memory, but the commands are still constructed
+    and the output is parsed by the normal Docker code.
+    """
+    def __init__(self, simulation, registry=None):
+        super(SimulatedCLI, self).__init__(registry)
+        self.simulation = simulation
+        self.containers = {}
+        self.lock = threading2.Lock()
+
+    def _execute(self, cmd, server, user, read_output):
+        command = self._command_name(cmd)
+        success = self.simulation.wait(command)
+
+        out, err = '', ''
+        if command == 'run':
+            if success:
+                out = self._run(cmd)
+            else:
+                err = 'Unable to find image'
+        elif command == 'start':
+            out = self._start(cmd)
+        elif command == 'inspect':
+            out = self._inspect(cmd)
+        elif command == 'version':
+            out = '1.6.0'
+        elif command == 'info':
+            out = 'simulated'
+        elif command in ['stop', 'rm']:
+            self._stop(cmd, command == 'rm')
+        elif not success:
+            err = 'simulated %s failure' % command
+
+        if read_output:
+            return out, err
+        return _SimulatedProcess(out, err)
+
+    def _run(self, cmd):
+        args = shlex.split(cmd[len(self.docker):])[1:]
+        info = { 'image' : None,
+                 'hostname' : None,
+                 'lxc' : [],
+                 'running' : True }
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a in RUN_VALUE_FLAGS:
+                if a == '-h':
+                    info['hostname'] = args[i + 1]
+                elif a == '-lxc-conf':
+                    k, _, v = args[i + 1].partition('=')
+                    info['lxc'].append( { 'Key' : k.strip(),
+                                          'Value' : v.strip() } )
+                i += 2
+            elif a.startswith('-'):
+                i += 1
+            else:
+                info['image'] = a
+                break
+
+        container = uuid.uuid4().hex
+        with self.lock:
+            self.containers[container] = info
+        return container
+
+    def _start(self, cmd):
+        container = cmd.split()[-1]
+        with self.lock:
+            if not container in self.containers:
+                # The container was created before the
+                # server restarted, so just make one up.
+                self.containers[container] = { 'image' : None,
+                                               'hostname' : None,
+                                               'lxc' : [] }
+            self.containers[container]['running'] = True
+        return container
+
+    def _stop(self, cmd, remove):
+        container = cmd.split()[-1]
+        with self.lock:
+            if remove:
+                self.containers.pop(container, None)
+            elif container in self.containers:
+                self.containers[container]['running'] = False
+
+    def _inspect(self, cmd):
+        container = cmd.split()[-1]
+        with self.lock:
+            info = self.containers.get(container)
+        if not info:
+            return '[]'
+        return json.dumps([ { 'State' : { 'Running' : info['running'] },
+                              'Config' : { 'Image' : info['image'],
+                                           'Hostname' : info['hostname'],
+                                           'Cmd' : [] },
+                              'NetworkSettings' : { 'IPAddress' : '' },
+                              'HostConfig' : { 'LxcConf' : info['lxc'],
+                                               'PortBindings' : {} },
+                              'Volumes' : {} } ])
+
+class SimulatedNetwork(object):
+    """
+    In-memory replacement for the DHCP client.
+    """
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.next_ip = 2
+        self.next_port = 1000
+        self.free_ips = []
+        self.rules = {}
+        self.lock = threading2.Lock()
+
+    @tracing.traced('dhcp.assign_ip')
+    def assign_ip(self, container):
+        self.simulation.wait('dhcp')
+        with self.lock:
+            if len(self.free_ips) > 0:
+                return self.free_ips.pop(0)
+            ip = self.next_ip
+            self.next_ip += 1
+        return '10.%d.%d.%d' % (ip / 65536 % 256, ip / 256 % 256, ip % 256)
+
+    def reserve_ip(self, ip):
+        self.simulation.wait('dhcp')
+
+    def set_owner(self, ip, container):
+        self.simulation.wait('dhcp')
+
+    def random_port(self):
+        self.simulation.wait('dhcp')
+        with self.lock:
+            self.next_port += 1
+            return str(self.next_port)
+
+    @tracing.traced('dhcp.forward_rule')
+    def forward_rule(self, source_ip, source_port, dest_ip, dest_port):
+        self.simulation.wait('dhcp')
+        with self.lock:
+            self.rules[(dest_ip, dest_port)] = (source_ip, source_port)
+
+    def delete_rule(self, dest_ip, dest_port):
+        self.simulation.wait('dhcp')
+        with self.lock:
+            self.rules.pop((dest_ip, dest_port), None)
+
+    def clean_rules(self):
+        with self.lock:
+            self.rules = {}
+
+    def stop_ip(self, ip):
+        self.simulation.wait('dhcp')
+
+    def free_ip(self, ip):
+        self.simulation.wait('dhcp')
+        with self.lock:
+            self.free_ips.append(ip)
+
+class SimulatedFabric(LocalFabric):
+    """
+    A fabric that doesn't start any real containers. It behaves like
+    the local fabric, except that Docker commands, the DHCP server and
+    ssh are simulated with configurable latencies and failure rates.
+    This is used to benchmark the Ferry server without Docker. The
+    simulation is configured in the "simulate" section of the system
+    configuration (latency, failures, jitter, scale, seed).
+    """
+    def __init__(self, bootstrap=False):
+        self.name = "simulated"
+        self.repo = 'public'
+        self.bootstrap = bootstrap
+        self.system = System()
+        self.pool = None
+
+        conf = ferry.install.read_ferry_config()
+        params = conf['system'].get('simulate', {})
+        self.simulation = Simulation(latencies = params.get('latency'),
+                                     failures = params.get('failures'),
+                                     jitter = params.get('jitter', 0.1),
+                                     scale = params.get('scale', 1.0),
+                                     seed = params.get('seed'))
+        self.cli = SimulatedCLI(self.simulation, ferry.install.DOCKER_REGISTRY)
+        self.docker_user = self.cli.docker_user
+        self.inspector = DockerInspector(self.cli)
+        self.network = SimulatedNetwork(self.simulation)
+
+        # Wait for the simulated ssh servers to start.
+        self.RUN_WAIT = self.simulation.latency('boot')
+        self.RESTART_WAIT = self.simulation.latency('restart')
+
+    def _get_lxc_opts(self, ip):
+        return ["lxc.network.type = veth",
+                "lxc.network.ipv4 = %s/24" % ip]
+
+    def installed_images(self):
+        return []
+
+    def copy_raw(self, key, ip, from_dir, to_dir, user):
+        if key:
+            with tracing.span('robust_com', cmd='scp %s %s' % (from_dir, ip)):
+                if not self.simulation.wait('scp'):
+                    logging.error("could not communicate")
+
+    def cmd_raw(self, key, ip, cmd, user):
+        if key:
+            with tracing.span('robust_com', cmd=cmd[:120]):
+                if not self.simulation.wait('ssh'):
+                    logging.error("could not communicate")
+        return ''
+
+    def _copy_volume(self, src, dst, parent=None):
+        self.simulation.wait('copy')
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+
+    def _get_dir_fs(self, path):
+        return 'simulated'
@@ -0,0 +1,130 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading2
+import time
+
+READY = "ready"
+FAILED = "failed"
+
+class BatchPoller(object):
+    """
+    Fetch the status of many cloud resources in one round of API calls.
+    Stacks are provisioned concurrently, so every thread waiting on a
+    resource of the same kind shares the result of the last round instead
+    of making its own.
+
+    The fetch function takes a list of IDs and returns a dictionary
+    from ID to status (READY, FAILED, or None if still pending).
+    """
+    def __init__(self, fetch, min_interval=1.0):
+        self.fetch = fetch
+        self.min_interval = min_interval
+        self.lock = threading2.Lock()
+        self.pending = set()
+        self.statuses = {}
+        self.last_fetch = 0
+
+    def poll(self, ids):
+        with self.lock:
+            self.pending.update(ids)
+            stale = time.time() - self.last_fetch >= self.min_interval
+            missing = [i for i in ids if not i in self.statuses]
+            if stale or len(missing) > 0:
+                try:
+                    self.statuses.update(self.fetch(list(self.pending)))
+                finally:
+                    self.last_fetch = time.time()
+            return dict([(i, self.statuses.get(i)) for i in ids])
+
+    def forget(self, ids):
+        """
+        Stop fetching the status of these resources.
+        """
+        with self.lock:
+            for i in ids:
+                self.pending.discard(i)
+                self.statuses.pop(i, None)
+
+class Waiter(object):
+    """
+    Wait for a set of cloud resources to become ready. The polling interval
+    starts small, since many resources are ready quickly, and backs off
+    so that long waits don't flood the cloud API.
+    """
+    def __init__(self, poller, name, initial=1.0, maximum=10.0, factor=1.5, timeout=1800):
+        self.poller = poller
+        self.name = name
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.timeout = timeout
+
+    def wait(self, ids, progress=None):
+        """
+        Wait for all the resources. The optional progress function is called
+        with the pending IDs after every poll (i.e., to report stack events).
+        Returns a dictionary from ID to True if the resource is ready
+        and False if it failed or timed out.
+        """
+        results = {}
+        pending = list(ids)
+        interval = self.initial
+        start = time.time()
+        while len(pending) > 0:
+            try:
+                statuses = self.poller.poll(pending)
+            except Exception as e:
+                logging.error("could not fetch %s status (%s)" % (self.name, str(e)))
+                statuses = {}
+
+            for i in pending:
+                if statuses.get(i) == READY:
+                    results[i] = True
+                elif statuses.get(i) == FAILED:
+                    logging.warning("%s %s failed" % (self.name, str(i)))
+                    results[i] = False
+            done = [i for i in pending if i in results]
+            self.poller.forget(done)
+            pending = [i for i in pending if not i in results]
+
+            if progress and len(pending) > 0:
+                progress(pending)
+
+            elapsed = time.time() - start
+            if len(pending) > 0:
+                if self.timeout and elapsed > self.timeout:
+                    logging.error("timed out waiting for %s %s" % (self.name, str(pending)))
+                    for i in pending:
+                        results[i] = False
+                    self.poller.forget(pending)
+                    break
+
+                logging.info("waiting for %d %s (%d finished, %ds elapsed)" % (len(pending),
+                                                                            self.name,
+                                                                            len(ids) - len(pending),
+                                                                            elapsed))
+                time.sleep(interval)
+                interval = min(interval * self.factor, self.maximum)
+        return results
+
+    def wait_all(self, ids, progress=None):
+        """
+        Wait for all the resources and return True only if
+        every one of them is ready.
+        """
+        results = self.wait(ids, progress)
+        return all(results.values())
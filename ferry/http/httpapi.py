@@ -15,19 +15,21 @@
 
 import json
 import logging
-from flask import Flask, request
+from flask import Flask, request, Response
 import ferry.install
 from ferry.install import Installer
 from ferry.docker.manager import DockerManager
 from ferry.docker.docker import DockerInstance
+from ferry import metrics, tracing
 import os
 import Queue
 import sys
 import threading2
 import time
-from tornado.wsgi import WSGIContainer
+from ferry.http.wsgi import ThreadedWSGIContainer, StackEventsHandler
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.web import Application, FallbackHandler
 
 
 # Initialize Flask
@@ -37,25 +39,95 @@ app = Flask(__name__)
 installer = Installer()
 docker = DockerManager()
 
+# Server metrics. 
+QUEUE_DEPTH = metrics.Gauge('ferry_queue_depth',
+                            'Number of requests waiting for the stack worker')
+QUEUE_WAIT_SECONDS = metrics.Histogram('ferry_queue_wait_seconds',
+                                       'Time requests wait before the stack worker picks them up',
+                                       labels=('action',))
+BUILD_SECONDS = metrics.Histogram('ferry_stack_build_seconds',
+                                  'Time spent building stacks',
+                                  labels=('action', 'stack', 'status'),
+                                  buckets=(5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600))
+
+def _enqueue(payload):
+    """
+    Hand the request to the stack worker. 
+    """
+    payload["_queued"] = time.time()
+    _new_queue.put(payload)
+
 def _stack_worker():
     """
     Worker thread.
     """
     while(True):
         payload = _new_queue.get()
-
-        if payload["_action"] == "new":
-            _allocate_new_worker(payload["_uuid"], payload)
-        elif payload["_action"] == "stopped":
-            _allocate_stopped_worker(payload)
-        elif payload["_action"] == "snapshotted":
-            _allocate_snapshot_worker(payload["_uuid"], payload)
-        elif payload["_action"] == "manage":
-            _manage_stack_worker(payload["_uuid"], payload["_manage"], payload["_key"])
+        QUEUE_WAIT_SECONDS.observe(time.time() - payload.pop("_queued"), 
+                                   action=payload["_action"])
+
+        # Never let a failed request stop the worker, 
+        # since every other request would then wait forever. 
+        try:
+            if payload["_action"] == "manage":
+                _manage_stack_worker(payload["_uuid"], payload["_manage"], payload["_key"])
+            elif payload["_action"] == "manage_batch":
+                docker.manage_stacks(payload["_uuids"], payload["_key"], payload["_manage"])
+            else:
+                _build_stack_worker(payload)
+        except Exception:
+            logging.exception("could not handle %s request" % payload["_action"])
             
         time.sleep(2)
 
+def _stack_type(payload):
+    """
+    New stacks are labelled by their application. Stopped and
+    snapshotted stacks are referred to by uuid, so just use the action. 
+    """
+    if payload["_action"] == "new":
+        return payload["_file"]
+    return payload["_action"]
+
+def _build_stack_worker(payload):
+    """
+    Build a new, stopped, or snapshotted stack, and record
+    whether it succeeded in the stack's progress events. 
+    """
+    uuid = payload.get("_uuid", payload["_file"])
+    reply = None
+    status = 'failed'
+    start = time.time()
+    tracing.start_trace(uuid)
+    try:
+        with tracing.span('build', action=payload["_action"]):
+            if payload["_action"] == "new":
+                reply = _allocate_new_worker(uuid, payload)
+            elif payload["_action"] == "stopped":
+                reply = _allocate_stopped_worker(payload)
+            elif payload["_action"] == "snapshotted":
+                reply = _allocate_snapshot_worker(uuid, payload)
+        if reply and json.loads(reply)['status'] == 'ok':
+            status = 'running'
+    except Exception as e:
+        logging.exception("could not build stack %s" % uuid)
+        try:
+            docker._update_stack(uuid, { 'status' : 'failed' })
+        except Exception:
+            logging.exception("could not mark stack %s as failed" % uuid)
+        docker.events.finish(uuid, 'failed', error=str(e))
+        return
+    finally:
+        docker.save_trace(uuid, tracing.end_trace(uuid))
+        BUILD_SECONDS.observe(time.time() - start,
+                              action = payload["_action"],
+                              stack = _stack_type(payload),
+                              status = status)
+
+    docker.events.finish(uuid, status)
+
 _new_queue = Queue.Queue()
+QUEUE_DEPTH.set_function(_new_queue.qsize)
 _new_stack_worker = threading2.Thread(target=_stack_worker)
 _new_stack_worker.daemon = True
 _new_stack_worker.start()
@@ -100,7 +172,121 @@ def _fetch_num_instances(instance_arg):
 
     return reply
 
-def _allocate_compute(cluster_uuid, computes, key_name, storage_uuid):
+def _storage_params(storage):
+    """
+    Read the storage parameters from the stack description. 
+    """
+    reply = _fetch_num_instances(storage['instances'])
+    storage['instances'] = reply['num']
+    params = { 'storage_type' : storage['personality'],
+               'num_instances' : reply['num'],
+               'layers' : [],
+               'args' : None }
+    if 'layers' in storage:
+        params['layers'] = storage['layers']
+    if 'args' in storage:
+        params['args'] = storage['args']
+    return params
+
+def _compute_params(compute):
+    """
+    Read the compute parameters from the stack description. 
+    """
+    reply = _fetch_num_instances(compute['instances'])
+    compute['instances'] = reply['num']
+    params = { 'compute_type' : compute['personality'],
+               'num_instances' : reply['num'],
+               'layers' : [],
+               'args' : {} }
+    if 'layers' in compute:
+        params['layers'] = compute['layers']
+    if 'args' in compute:
+        params['args'] = compute['args']
+    return params
+
+def _connector_params(connector):
+    """
+    Read the connector parameters from the stack description. There
+    is one set of parameters for each connector instance. 
+    """
+    # Check number of instances.
+    num_instances = 1
+    if 'instances' in connector:
+        num_instances = int(connector['instances'])
+
+    instances = []
+    for i in range(num_instances):
+        # Connector names are created by the user 
+        # to help identify particular instances. 
+        if 'name' in connector:
+            connector_name = connector['name']
+            if num_instances > 1:
+                connector_name = connector_name + "-" + str(i)
+        else:
+            connector_name = None
+
+        # Arguments are optional parameters defined by
+        # the user and passed to the connectors.
+        if 'args' in connector:
+            args = connector['args']
+        else:
+            args = {}
+
+        # The user can choose to expose ports on the connectors.
+        if 'ports' in connector:
+            ports = connector['ports']
+        else:
+            ports = []
+
+        instances.append( { 'connector_type' : connector['personality'],
+                            'name' : connector_name,
+                            'args' : args,
+                            'ports' : ports } )
+    return instances
+
+def _reserve_stack(cluster_uuid, payload, key_name, reservations):
+    """
+    Reserve the machines for every service in the stack up front. On
+    cloud fabrics this starts creating all the stacks concurrently instead
+    of waiting for each service before starting the next. The reservations
+    are added as they are made, so that they can be released if a later
+    one fails. 
+    """
+    if 'backend' in payload:
+        for b in payload['backend']:
+            params = _storage_params(b['storage'])
+            r = docker.reserve_storage(cluster_uuid = cluster_uuid,
+                                       key_name = key_name, 
+                                       replace = True,
+                                       **params)
+            reservations['storage'].append(r)
+            reservations['all'].append(r)
+
+            computes = []
+            if 'compute' in b:
+                for c in b['compute']:
+                    params = _compute_params(c)
+                    r = docker.reserve_compute(cluster_uuid = cluster_uuid,
+                                               key_name = key_name, 
+                                               **params)
+                    computes.append(r)
+                    reservations['all'].append(r)
+            reservations['compute'].append(computes)
+
+    if 'connectors' in payload:
+        for c in payload['connectors']:
+            instances = []
+            for params in _connector_params(c):
+                r = docker.reserve_connector(cluster_uuid = cluster_uuid,
+                                             key_name = key_name, 
+                                             image = None,
+                                             **params)
+                instances.append(r)
+                reservations['all'].append(r)
+            reservations['connectors'].append(instances)
+    return reservations
+
+def _allocate_compute(cluster_uuid, computes, key_name, storage_uuid, reservations=None):
     """
     Allocate a new compute backend. This method assumes that every
     compute backend already has a specific instance count associated
@@ -109,26 +295,18 @@ def _allocate_compute(cluster_uuid, computes, key_name, storage_uuid):
     """
     uuids = []
     compute_plan = []
-    for c in computes:
-        compute_type = c['personality']
-        reply = _fetch_num_instances(c['instances'])
-        num_instances = reply['num']
-        c['instances'] = num_instances
-        args = {}
-        if 'args' in c:
-            args = c['args']
-
-        layers = []
-        if 'layers' in c:
-            layers = c['layers']
+    for i, c in enumerate(computes):
+        params = _compute_params(c)
+        compute_type = params['compute_type']
+        reservation = None
+        if reservations:
+            reservation = reservations[i]
 
         compute_uuid, compute_containers = docker.allocate_compute(cluster_uuid = cluster_uuid,
-                                                                   compute_type = compute_type,
                                                                    key_name = key_name,
                                                                    storage_uuid = storage_uuid, 
-                                                                   args = args, 
-                                                                   num_instances = num_instances,
-                                                                   layers = layers)
+                                                                   reservation = reservation,
+                                                                   **params)
         if compute_uuid:
             compute_plan.append( { 'uuid' : compute_uuid,
                                    'containers' : compute_containers,
@@ -167,7 +345,8 @@ def _allocate_backend(cluster_uuid,
                       backends=None,
                       replace=False,
                       uuid=None,
-                      new_stack = True):
+                      new_stack = True,
+                      reservations = None):
     """
     Allocate a brand new backend
     """
@@ -192,27 +371,20 @@ def _allocate_backend(cluster_uuid,
     # Go ahead and create the actual backend stack. If the user has passed in
     # an existing backend UUID, that means we should restart that backend. Otherwise
     # we create a fresh backend. 
-    for b in backends:
+    for i, b in enumerate(backends):
         storage = b['storage']
         if new_stack:
-            args = None
-            if 'args' in storage:
-                args = storage['args']
-            storage_type = storage['personality']
-            reply = _fetch_num_instances(storage['instances'])
-            num_instances = reply['num']
-            storage['instances'] = num_instances
-            layers = []
-            if 'layers' in storage:
-                layers = storage['layers']
+            params = _storage_params(storage)
+            storage_type = params['storage_type']
+            reservation = None
+            if reservations:
+                reservation = reservations['storage'][i]
 
             storage_uuid, storage_containers = docker.allocate_storage(cluster_uuid = cluster_uuid,
-                                                                       storage_type = storage_type, 
                                                                        key_name = key_name, 
-                                                                       num_instances = num_instances,
-                                                                       layers = layers,
-                                                                       args = args,
-                                                                       replace = replace)
+                                                                       replace = replace,
+                                                                       reservation = reservation,
+                                                                       **params)
 
             if storage_uuid:
                 storage_plan.append( { 'uuid' : storage_uuid,
@@ -242,10 +414,14 @@ def _allocate_backend(cluster_uuid,
         compute_uuid = []
         if 'compute' in b:
             if not uuid:
+                compute_reservations = None
+                if reservations:
+                    compute_reservations = reservations['compute'][i]
                 compute_uuid, plan = _allocate_compute(cluster_uuid = cluster_uuid,
                                                        computes = b['compute'], 
                                                        key_name = key_name, 
-                                                       storage_uuid = storage_uuid) 
+                                                       storage_uuid = storage_uuid,
+                                                       reservations = compute_reservations) 
 
                 if compute_uuid:
                     compute_uuids += compute_uuid
@@ -265,17 +441,12 @@ def _allocate_backend(cluster_uuid,
     return backend_info, { 'storage' : storage_plan,
                            'compute' : compute_plan }
 
-def _allocate_connectors(cluster_uuid, payload, key_name, backend_info):
+def _allocate_connectors(cluster_uuid, payload, key_name, backend_info, reservations=None):
     connector_info = []
     connector_plan = []
     if 'connectors' in payload:
         connectors = payload['connectors']
-        for c in connectors:
-            # Check number of instances.
-            num_instances = 1
-            if 'instances' in c:
-                num_instances = int(c['instances'])
-
+        for j, c in enumerate(connectors):
             # Check if this connector type has already been pulled
             # into the local index. If not, manually pull it. 
             connector_type = c['personality']
@@ -284,37 +455,17 @@ def _allocate_connectors(cluster_uuid, payload, key_name, backend_info):
                 # finishing, just return an error.
                 return False, connector_info, None
 
-            for i in range(num_instances):
-                # Connector names are created by the user 
-                # to help identify particular instances. 
-                if 'name' in c:
-                    connector_name = c['name']
-                    if num_instances > 1:
-                        connector_name = connector_name + "-" + str(i)
-                else:
-                    connector_name = None
-
-                # Arguments are optional parameters defined by
-                # the user and passed to the connectors.
-                if 'args' in c:
-                    args = c['args']
-                else:
-                    args = {}
-
-                # The user can choose to expose ports on the connectors.
-                if 'ports' in c:
-                    ports = c['ports']
-                else:
-                    ports = []
+            for i, params in enumerate(_connector_params(c)):
+                reservation = None
+                if reservations:
+                    reservation = reservations['connectors'][j][i]
 
                 # Now allocate the connector. 
                 uuid, containers = docker.allocate_connector(cluster_uuid = cluster_uuid,
-                                                             connector_type = connector_type,
                                                              key_name = key_name, 
                                                              backend = backend_info, 
-                                                             name = connector_name, 
-                                                             args = args,
-                                                             ports = ports)
+                                                             reservation = reservation,
+                                                             **params)
                 if uuid:
                     connector_plan.append( { 'uuid' : uuid,
                                              'containers' : containers,
@@ -386,7 +537,7 @@ def _register_ip_addresses(backend_plan, connector_plan):
     if private_key:
         docker._transfer_ip(private_key, ips)
 
-def _start_all_services(backend_plan, connector_plan):
+def _start_all_services(backend_plan, connector_plan, cluster_uuid=None):
     """
     Helper function to start both the backend and
     frontend. Depending on the plan, this will either
@@ -396,6 +547,7 @@ def _start_all_services(backend_plan, connector_plan):
     # Make sure that all the hosts have the current set
     # of IP addresses. 
     _register_ip_addresses(backend_plan, connector_plan)
+    docker.events.emit(cluster_uuid, 'addresses_registered')
 
     # Now we need to start/restart all the services. 
     for s in backend_plan['storage']:
@@ -404,12 +556,14 @@ def _start_all_services(backend_plan, connector_plan):
                                  s['containers'])
         else:
             docker._restart_service(s['uuid'], s['containers'], s['type'])
+        docker.events.emit(cluster_uuid, 'service_started', service=s['uuid'], type=s['type'])
 
     for c in backend_plan['compute']:
         if c['start'] == 'start':
             docker.start_service(c['uuid'], c['containers'])
         else:
             docker._restart_service(c['uuid'], c['containers'], c['type'])
+        docker.events.emit(cluster_uuid, 'service_started', service=c['uuid'], type=c['type'])
 
     # The connectors can optionally output msgs for the user.
     # Collect them so that we can display them later. 
@@ -421,6 +575,7 @@ def _start_all_services(backend_plan, connector_plan):
         else:
             output = docker._restart_connectors(c['uuid'], c['containers'], c['backend'])
             all_output = dict(all_output.items() + output.items())
+        docker.events.emit(cluster_uuid, 'service_started', service=c['uuid'], type=c['type'])
     return all_output
 
 def _allocate_new(payload, key_name):
@@ -434,13 +589,19 @@ def _allocate_new(payload, key_name):
         values = docker.resolver.resolve(payload['questions'])
         payload = docker.resolver.replace(payload, values)
 
+    # Start pulling the connector images now so that
+    # creating the connectors doesn't have to wait for them. 
+    if 'connectors' in payload:
+        installer.prefetch_images([c['personality'] for c in payload['connectors']])
+
     # Now allocate the backend. This includes both storage and compute. 
     reply = {}
     uuid = docker.reserve_stack()
     payload["_action"] = "new"
     payload["_uuid"] = str(uuid)
     payload["_key"] = key_name
-    _new_queue.put(payload)
+    docker.events.start(uuid)
+    _enqueue(payload)
     docker.register_stack(backends = { 'uuids':[] }, 
                           connectors = [], 
                           base = payload['_file'], 
@@ -466,14 +627,61 @@ def _allocate_new_worker(uuid, payload):
     """
     Helper function to allocate and start a new stack. 
     """
-    reply = {}
     key_name = payload['_key']
+    reservations = { 'storage' : [],
+                     'compute' : [], 
+                     'connectors' : [],
+                     'all' : [] }
+    try:
+        return _allocate_reserved(uuid, payload, key_name, reservations)
+    except Exception:
+        # The other services may already be provisioned, so 
+        # make sure that nothing is left running. 
+        exc_info = sys.exc_info()
+        logging.info("cancelling services...")
+        try:
+            backend_info, connector_info = _reserved_services(reservations)
+            _cancel_stack(uuid, backend_info, connector_info, payload['_file'])
+            docker.release_reservations(uuid, reservations['all'], claimed=True)
+        except Exception:
+            logging.exception("could not cancel stack %s" % uuid)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+def _reserved_services(reservations):
+    """
+    The services that were reserved for a stack, in the same 
+    form as the backend and connector info. 
+    """
+    backend_info = { 'uuids' : [] }
+    for i, s in enumerate(reservations['storage']):
+        compute = []
+        if i < len(reservations['compute']):
+            compute = [c['uuid'] for c in reservations['compute'][i]]
+        backend_info['uuids'].append( { 'storage' : s['uuid'],
+                                        'compute' : compute } )
+
+    connector_info = []
+    for instances in reservations['connectors']:
+        connector_info += [c['uuid'] for c in instances]
+    return backend_info, connector_info
+
+def _allocate_reserved(uuid, payload, key_name, reservations):
+    """
+    Reserve the machines for the stack, then allocate and 
+    start the services. 
+    """
+    reply = {}
+    logging.info("reserving machines...")
+    _reserve_stack(uuid, payload, key_name, reservations)
+    docker.events.emit(uuid, 'reserved', instances=len(reservations['all']))
+
     logging.info("creating backend...")
     backend_info, backend_plan = _allocate_backend(cluster_uuid = uuid,
                                                    payload = payload, 
                                                    key_name = key_name,
                                                    replace=True,
-                                                   new_stack=True)
+                                                   new_stack=True,
+                                                   reservations=reservations)
     # Check if the backend status was ok, and if so,
     # go ahead and allocate the connectors. 
     reply['status'] = backend_info['status']
@@ -482,11 +690,12 @@ def _allocate_new_worker(uuid, payload):
         success, connector_info, connector_plan = _allocate_connectors(cluster_uuid = uuid,
                                                                        payload = payload, 
                                                                        key_name = key_name, 
-                                                                       backend_info = backend_info['uuids'])
+                                                                       backend_info = backend_info['uuids'],
+                                                                       reservations = reservations)
 
         if success:
             logging.info("starting services...")
-            output = _start_all_services(backend_plan, connector_plan)
+            output = _start_all_services(backend_plan, connector_plan, uuid)
             docker.register_stack(backends = backend_info, 
                                   connectors = connector_info, 
                                   base = payload['_file'], 
@@ -500,9 +709,11 @@ def _allocate_new_worker(uuid, payload):
         else:
             # One or more connectors was not instantiated properly. 
             logging.info("cancelling services...")
+            docker.release_reservations(uuid, reservations['all'])
             _cancel_stack(uuid, backend_info, connector_info, payload['_file'])
             reply['status'] = 'failed'
     else:
+        docker.release_reservations(uuid, reservations['all'])
         _cancel_stack(uuid, backend_info, [], payload['_file'])
         reply['status'] = 'failed'
 
@@ -513,7 +724,8 @@ def _allocate_stopped(payload):
     stack = docker.get_stack(uuid)
     payload["_action"] = "stopped"
     payload["_key"] = stack['key']
-    _new_queue.put(payload)
+    docker.events.start(uuid)
+    _enqueue(payload)
     docker.register_stack(backends = stack['backends'], 
                           connectors = stack['connectors'],
                           base = stack['base'],
@@ -538,7 +750,7 @@ def _allocate_stopped_worker(payload):
         connector_info, connector_plan = _allocate_connectors_from_stopped(payload = payload, 
                                                                            backend_info = backend_info['uuids'])
         logging.info("starting services...")
-        output = _start_all_services(backend_plan, connector_plan)
+        output = _start_all_services(backend_plan, connector_plan, uuid)
         docker.register_stack(backends = backend_info,
                               connectors = connector_info,
                               base = stack['base'],
@@ -561,7 +773,8 @@ def _allocate_snapshot(payload, key_name):
     payload["_action"] = "snapshotted"
     payload["_uuid"] = str(uuid)
     payload["_key"] = key_name
-    _new_queue.put(payload)
+    docker.events.start(uuid)
+    _enqueue(payload)
     docker.register_stack(backends = { 'uuids':[] }, 
                           connectors = [], 
                           base = payload['_file'], 
@@ -581,11 +794,18 @@ def _allocate_snapshot_worker(uuid, payload):
                                                                  payload = payload,
                                                                  key_name = key_name)
     if backend_info['status'] == 'ok':
+        # In clone mode, the storage starts with a copy-on-write
+        # copy of the snapshot data instead of empty directories. 
+        if payload.get('_clone'):
+            logging.info("cloning snapshot data...")
+            if not docker.clone_snapshot_volumes(payload['_file'], backend_plan['storage']):
+                logging.warning("starting %s without the snapshot data" % uuid)
+
         connector_info, connector_plan = _allocate_connectors_from_snapshot(cluster_uuid = uuid,
                                                                             payload = payload, 
                                                                             key_name = key_name,                                                                            
                                                                             backend_info = backend_info['uuids'])
-        output = _start_all_services(backend_plan, connector_plan)
+        output = _start_all_services(backend_plan, connector_plan, uuid)
         docker.register_stack(backends = backend_info, 
                               connectors = connector_info, 
                               base = payload['_file'],
@@ -639,28 +859,39 @@ def login_registry():
 @app.route('/image', methods=['POST'])
 def push_image():
     """
-    Push a local image to a remote registry. 
+    Push a local image to a remote registry. The push happens
+    in the background, so this returns the job. 
     """
     image = request.form['image']
     if 'server' in request.form:
         registry = request.form['server']
     else:
         registry = None
-    if docker.push_image(image, registry):
-        return "success"
-    else:
-        return "fail"
+    return json.dumps(docker.submit_push(image, registry))
 
 @app.route('/image', methods=['GET'])
 def pull_image():
     """
-    Pull a remote image to the local registry. 
+    Pull a remote image to the local registry. The pull happens
+    in the background, so this returns the job. 
     """
     image = request.args['image']
-    if docker.pull_image(image):
-        return "success"
+    return json.dumps(docker.submit_pull(image))
+
+@app.route('/image/job', methods=['GET'])
+def image_job():
+    """
+    Fetch the progress of an image push/pull, or
+    of all the recent jobs if no id is given. 
+    """
+    if 'id' in request.args:
+        job = docker.image_job(request.args['id'])
+        if not job:
+            job = { 'id' : request.args['id'],
+                    'status' : 'unknown' }
+        return json.dumps(job)
     else:
-        return "fail"
+        return json.dumps(docker.image_job())
     
 @app.route('/create', methods=['POST'])
 def allocate_stack():
@@ -692,13 +923,29 @@ def quit():
 @app.route('/query', methods=['GET'])
 def query_stacks():
     """
-    Query the stacks.
+    Query the stacks. Optionally select the 'fields' and 'status'
+    (comma separated), 'sort' by a field ('-' for descending), 'limit'
+    the number of stacks, or only return the stacks updated 'since'
+    a time (the largest 'updated' value of a previous reply). 
     """
+    constraints = None
     if 'constraints' in request.args:
         constraints = json.loads(request.args['constraints'])
-        return docker.query_stacks(constraints)
-    else:
-        return docker.query_stacks()
+
+    fields = None
+    if 'fields' in request.args:
+        fields = request.args['fields'].split(',')
+
+    status = None
+    if 'status' in request.args:
+        status = request.args['status'].split(',')
+
+    return docker.query_stacks(constraints,
+                               fields = fields,
+                               status = status,
+                               sort = request.args.get('sort'),
+                               limit = request.args.get('limit', type=int),
+                               since = request.args.get('since', type=float))
 
 @app.route('/snapshots', methods=['GET'])
 def snapshots():
@@ -710,14 +957,12 @@ def snapshots():
 @app.route('/apps', methods=['GET'])
 def apps():
     """
-    Get list of installed applications.
+    Get list of installed applications, optionally 
+    filtered by name, tag, or author. 
     """
-    if 'app' in request.args:
-        app = request.args['app']
-    else:
-        app = None
-
-    return docker.query_applications(app)
+    return docker.query_applications(request.args.get('app'),
+                                     request.args.get('tag'),
+                                     request.args.get('author'))
 
 @app.route('/images', methods=['GET'])
 def images():
@@ -751,11 +996,50 @@ def inspect():
 @app.route('/logs', methods=['GET'])
 def logs():
     """
-    Copy over logs
+    Copy over logs. If a directory is given, the logs are copied
+    into that directory on the server. Otherwise the logs are streamed
+    back as a compressed tar. 
     """
     stack_uuid = request.args['uuid']
-    to_dir = request.args['dir']
-    return docker.copy_logs(stack_uuid, to_dir)
+    if 'dir' in request.args:
+        return docker.copy_logs(stack_uuid, request.args['dir'])
+
+    filters = {}
+    if 'types' in request.args:
+        filters['types'] = request.args['types'].split(',')
+    if 'glob' in request.args:
+        filters['glob'] = request.args['glob']
+    for f in ['since', 'until', 'tail']:
+        if f in request.args:
+            try:
+                filters[f] = int(request.args[f])
+            except ValueError:
+                return "invalid %s value" % f, 400
+    return Response(docker.stream_logs(stack_uuid, filters), 
+                    mimetype='application/x-gzip')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Export the server metrics in the Prometheus text format. 
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route('/stack/trace', methods=['GET'])
+def stack_trace():
+    """
+    Fetch the timings of the last build of a stack. If the stack
+    is still being built, return the timings so far. 
+    """
+    uuid = request.args['uuid']
+    trace = tracing.get_trace(uuid)
+    if not trace:
+        trace = docker.get_trace(uuid)
+    if not trace:
+        return json.dumps({ 'uuid' : uuid,
+                            'status' : 'failed',
+                            'msg' : 'no timings for ' + uuid })
+    return json.dumps(trace)
 
 @app.route('/manage/stack', methods=['POST'])
 def manage_stack():
@@ -766,9 +1050,31 @@ def manage_stack():
                 "_manage" : request.form['action'],
                 "_key" : request.form['key'],
                 "_action" : "manage" }
-    _new_queue.put(payload)
+    _enqueue(payload)
     return ""
 
+@app.route('/manage/stacks', methods=['POST'])
+def manage_stacks():
+    """
+    Manage many stacks at once. The stacks are listed in 'uuids' 
+    and/or selected by the 'constraints' (like /query). Returns the 
+    stacks that will be managed. 
+    """
+    uuids = json.loads(request.form.get('uuids', '[]'))
+    if 'constraints' in request.form:
+        constraints = json.loads(request.form['constraints'])
+        for uuid in docker.find_stacks(constraints):
+            if not uuid in uuids:
+                uuids.append(uuid)
+
+    if len(uuids) > 0:
+        payload = { "_uuids" : uuids,
+                    "_manage" : request.form['action'],
+                    "_key" : request.form['key'],
+                    "_action" : "manage_batch" }
+        _enqueue(payload)
+    return json.dumps(uuids)
+
 def _manage_stack_worker(uuid, action, private_key):
     """
     Manage the stacks.
@@ -794,7 +1100,18 @@ def after_request(response):
     return response
 
 if __name__ == '__main__':
-    http_server = HTTPServer(WSGIContainer(app))
+    # Fetch the connector images of the installed applications
+    # in the background while the server starts up. 
+    installer.prefetch_app_images()
+
+    # Requests are handled by a pool of threads (the "workers" in 
+    # the web configuration) so that slow requests don't block others. 
+    # Clients waiting for stack events are served on the IOLoop instead. 
+    workers, _, _ = installer._get_worker_info()
+    container = ThreadedWSGIContainer(app, workers)
+    application = Application([ (r'/stack/events', StackEventsHandler, dict(events=docker.events)),
+                                (r'.*', FallbackHandler, dict(fallback=container)) ])
+    http_server = HTTPServer(application)
     http_server.listen(port=int(sys.argv[2]),
                        address=sys.argv[1])
     IOLoop.instance().start()
@@ -0,0 +1,189 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import datetime
+import json
+import logging
+import Queue
+import threading2
+import tornado
+from tornado import escape
+from tornado import gen
+from tornado import httputil
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+from tornado.wsgi import WSGIContainer
+
+class ThreadedWSGIContainer(WSGIContainer):
+    """
+    Run a WSGI application on a pool of worker threads. The plain
+    WSGIContainer runs the application on the IOLoop thread, so a slow
+    request (i.e., pulling an image) blocks every other client. Here the
+    IOLoop only handles the network, and responses are streamed back as
+    the application produces them.
+    """
+    def __init__(self, wsgi_application, workers=8):
+        super(ThreadedWSGIContainer, self).__init__(wsgi_application)
+        self.requests = Queue.Queue()
+        self.threads = []
+        for i in range(max(int(workers), 1)):
+            t = threading2.Thread(target=self._serve)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __call__(self, request):
+        self.requests.put( (IOLoop.current(), request) )
+
+    def _serve(self):
+        while True:
+            io_loop, request = self.requests.get()
+            try:
+                self._handle(io_loop, request)
+            except Exception as e:
+                logging.exception("could not handle %s %s" % (request.method, request.uri))
+                io_loop.add_callback(request.connection.close)
+
+    def _on_loop(self, io_loop, func, *args):
+        """
+        Call the function on the IOLoop thread and wait for it
+        (and the write it returns) to finish. Returns False if the
+        client has gone away.
+        """
+        done = threading2.Event()
+        result = { 'ok' : True }
+
+        def finished(future):
+            if future.exception():
+                result['ok'] = False
+            done.set()
+
+        def call():
+            try:
+                future = func(*args)
+            except Exception as e:
+                logging.warning("could not write response (%s)" % str(e))
+                result['ok'] = False
+                future = None
+
+            if future:
+                future.add_done_callback(finished)
+            else:
+                done.set()
+
+        io_loop.add_callback(call)
+        done.wait()
+        return result['ok']
+
+    def _handle(self, io_loop, request):
+        data = {}
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            data["status"] = status
+            data["headers"] = response_headers
+            return response.append
+
+        app_response = self.wsgi_application(WSGIContainer.environ(request), start_response)
+        try:
+            if not data:
+                raise Exception("WSGI app did not call start_response")
+
+            status_code, reason = data["status"].split(' ', 1)
+            status_code = int(status_code)
+            headers = data["headers"]
+            header_set = set(k.lower() for (k, v) in headers)
+
+            # Responses with a known length are sent in one piece. Streaming
+            # responses (i.e., logs) are sent as they are produced. 
+            chunks = iter(app_response)
+            body = b"".join(response)
+            streaming = "content-length" not in header_set and not isinstance(app_response, list)
+            if not streaming:
+                body += b"".join(chunks)
+            body = escape.utf8(body)
+
+            if status_code != 304:
+                if not streaming and "content-length" not in header_set:
+                    headers.append(("Content-Length", str(len(body))))
+                if "content-type" not in header_set:
+                    headers.append(("Content-Type", "text/html; charset=UTF-8"))
+            if "server" not in header_set:
+                headers.append(("Server", "TornadoServer/%s" % tornado.version))
+
+            start_line = httputil.ResponseStartLine("HTTP/1.1", status_code, reason)
+            header_obj = httputil.HTTPHeaders()
+            for key, value in headers:
+                header_obj.add(key, value)
+
+            ok = self._on_loop(io_loop, request.connection.write_headers, start_line, header_obj, body)
+            if ok and streaming:
+                for chunk in chunks:
+                    chunk = escape.utf8(chunk)
+                    if chunk and not self._on_loop(io_loop, request.connection.write, chunk):
+                        # The client went away, so stop producing output. 
+                        break
+        finally:
+            if hasattr(app_response, "close"):
+                app_response.close()
+
+        def finish():
+            request.connection.finish()
+            self._log(status_code, request)
+        self._on_loop(io_loop, finish)
+
+class StackEventsHandler(RequestHandler):
+    """
+    Fetch the progress events of a stack that come after the 'after'
+    sequence number. If there are no new events, wait up to 'timeout'
+    seconds for one to arrive. The request waits on the IOLoop instead
+    of a worker thread, so clients following their stacks don't keep
+    the workers from serving other requests.
+    """
+    MAX_TIMEOUT = 30
+
+    def initialize(self, events):
+        self.events = events
+
+    @gen.coroutine
+    def get(self):
+        uuid = self.get_argument('uuid')
+        after = int(self.get_argument('after', 0))
+        timeout = min(float(self.get_argument('timeout', 0)), self.MAX_TIMEOUT)
+
+        io_loop = IOLoop.current()
+        changed = Future()
+        def notify(uuid):
+            io_loop.add_callback(lambda: changed.done() or changed.set_result(True))
+
+        # Listen before looking at the events, so that
+        # an event can't arrive in between unnoticed. 
+        self.events.listen(uuid, notify)
+        try:
+            events, finished = self.events.wait(uuid, after)
+            if len(events) == 0 and not finished and timeout > 0:
+                try:
+                    yield gen.with_timeout(datetime.timedelta(seconds=timeout), changed)
+                except gen.TimeoutError:
+                    pass
+                events, finished = self.events.wait(uuid, after)
+        finally:
+            self.events.unlisten(uuid, notify)
+
+        self.set_header('Access-Control-Allow-Origin', '*')
+        self.write(json.dumps({ 'uuid' : uuid,
+                                'events' : events,
+                                'finished' : finished }))
@@ -14,6 +14,7 @@
 #
 
 import base64
+import errno
 import ferry
 import grp
 import hashlib
@@ -28,13 +29,16 @@ import shutil
 import stat
 import struct
 import sys
+import threading2
 import time
 import uuid
 import yaml
 from distutils import spawn
 from ferry.ip.client import DHCPClient
 from ferry.config.mongo.mongoconfig import *
+from ferry.docker.catalog import load_app
 from ferry.fabric.local import LocalFabric
+from ferry.workers import WorkerPool, BackgroundTask, default_workers
 from string import Template
 from subprocess import Popen, PIPE
 
@@ -124,7 +128,7 @@ def _supported_tuple(tuple_string, tuple_min):
     cleaned = []
     tuples = tuple_string.split(".")[:3]
     for t in tuples: 
-        m = re.compile('(\d)*').match(t)
+        m = re.compile('(\d+)').match(t)
         if m and len(m.groups()) > 0 and m.group(1) != '':
             cleaned.append(m.group(1))
         else:
@@ -216,6 +220,10 @@ DEFAULT_MONGO_DB=DOCKER_DIR + '/mongo'
 DEFAULT_MONGO_LOG=DOCKER_DIR + '/mongolog'
 DEFAULT_REGISTRY_DB=DOCKER_DIR + '/registry'
 DEFAULT_DOCKER_LOG=DOCKER_DIR + '/docker.log'
+DEFAULT_BASE_IMAGE='ubuntu:14.04'
+DEFAULT_IMAGE_WORKERS=4
+DEFAULT_MANAGE_WORKERS=8
+IMAGE_HASH_LABEL='ferry.hash'
 
 def _recursive_merge(dict1, dict2):
     """
@@ -260,6 +268,11 @@ class Installer(object):
         self.cli = cli
         self.config = read_ferry_config()
 
+        # Images that are being fetched in the background. 
+        self.fetches = {}
+        self.fetch_lock = threading2.Lock()
+        self.print_lock = threading2.Lock()
+
     def get_ferry_account(self):
         """
         Get the Ferry authentication information. 
@@ -329,7 +342,7 @@ class Installer(object):
             # We want to be selective about which images
             # to rebuild. Useful if one image breaks, etc. 
             to_build = self.check_images(DEFAULT_IMAGE_DIR,
-                                         DEFAULT_DOCKER_REPO)
+                                         DEFAULT_DOCKER_REPO, build)
             if len(to_build) > 0:
                 logging.warning("performing select rebuild (%s)" % str(to_build))
                 self.build_from_list(to_build, 
@@ -410,7 +423,63 @@ class Installer(object):
                 not_installed.append(i)
         return not_installed
 
+    def prefetch_images(self, images):
+        """
+        Start pulling any missing images in the background so that
+        they are (hopefully) available by the time a stack needs them. 
+        """
+        with self.fetch_lock:
+            for image in set(images):
+                if image in self.fetches and not self.fetches[image].done():
+                    continue
+                self.fetches[image] = BackgroundTask(self._prefetch_image, image)
+
+    def _prefetch_image(self, image_name):
+        if not self._check_image_installed(image_name):
+            logging.warning("prefetching image " + image_name)
+            self._pull_image(image_name, on_client=False)
+
+    def prefetch_app_images(self):
+        """
+        Prefetch the connector images used by the installed applications. 
+        """
+        images = []
+        for app_dir in [DEFAULT_BUILTIN_APPS, DEFAULT_FERRY_APPS]:
+            if not os.path.isdir(app_dir):
+                continue
+            for root, dirs, files in os.walk(app_dir):
+                for f in files:
+                    images += self._get_app_images(os.path.join(root, f))
+        self.prefetch_images(images)
+        return images
+
+    def _get_app_images(self, app_file):
+        try:
+            app = load_app(app_file)
+            if app is None:
+                return []
+        except Exception as e:
+            logging.warning("could not read application %s (%s)" % (app_file, str(e)))
+            return []
+
+        images = []
+        if isinstance(app, dict) and isinstance(app.get('connectors'), list):
+            for c in app['connectors']:
+                if isinstance(c, dict) and 'personality' in c:
+                    images.append(c['personality'])
+        return images
+
     def _check_and_pull_image(self, image_name):
+        # If the image is already being fetched, just wait for
+        # that to finish instead of pulling it again. 
+        with self.fetch_lock:
+            task = self.fetches.pop(image_name, None)
+        if task:
+            try:
+                task.wait()
+            except Exception as e:
+                logging.warning("could not prefetch %s (%s)" % (image_name, str(e)))
+
         if not self._check_image_installed(image_name):
             self._pull_image(image_name, on_client=False)
 
@@ -632,7 +701,7 @@ class Installer(object):
     """
     Check if the dockerfiles are already built. 
     """
-    def check_images(self, image_dir, repo):
+    def check_images(self, image_dir, repo, build=False):
         if self._docker_running():
             build_images = []
             for f in os.listdir(image_dir):
@@ -640,6 +709,13 @@ class Installer(object):
                 image_names = self._check_dockerfile(dockerfile, repo)
                 if len(image_names) > 0:
                     build_images += image_names
+
+            # When building locally, also rebuild the images
+            # whose inputs have changed since they were built. 
+            if build:
+                for image in self._check_stale_images(image_dir, repo):
+                    if not image in build_images:
+                        build_images.append(image)
             return build_images
         else:
             logging.error("ferry daemon not started")
@@ -649,23 +725,19 @@ class Installer(object):
     """
     def build_from_list(self, to_build, image_dir, repo, build=False, recurse=True):
         if self._docker_running():
-            built_images = {}
             for f in os.listdir(image_dir):
                 logging.warning("transforming dockerfile")
                 self._transform_dockerfile(image_dir, f, repo)
 
-            for f in os.listdir("/tmp/dockerfiles/"):
-                dockerfile = '/tmp/dockerfiles/' + f + '/Dockerfile'
-                images = self._get_image(dockerfile)
-                intersection = [i for i in images if i in to_build]
-                if len(intersection) > 0:
-                    image = images.pop(0)
-                    logging.warning("building image " + image)
-                    self._build_image(image, dockerfile, repo, built_images, recurse=recurse, build=build)
+            nodes = self._read_image_graph("/tmp/dockerfiles")
+            levels = self._plan_images(nodes, to_build, recurse)
 
-                    if len(images) > 0:
-                        logging.warning("tagging images " + image)
-                        self._tag_images(image, repo, images)
+            # Base images that were only included because of the
+            # recursion can be skipped if they haven't changed. 
+            required = set([i for l in levels for i in l 
+                            if i in to_build or
+                            any(a in to_build for a in nodes[i]['alternatives'])])
+            self._fetch_images(nodes, levels, repo, build, required=required)
 
             # After building everything, get rid of the temp dir.
             shutil.rmtree("/tmp/dockerfiles")
@@ -677,24 +749,250 @@ class Installer(object):
     """
     def build_from_dir(self, image_dir, repo, build=False):
         if self._docker_running():
-            built_images = {}
             for f in os.listdir(image_dir):
                 self._transform_dockerfile(image_dir, f, repo)
-            for f in os.listdir("/tmp/dockerfiles/"):
-                dockerfile = "/tmp/dockerfiles/" + f + "/Dockerfile"
-                images = self._get_image(dockerfile)
-                image = images.pop(0)
-                self._build_image(image, dockerfile, repo, built_images, recurse=True, build=build)
 
-                if len(images) > 0:
-                    logging.warning("tagging images " + image)
-                    self._tag_images(image, repo, images)
+            nodes = self._read_image_graph("/tmp/dockerfiles")
+            levels = self._plan_images(nodes)
+            self._fetch_images(nodes, levels, repo, build)
 
             # After building everything, get rid of the temp dir.
             # shutil.rmtree("/tmp/dockerfiles")
         else:
             logging.error("ferry daemon not started")
 
+    def _check_stale_images(self, image_dir, repo):
+        """
+        Find the images built from an older version of their inputs. 
+        Since the hash of an image includes the hash of its base, 
+        the descendants of a changed image are stale too. Images 
+        without a hash (i.e., pulled images) are never stale. 
+        """
+        for f in os.listdir(image_dir):
+            self._transform_dockerfile(image_dir, f, repo)
+
+        stale = []
+        nodes = self._read_image_graph("/tmp/dockerfiles")
+        for image in sorted(nodes.keys()):
+            installed = self._get_image_hash("%s/%s" % (repo, image))
+            if installed and installed != nodes[image]['hash']:
+                logging.warning("image %s has changed" % image)
+                stale.append(image)
+        return stale
+
+    def _read_image_graph(self, dockerfile_dir):
+        """
+        Read the name, alternative names, base image, and 
+        content hash of every Dockerfile in the directory. 
+        """
+        nodes = {}
+        for f in sorted(os.listdir(dockerfile_dir)):
+            dockerfile = dockerfile_dir + '/' + f + '/Dockerfile'
+            if not os.path.exists(dockerfile):
+                continue
+            images = self._get_image(dockerfile)
+            if len(images) > 0:
+                nodes[images[0]] = { 'dockerfile' : dockerfile,
+                                     'dir' : f, 
+                                     'base' : self._get_base(dockerfile),
+                                     'alternatives' : images[1:] }
+
+        # Base images may be referred to by any of their names
+        # or by the name of their directory. The parent is the
+        # base image if we also build it, and None otherwise. 
+        names = self._image_names(nodes)
+        for node in nodes.values():
+            node['parent'] = names.get(node['base'])
+        self._hash_images(nodes)
+        return nodes
+
+    def _hash_images(self, nodes):
+        """
+        Hash each image directory together with the hash of its base, 
+        so that changing an image changes the hash of all its descendants. 
+        """
+        def _hash(image):
+            node = nodes[image]
+            if not 'hash' in node:
+                h = hashlib.sha1(self._hash_inputs(os.path.dirname(node['dockerfile'])))
+                if node['parent'] and node['parent'] != image:
+                    h.update(_hash(node['parent']))
+                else:
+                    h.update(node['base'] or '')
+                node['hash'] = h.hexdigest()
+            return node['hash']
+
+        for image in nodes.keys():
+            _hash(image)
+
+    def _image_names(self, nodes):
+        names = {}
+        for image, node in nodes.items():
+            names[node['dir']] = image
+            for a in node['alternatives']:
+                names[a] = image
+            names[image] = image
+        return names
+
+    def _plan_images(self, nodes, to_build=None, recurse=True):
+        """
+        Group the images into levels using the FROM dependency graph. 
+        Images in the same level don't depend on each other, so they
+        can be pulled or built at the same time. 
+        """
+        if to_build is None:
+            selected = set(nodes.keys())
+        else:
+            names = self._image_names(nodes)
+            selected = set([names[i] for i in to_build if i in names])
+            if recurse:
+                parents = list(selected)
+                while len(parents) > 0:
+                    base = nodes[parents.pop()]['parent']
+                    if base and not base in selected:
+                        selected.add(base)
+                        parents.append(base)
+
+        levels = []
+        done = set()
+        remaining = sorted(selected)
+        while len(remaining) > 0:
+            level = []
+            for image in remaining:
+                base = nodes[image]['parent']
+                if not base in selected or base in done:
+                    level.append(image)
+            if len(level) == 0:
+                logging.error("circular image dependencies " + str(remaining))
+                level = remaining
+            levels.append(level)
+            done.update(level)
+            remaining = [i for i in remaining if not i in done]
+        return levels
+
+    def _fetch_images(self, nodes, levels, repo, build=False, required=None):
+        """
+        Pull or build each level of images concurrently. If the set of
+        required images is given, then other images are only built when
+        their hash changed since they were last built. 
+        """
+        # Builds are CPU bound, while pulls mostly wait on the network. 
+        if build:
+            pool = WorkerPool(default_workers())
+        else:
+            pool = WorkerPool(DEFAULT_IMAGE_WORKERS)
+
+        # The root image is shared by most images, so only pull it once. 
+        images = [i for level in levels for i in level]
+        if any(nodes[i]['base'] == DEFAULT_BASE_IMAGE for i in images):
+            self._pull_image(DEFAULT_BASE_IMAGE)
+
+        start = time.time()
+        timings = {}
+        for level in levels:
+            logging.warning("fetching images " + str(level))
+            prefixed = len(level) > 1
+            fetch = lambda image: self._fetch_image(nodes, image, repo, build, prefixed, 
+                                                    timings, required)
+            pool.map(fetch, level)
+        self._log_build_timings(nodes, timings, time.time() - start)
+
+    def _fetch_image(self, nodes, image, repo, build, prefixed, timings, required=None):
+        node = nodes[image]
+        image_dir = os.path.dirname(node['dockerfile'])
+
+        # Skip images that are already built from the same inputs. 
+        # The hash includes the base images, so if a base image
+        # was rebuilt, this image will be rebuilt too. 
+        if build:
+            if required is not None and not image in required:
+                if self._get_image_hash("%s/%s" % (repo, image)) == node['hash']:
+                    logging.warning("skipping unchanged image " + image)
+                    timings[image] = None
+                    return
+            self._label_dockerfile(node['dockerfile'], node['hash'])
+
+        start = time.time()
+        prefix = None
+        if prefixed:
+            prefix = image
+        self._compile_image(image, repo, image_dir, build, prefix)
+        if len(node['alternatives']) > 0:
+            logging.warning("tagging images " + image)
+            self._tag_images(image, repo, node['alternatives'])
+        timings[image] = time.time() - start
+
+    def _hash_inputs(self, image_dir):
+        """
+        Hash the contents of the image directory (Dockerfile, scripts, etc.)
+        so that we can tell if an image needs to be rebuilt. 
+        """
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(image_dir):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                h.update(os.path.relpath(path, image_dir) + '\0')
+                if os.path.isfile(path):
+                    with open(path, 'rb') as content:
+                        for chunk in iter(lambda: content.read(65536), ''):
+                            h.update(chunk)
+                h.update('\0')
+        return h.hexdigest()
+
+    def _label_dockerfile(self, dockerfile, digest):
+        """
+        Record the hash as an image label. Labels need Docker 1.6, 
+        so older versions just rebuild the image every time. 
+        """
+        _, version = _get_docker_version()
+        if version < (1, 6, 0):
+            return
+        with open(dockerfile, 'a') as f:
+            f.write("\nLABEL %s=%s\n" % (IMAGE_HASH_LABEL, digest))
+
+    def _get_image_hash(self, image_name):
+        cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' inspect %s 2> /dev/null' % image_name
+        output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
+        try:
+            labels = json.loads(output)[0]['Config'].get('Labels')
+        except (ValueError, IndexError, KeyError, TypeError):
+            return None
+        if labels:
+            return labels.get(IMAGE_HASH_LABEL)
+        return None
+
+    def _log_build_timings(self, nodes, timings, total):
+        """
+        Report the time taken by each image and by the longest
+        chain of images (the critical path), since that bounds how
+        fast the images can be built in parallel. 
+        """
+        paths = {}
+        def _path(image):
+            if not image in paths:
+                elapsed = timings.get(image) or 0
+                chain = [image]
+                base = nodes[image]['parent']
+                if base in timings:
+                    base_elapsed, base_chain = _path(base)
+                    elapsed += base_elapsed
+                    chain = base_chain + chain
+                paths[image] = (elapsed, chain)
+            return paths[image]
+
+        for image in sorted(timings.keys()):
+            if timings[image] is None:
+                logging.warning("  %s: skipped" % image)
+            else:
+                logging.warning("  %s: %.1fs" % (image, timings[image]))
+
+        if len(timings) > 0:
+            critical, chain = max([_path(i) for i in timings.keys()])
+            serial = sum([t for t in timings.values() if t])
+            logging.warning("fetched %d images in %.1fs (%.1fs serial, critical path %.1fs: %s)" % 
+                            (len(timings), total, serial, critical, " -> ".join(chain)))
+
     def _docker_running(self):
         return os.path.exists('/var/run/ferry.sock')
 
@@ -717,8 +1015,11 @@ class Installer(object):
         return not_installed
 
     def _transform_dockerfile(self, image_dir, f, repo):
-        if not os.path.exists("/tmp/dockerfiles/" + f):
-            shutil.copytree(image_dir + '/' + f, '/tmp/dockerfiles/' + f)
+        # Always start from a fresh copy, otherwise edits to the
+        # image directory would not be picked up. 
+        if os.path.exists("/tmp/dockerfiles/" + f):
+            shutil.rmtree("/tmp/dockerfiles/" + f)
+        shutil.copytree(image_dir + '/' + f, '/tmp/dockerfiles/' + f)
     
         out_file = "/tmp/dockerfiles/" + f + "/Dockerfile"
         out = open(out_file, "w+")
@@ -732,20 +1033,6 @@ class Installer(object):
             out.write(s)
         out.close()
 
-    def _build_image(self, image, f, repo, built_images, recurse=False, build=False):
-        base = self._get_base(f)
-        if recurse and base != "ubuntu:14.04":
-            image_dir = os.path.dirname(os.path.dirname(f))
-            dockerfile = image_dir + '/' + base + '/Dockerfile'
-            self._build_image(base, dockerfile, repo, built_images, recurse, build)
-
-        if not image in built_images:
-            if base == "ubuntu:14.04":
-                self._pull_image(base)
-
-            built_images[image] = True
-            self._compile_image(image, repo, os.path.dirname(f), build)
-
     def _get_image(self, dockerfile):
         names = []
         for l in open(dockerfile, 'r'):
@@ -766,31 +1053,58 @@ class Installer(object):
                     return base[-1]
         return base
 
-    def _continuous_print(self, process, on_client=True):
+    def _continuous_print(self, process, on_client=True, prefix=None):
+        """
+        Stream the output of the process. When several processes run at
+        the same time, each line is printed whole with a prefix
+        so that the output doesn't get jumbled. 
+        """
+        fd = process.stdout.fileno()
+        pending = ''
+        logged = False
         while True:
             try:
-                out = process.stdout.read(15)
-                if out == '':
-                    break
-                else:
-                    if on_client:
-                        sys.stdout.write(out)
-                        sys.stdout.flush()
-                    else:
-                        logging.warning("downloading image...")
-            except IOError as e:
+                out = os.read(fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
                 logging.warning(e)
+                break
+            if out == '':
+                break
+
+            if not on_client:
+                if not logged:
+                    logging.warning("downloading image...")
+                    logged = True
+            elif not prefix:
+                sys.stdout.write(out)
+                sys.stdout.flush()
+            else:
+                lines = (pending + out).split('\n')
+                pending = lines.pop()
+                self._print_lines(lines, prefix)
+        if on_client and prefix and pending != '':
+            self._print_lines([pending], prefix)
 
         try:
-            errmsg = process.stderr.readline()
+            errmsg = process.stderr.read()
             if errmsg and errmsg != '':
                 logging.warning(errmsg)
             else:
                 logging.warning("downloaded image!")
         except IOError:
             pass
+        process.wait()
+
+    def _print_lines(self, lines, prefix):
+        if len(lines) > 0:
+            with self.print_lock:
+                for l in lines:
+                    sys.stdout.write("[%s] %s\n" % (prefix, l.rstrip('\r')))
+                sys.stdout.flush()
 
-    def _pull_image(self, image, tag=None, on_client=True):
+    def _pull_image(self, image, tag=None, on_client=True, prefix=None):
         if not tag:
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' pull %s' % image
         else:
@@ -798,7 +1112,7 @@ class Installer(object):
 
         logging.warning(cmd)
         child = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-        self._continuous_print(child, on_client=on_client)
+        self._continuous_print(child, on_client=on_client, prefix=prefix)
 
         # Now tag the image with the 'latest' tag. 
         if tag and tag != 'latest':
@@ -806,13 +1120,13 @@ class Installer(object):
             logging.warning(cmd)
             Popen(cmd, stdout=PIPE, shell=True)
         
-    def _compile_image(self, image, repo, image_dir, build=False):
+    def _compile_image(self, image, repo, image_dir, build=False, prefix=None):
         # Now build the image. 
         if build:
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' build --rm=true -t' + ' %s/%s %s' % (repo, image, image_dir)
             logging.warning(cmd)
             child = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-            self._continuous_print(child)
+            self._continuous_print(child, prefix=prefix)
 
             # Now tag the image. 
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' tag' + ' %s/%s %s/%s:%s' % (repo, image, repo, image, ferry.__version__)
@@ -821,7 +1135,7 @@ class Installer(object):
         else:
             # Just pull the image from the public repo. 
             image_name = "%s/%s" % (repo, image)
-            self._pull_image(image_name, tag=ferry.__version__)
+            self._pull_image(image_name, tag=ferry.__version__, prefix=prefix)
 
     def _tag_images(self, image, repo, alternatives):
         for a in alternatives:
@@ -16,6 +16,7 @@
 import json
 import logging
 import requests
+from ferry import tracing
 
 DHCP_SERVER = 'http://localhost:5000'
 class DHCPClient(object):
@@ -24,25 +25,30 @@ class DHCPClient(object):
             payload = { 'cidr' : cidr_block }
             res = requests.post(DHCP_SERVER + '/cidr', data=payload)
 
+    @tracing.traced('dhcp.assign_ip')
     def assign_ip(self, container):
         payload = { 'container' : json.dumps(container) }
         res = requests.get(DHCP_SERVER + '/ip', params=payload)
         j = json.loads(res.text)
         return j['ip']
 
+    @tracing.traced('dhcp.reserve_ip')
     def reserve_ip(self, ip):
         payload = { 'ip' : ip }
         res = requests.put(DHCP_SERVER + '/ip', data=payload)
 
+    @tracing.traced('dhcp.set_owner')
     def set_owner(self, ip, container):
         payload = { 'args' : json.dumps({ 'ip' : ip,
                                           'container' : container}) }
         requests.post(DHCP_SERVER + '/node', data=payload)
 
+    @tracing.traced('dhcp.random_port')
     def random_port(self):
         res = requests.get(DHCP_SERVER + '/port')
         return res.text
 
+    @tracing.traced('dhcp.forward_rule')
     def forward_rule(self, source_ip, source_port, dest_ip, dest_port):
         payload = { 'src_ip' : source_ip,
                     'src_port' : source_port,
@@ -50,18 +56,22 @@ class DHCPClient(object):
                     'dest_port' : dest_port }
         requests.post(DHCP_SERVER + '/port', data={'args': json.dumps(payload)})
 
+    @tracing.traced('dhcp.delete_rule')
     def delete_rule(self, dest_ip, dest_port):
         payload = { 'dest_ip' : dest_ip,
                     'dest_port' : dest_port }
         requests.delete(DHCP_SERVER + '/port', data={'args': json.dumps(payload)})
 
+    @tracing.traced('dhcp.clean_rules')
     def clean_rules(self):
         requests.delete(DHCP_SERVER + '/ports')
 
+    @tracing.traced('dhcp.stop_ip')
     def stop_ip(self, ip):
         payload = { 'ip' : ip }
         requests.post(DHCP_SERVER + '/ip', data=payload)
 
+    @tracing.traced('dhcp.free_ip')
     def free_ip(self, ip):
         payload = { 'ip' : ip }
         requests.delete(DHCP_SERVER + '/ip', data=payload)
@@ -16,8 +16,9 @@
 import json
 import logging
 import os
-from flask import Flask, request
+from flask import Flask, request, Response
 from pymongo import MongoClient
+from ferry import metrics
 from ferry.ip.nat import NAT
 import sys
 from tornado.wsgi import WSGIContainer
@@ -50,8 +51,8 @@ class DHCP(object):
 
     def _init_state_db(self):
         self.mongo = MongoClient(os.environ['MONGODB'], 27017, connectTimeoutMS=6000)
-        self.dhcp_collection = self.mongo['network']['dhcp']
-        self.cidr_collection = self.mongo['network']['cidr']
+        self.dhcp_collection = metrics.TimedCollection(self.mongo['network']['dhcp'])
+        self.cidr_collection = metrics.TimedCollection(self.mongo['network']['cidr'])
 
         cidr = self.cidr_collection.find_one()
         if cidr:
@@ -186,6 +187,16 @@ class DHCP(object):
         self.dhcp_collection.update( { 'ip' : ip },
                                      { '$set' : self.ips[ip] } )
 
+    def ip_usage(self):
+        """
+        Count the IP addresses by status (active, stopped, free). 
+        """
+        usage = {}
+        for v in self.ips.values():
+            key = (v['status'],)
+            usage[key] = usage.get(key, 0) + 1
+        return usage
+
     def set_owner(self, ip, container):
         """
         Set the owner of this IP address. 
@@ -194,9 +205,28 @@ class DHCP(object):
         self.dhcp_collection.update( { 'ip' : ip },
                                      { '$set' : { 'container' : container}} )
 
-dhcp = DHCP()
+# The DHCP state is created when the server starts, so that
+# importing this module doesn't require Mongo or iptables. 
+dhcp = None
 app = Flask(__name__)
 
+# Pool utilization metrics. 
+metrics.Gauge('ferry_ip_pool_size',
+              'Number of addresses in the network').set_function(lambda: dhcp.num_addrs)
+metrics.Gauge('ferry_ip_addresses',
+              'Number of addresses handed out, by status',
+              labels=('status',)).set_function(lambda: dhcp.ip_usage())
+metrics.Gauge('ferry_ip_reserved',
+              'Number of addresses taken out of commission').set_function(lambda: len(dhcp.reserved_ips))
+metrics.Gauge('ferry_nat_ports_allocated',
+              'Number of ports used by forwarding rules').set_function(lambda: dhcp.nat.ports_allocated())
+metrics.Gauge('ferry_nat_rules',
+              'Number of port forwarding rules').set_function(lambda: dhcp.nat.num_rules())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
 @app.route('/cidr', methods=['POST'])
 def assign_cidr():
     cidr = request.form['cidr']
@@ -255,6 +285,7 @@ def set_owner():
     return ""
 
 if __name__ == '__main__':
+    dhcp = DHCP()
     http_server = HTTPServer(WSGIContainer(app))
     http_server.listen(port=int(sys.argv[2]),
                        address=sys.argv[1])
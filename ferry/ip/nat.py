@@ -16,6 +16,7 @@
 import logging
 import os
 from pymongo import MongoClient
+from ferry import metrics
 from subprocess import Popen, PIPE
 
 class NAT(object):
@@ -29,7 +30,7 @@ class NAT(object):
         
     def _init_state_db(self):
         self.mongo = MongoClient(os.environ['MONGODB'], 27017, connectTimeoutMS=6000)
-        self.nat_collection = self.mongo['network']['nat']
+        self.nat_collection = metrics.TimedCollection(self.mongo['network']['nat'])
 
 
     def _clear_nat(self):
@@ -92,6 +93,15 @@ class NAT(object):
             if not port in self.reserved_ports:
                 return str(port)
 
+    def ports_allocated(self):
+        """
+        Number of ports used by the forwarding rules. 
+        """
+        return len(self.nat_collection.distinct('src_port'))
+
+    def num_rules(self):
+        return self.nat_collection.count()
+
     def has_rule(self, dest_ip, dest_port):
         rule = self.nat_collection.find_one( { 'ip' : dest_ip,
                                                'port' : dest_port } )
@@ -0,0 +1,303 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading2
+import time
+
+# Content type of the Prometheus text format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets (in seconds). These cover everything
+# from a quick Mongo lookup to a slow image pull.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Registry(object):
+    """
+    All the metrics exported by this process.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading2.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Render all the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+
+        lines = []
+        for m in metrics:
+            lines.append("# HELP %s %s" % (m.name, m.doc))
+            lines.append("# TYPE %s %s" % (m.name, m.kind))
+            for name, labels, value in m.samples():
+                lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def render():
+    return REGISTRY.render()
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (k, v))
+    return '{' + ','.join(pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+class _Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading2.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.labels):
+            raise ValueError("%s expects labels %s" % (self.name, str(self.labels)))
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def _label_pairs(self, key, extra=()):
+        return tuple(zip(self.labels, key)) + tuple(extra)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(self.name, self._label_pairs(k), v) for k, v in items]
+
+class Counter(_Metric):
+    """
+    A value that only goes up (i.e., number of commands run).
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down (i.e., queue depth). Gauges can also
+    be computed when the metrics are collected by setting a function.
+    Functions of labelled gauges return a dictionary keyed by the
+    tuple of label values.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), registry=REGISTRY):
+        super(Gauge, self).__init__(name, doc, labels, registry)
+        self.func = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, func):
+        self.func = func
+
+    def samples(self):
+        if not self.func:
+            return super(Gauge, self).samples()
+
+        try:
+            value = self.func()
+        except Exception as e:
+            logging.warning("could not collect %s (%s)" % (self.name, str(e)))
+            return []
+
+        if not self.labels:
+            return [(self.name, (), value)]
+        return [(self.name, self._label_pairs(k), v) for k, v in sorted(value.items())]
+
+class Histogram(_Metric):
+    """
+    The distribution of a value (i.e., command latency).
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(name, doc, labels, registry)
+        self.buckets = tuple(float(b) for b in sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if not entry:
+                entry = { 'counts' : [0] * len(self.buckets),
+                          'sum' : 0.0 }
+                self.values[key] = entry
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][i] += 1
+                    break
+            entry['sum'] += value
+
+    def time(self, **labels):
+        """
+        Observe the duration of a block of code.
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, (list(v['counts']), v['sum'])) for k, v in self.values.items())
+
+        samples = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                self._label_pairs(key, [('le', _format_value(bound))]),
+                                cumulative))
+            samples.append((self.name + '_sum', self._label_pairs(key), total))
+            samples.append((self.name + '_count', self._label_pairs(key), cumulative))
+        return samples
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+# Metrics shared by the Ferry server and the DHCP server.
+SSH_COMMANDS = Counter('ferry_ssh_commands_total',
+                       'Number of remote commands run',
+                       labels=('status',))
+SSH_RETRIES = Counter('ferry_ssh_retries_total',
+                      'Number of times a remote command was retried after a connection error')
+SSH_SECONDS = Histogram('ferry_ssh_command_seconds',
+                        'Time spent running remote commands, including retries')
+DOCKER_SECONDS = Histogram('ferry_docker_command_seconds',
+                           'Time spent running Docker commands',
+                           labels=('command',))
+MONGO_SECONDS = Histogram('ferry_mongo_operation_seconds',
+                          'Time spent in Mongo operations',
+                          labels=('collection', 'operation'))
+
+class TimedCollection(object):
+    """
+    Wrap a Mongo collection so that the latency of each
+    operation is recorded. The query of a "find" only runs once
+    its cursor is read, so the cursor is timed as well. 
+    """
+    def __init__(self, collection):
+        self._collection = collection
+        self._name = collection.name
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        if name == 'find':
+            def timed_find(*args, **kwargs):
+                start = time.time()
+                cursor = attr(*args, **kwargs)
+                return _TimedCursor(cursor, self._name, time.time() - start)
+            return timed_find
+
+        def timed(*args, **kwargs):
+            with MONGO_SECONDS.time(collection=self._name, operation=name):
+                return attr(*args, **kwargs)
+        return timed
+
+class _TimedCursor(object):
+    """
+    Wrap a Mongo cursor so that the time spent creating and reading it
+    is recorded as a single "find" once all the results are read. 
+    """
+    def __init__(self, cursor, name, elapsed):
+        self._cursor = cursor
+        self._name = name
+        self._elapsed = elapsed
+        self._observed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        done = False
+        try:
+            return self._cursor.next()
+        except StopIteration:
+            done = True
+            raise
+        finally:
+            self._elapsed += time.time() - start
+            if done:
+                self._observe()
+
+    __next__ = next
+
+    def close(self):
+        self._observe()
+        return self._cursor.close()
+
+    def _observe(self):
+        if not self._observed:
+            self._observed = True
+            MONGO_SECONDS.observe(self._elapsed, collection=self._name, operation='find')
+
+    def __getitem__(self, index):
+        result = self._cursor[index]
+        if result is self._cursor:
+            return self
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        # Keep timing the cursor through chained calls (i.e., sort and limit). 
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if result is self._cursor:
+                return self
+            return result
+        return chained
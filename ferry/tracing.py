@@ -0,0 +1,177 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import functools
+import threading2
+import time
+
+# Maximum number of spans recorded per trace. Long running
+# retry loops shouldn't be able to use up all the memory.
+MAX_SPANS = 10000
+
+_context = threading2.local()
+_lock = threading2.Lock()
+_traces = {}
+
+class Trace(object):
+    """
+    All the spans recorded while building a single stack.
+    """
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.start = time.time()
+        self.spans = []
+        self.dropped = 0
+        self.next_id = 0
+        self.lock = threading2.Lock()
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def add(self, span):
+        with self.lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def to_dict(self):
+        """
+        Return the spans along with the total time and outcome
+        of each kind of span, from the most to the least time.
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s['start'])
+            dropped = self.dropped
+
+        summary = {}
+        for s in spans:
+            entry = summary.setdefault(s['name'], { 'name' : s['name'],
+                                                    'count' : 0,
+                                                    'errors' : 0,
+                                                    'total' : 0.0,
+                                                    'max' : 0.0 })
+            entry['count'] += 1
+            entry['total'] = round(entry['total'] + s['duration'], 3)
+            entry['max'] = max(entry['max'], s['duration'])
+            if s['status'] != 'ok':
+                entry['errors'] += 1
+
+        return { 'uuid' : self.trace_id,
+                 'elapsed' : round(time.time() - self.start, 3),
+                 'spans' : spans,
+                 'summary' : sorted(summary.values(), key=lambda e: -e['total']),
+                 'dropped' : dropped }
+
+def start_trace(trace_id):
+    """
+    Start recording spans for the current thread under the trace.
+    """
+    trace = Trace(trace_id)
+    with _lock:
+        _traces[trace_id] = trace
+    restore((trace, None))
+    return trace
+
+def end_trace(trace_id):
+    """
+    Stop recording the trace and return its contents.
+    """
+    with _lock:
+        trace = _traces.pop(trace_id, None)
+    restore(None)
+    if trace:
+        return trace.to_dict()
+
+def get_trace(trace_id):
+    """
+    Get the contents of a trace that is still being recorded.
+    """
+    with _lock:
+        trace = _traces.get(trace_id)
+    if trace:
+        return trace.to_dict()
+
+def capture():
+    """
+    Get the trace context of the current thread, so that it
+    can be restored in another thread (i.e., a worker thread).
+    """
+    return getattr(_context, 'current', None)
+
+def restore(context):
+    _context.current = context
+
+class span(object):
+    """
+    Record the duration and outcome of a block of code. If there
+    is no active trace, this does nothing.
+    """
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.context = None
+        self.error = None
+
+    def fail(self, error):
+        """
+        Mark the span as failed without raising an exception.
+        """
+        self.error = error
+
+    def __enter__(self):
+        self.context = capture()
+        if self.context:
+            trace, parent = self.context
+            self.span_id = trace.new_id()
+            self.parent = parent
+            self.start = time.time()
+            restore((trace, self.span_id))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.context:
+            trace, _ = self.context
+            record = dict(self.attrs)
+            record['id'] = self.span_id
+            record['parent'] = self.parent
+            record['name'] = self.name
+            record['start'] = round(self.start - trace.start, 3)
+            record['duration'] = round(time.time() - self.start, 3)
+            if exc_type:
+                record['status'] = 'error'
+                record['error'] = str(exc_value)
+            elif self.error:
+                record['status'] = 'error'
+                record['error'] = self.error
+            else:
+                record['status'] = 'ok'
+            trace.add(record)
+            restore(self.context)
+        return False
+
+def traced(name):
+    """
+    Decorator that records each call of the function as a span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
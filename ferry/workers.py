@@ -0,0 +1,168 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import multiprocessing
+import Queue
+import sys
+import threading2
+from ferry import tracing
+
+def default_workers():
+    """
+    Number of workers to use when the caller doesn't specify.
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class WorkerPool(object):
+    """
+    Run a function over a list of items using a bounded number
+    of threads. Results are always returned in the same order as
+    the items, so the output does not depend on scheduling.
+    """
+    def __init__(self, num_workers=None):
+        if not num_workers:
+            num_workers = default_workers()
+        self.num_workers = max(1, int(num_workers))
+
+    def map(self, func, items):
+        """
+        Apply the function to each item and return the list of
+        results. If any call raises an exception, the exception of
+        the earliest item is re-raised after all the workers finish.
+        """
+        items = list(items)
+        if self.num_workers == 1 or len(items) < 2:
+            return [func(i) for i in items]
+
+        work = Queue.Queue()
+        for i, item in enumerate(items):
+            work.put((i, item))
+
+        results = [None] * len(items)
+        errors = []
+        context = tracing.capture()
+        def _worker():
+            # Spans recorded by the workers belong to the caller's trace. 
+            tracing.restore(context)
+            while True:
+                try:
+                    i, item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(item)
+                except Exception:
+                    errors.append((i, sys.exc_info()))
+
+        threads = []
+        for _ in range(min(self.num_workers, len(items))):
+            t = threading2.Thread(target=_worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            errors.sort(key=lambda e: e[0])
+            exc_type, exc_value, exc_tb = errors[0][1]
+            raise exc_type, exc_value, exc_tb
+        return results
+
+    def imap(self, func, items):
+        """
+        Like map, but yield each result (in the same order as the items)
+        as soon as it's ready instead of waiting for all of them. If a call
+        raised an exception, it's re-raised when its result is reached. 
+        """
+        items = list(items)
+        if self.num_workers == 1 or len(items) < 2:
+            for item in items:
+                yield func(item)
+            return
+
+        work = Queue.Queue()
+        for i, item in enumerate(items):
+            work.put((i, item))
+
+        results = {}
+        cond = threading2.Condition()
+        context = tracing.capture()
+        def _worker():
+            tracing.restore(context)
+            while True:
+                try:
+                    i, item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result = (func(item), None)
+                except Exception:
+                    result = (None, sys.exc_info())
+                with cond:
+                    results[i] = result
+                    cond.notify_all()
+
+        for _ in range(min(self.num_workers, len(items))):
+            t = threading2.Thread(target=_worker)
+            t.daemon = True
+            t.start()
+
+        for i in range(len(items)):
+            with cond:
+                while not i in results:
+                    cond.wait()
+                result, exc_info = results.pop(i)
+            if exc_info:
+                exc_type, exc_value, exc_tb = exc_info
+                raise exc_type, exc_value, exc_tb
+            yield result
+
+class BackgroundTask(object):
+    """
+    Run a function in a background thread so that the caller
+    can wait for the result later. 
+    """
+    def __init__(self, func, *args, **kwargs):
+        self.result = None
+        self.exc_info = None
+        self._thread = threading2.Thread(target=self._run, 
+                                         args=(func, args, kwargs, tracing.capture()))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs, context):
+        tracing.restore(context)
+        try:
+            self.result = func(*args, **kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self):
+        """
+        Wait for the function to finish and return its result. If
+        the function raised an exception, re-raise it here. 
+        """
+        self._thread.join()
+        if self.exc_info:
+            exc_type, exc_value, exc_tb = self.exc_info
+            raise exc_type, exc_value, exc_tb
+        return self.result